@@ -1,11 +1,18 @@
-from decimal import Decimal
+import os
 
 SYNC_FREQUENCY_INTERVAL_HOURS = 4
 NUM_WORKERS = 14
 """Max 14 workers because of DB config of 5 concurrent + 10 overflow connections"""
-TAX = Decimal(0.10)
-SELLER_COST = Decimal(0.85)
+PROFIT_WORKERS = int(os.environ.get('PROFIT_WORKERS', os.cpu_count() or 1))
+"""Processes for the CPU-bound profit stages. They never touch the database, so cores bound them and not the pool"""
+TAX_RATE_BASIS_POINTS = 1000
+"""Sales tax paid on purchases, 10%"""
+SELLER_COST_RATE_BASIS_POINTS = 8500
+"""What's left of a sale after TCGplayer's fees, 85%"""
+SELL_SHIPPING_CUTOFF_CENTS = 4000
+SELL_SHIPPING_COST_CENTS = 400
+"""Sales at or above $40 ship tracked, which eats $4 of the sale price"""
 BATCH_SIZE = 1000
-MAX_PROFIT_CUTOFF_DOLLARS = 1
+MAX_PROFIT_CUTOFF_CENTS = 100
 COPIES_TIME_DELTA_DAYS = 7
 SALES_TIME_DELTA_DAYS = 7
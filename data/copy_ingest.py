@@ -0,0 +1,78 @@
+import io
+from datetime import datetime
+from typing import Iterable, Sequence, Any
+
+from sqlalchemy.orm import Session
+
+from utils.metrics import metrics, DB_ROWS_WRITTEN_METRIC, DB_STATEMENTS_METRIC, DB_STATEMENT_DURATION_METRIC
+
+_COPY_TEXT_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def _encode_copy_value(value: Any) -> str:
+    # Encodes a value in the COPY text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, str):
+        return value.translate(_COPY_TEXT_ESCAPES)
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+
+    return str(value)
+
+
+class CopyBuffer:
+    """
+        In-memory buffer of rows in the COPY text format for one table. Rows are encoded as they're added, so flushing
+        is a single COPY ... FROM STDIN of the buffer.
+    """
+
+    def __init__(self, table_name: str, columns: Sequence[str]):
+        self.table_name = table_name
+        self.columns = columns
+        self.row_count = 0
+        self._buffer = io.StringIO()
+
+    def add_row(self, row: Sequence[Any]):
+        self._buffer.write('\t'.join(map(_encode_copy_value, row)))
+        self._buffer.write('\n')
+        self.row_count += 1
+
+    def add_rows(self, rows: Iterable[Sequence[Any]]):
+        for row in rows:
+            self.add_row(row)
+
+    def flush(self, session: Session) -> int:
+        """Copies the buffered rows in the session's transaction and resets the buffer. Returns the row count."""
+        row_count = self.row_count
+        if row_count == 0:
+            return 0
+
+        self._buffer.seek(0)
+
+        # COPY isn't exposed by SQLAlchemy, so we go through the psycopg2 cursor of the session's connection,
+        # and record it ourselves, the engine events never see it
+        cursor = session.connection().connection.cursor()
+        try:
+            with metrics.time(DB_STATEMENT_DURATION_METRIC, operation='COPY'):
+                cursor.copy_expert(
+                    f'COPY {self.table_name} ({", ".join(self.columns)}) FROM STDIN',
+                    self._buffer,
+                )
+        finally:
+            cursor.close()
+
+        metrics.inc(DB_STATEMENTS_METRIC, operation='COPY')
+        metrics.inc(DB_ROWS_WRITTEN_METRIC, row_count, table=self.table_name)
+
+        self._buffer = io.StringIO()
+        self.row_count = 0
+
+        return row_count
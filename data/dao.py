@@ -1,36 +1,137 @@
 from datetime import timedelta, datetime
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Dict
 
-from sqlalchemy import and_, desc, func, asc, select
+from sqlalchemy import and_, desc, func, asc, select, insert, literal, union_all, Subquery, update
 from sqlalchemy.orm import Session, Query
 
-from models import db_sessionmaker, SKUListingsBatchAggregateData, SKU, SKUListing
+from models import db_sessionmaker, SKUListingsBatchAggregateData, SKU, SKUListing, Printing, Condition, Set, Card
 from models.card_sale import CardSale
+from models.card_sync_data import CardSyncData
+from models.listing_snapshot import ListingSnapshot, ListingSnapshotStatus
+from models.sku_listings_batch_aggregate_rollup import sku_listings_batch_aggregate_hourly, \
+    sku_listings_batch_aggregate_daily
 from tasks.log_runtime_decorator import log_runtime
 
 
-def query_most_recent_sale_timestamp_for_card(session: Session, card_id) -> Query:
-    return session.query(CardSale.order_date) \
-        .filter(CardSale.card_id == card_id) \
-        .order_by(desc(CardSale.order_date))
-
-
 def get_sales_count_since_date(session: Session, card_id: int, date: datetime):
     return session.query(func.count()).filter(
         and_(CardSale.card_id == card_id, CardSale.order_date >= date)
     ).scalar()
 
 
+def get_sales_counts_since_date(session: Session, date: datetime) -> Dict[int, int]:
+    """Number of sales of every card that sold since date, in one grouped query"""
+    return dict(
+        session.query(CardSale.card_id, func.count())
+        .filter(CardSale.order_date >= date)
+        .group_by(CardSale.card_id)
+        .all()
+    )
+
+
+def _query_sku_sales(session: Session, sku_ids: Optional[List[int]], start_date: datetime, *columns) -> Query:
+    """
+        card_sales rows of sku_ids (all SKUs if None) since start_date, matched to their SKU on card, printing and
+        condition
+    """
+    query = session.query(SKU.id, *columns) \
+        .join(Printing, Printing.id == SKU.printing_id) \
+        .join(Condition, Condition.id == SKU.condition_id) \
+        .join(CardSale, and_(
+            CardSale.card_id == SKU.card_id,
+            CardSale.printing_name == Printing.name,
+            CardSale.condition_name == Condition.name,
+        )) \
+        .filter(CardSale.order_date >= start_date)
+
+    return query.filter(SKU.id.in_(sku_ids)) if sku_ids is not None else query
+
+
+def get_sales_watermarks_for_cards(
+        session: Session,
+        card_ids: List[int],
+        start_date: datetime,
+) -> List[Tuple[int, str, str, datetime]]:
+    """
+        (card_id, printing_name, condition_name, latest order_date) of every variant of card_ids with sales since
+        start_date, in one grouped query. start_date keeps the scan to the recent chunks of the hypertable.
+    """
+    return session.query(
+        CardSale.card_id, CardSale.printing_name, CardSale.condition_name, func.max(CardSale.order_date)
+    ) \
+        .filter(CardSale.card_id.in_(card_ids), CardSale.order_date >= start_date) \
+        .group_by(CardSale.card_id, CardSale.printing_name, CardSale.condition_name) \
+        .all()
+
+
+def get_card_sales_watermarks(session: Session, card_ids: List[int]) -> List[Tuple[int, datetime]]:
+    """(card_id, sales_watermark) of the cards of card_ids whose sales were ever fetched for every variant"""
+    return session.query(CardSyncData.card_id, CardSyncData.sales_watermark) \
+        .filter(CardSyncData.card_id.in_(card_ids), CardSyncData.sales_watermark.isnot(None)) \
+        .all()
+
+
+def set_card_sales_watermarks(session: Session, card_id_to_watermark: Dict[int, datetime]):
+    """Sets the sales_watermark of the cards, in the session's transaction"""
+    session.execute(update(CardSyncData), [
+        dict(card_id=card_id, sales_watermark=watermark) for card_id, watermark in card_id_to_watermark.items()
+    ])
+
+
+def get_sales_for_skus(
+        session: Session,
+        sku_ids: Optional[List[int]],
+        start_date: datetime,
+) -> List[Tuple[int, datetime, int]]:
+    """(sku_id, order_date, quantity) of every sale of sku_ids (all SKUs if None) in card_sales since start_date"""
+    return _query_sku_sales(session, sku_ids, start_date, CardSale.order_date, CardSale.quantity).all()
+
+
+def get_sku_request_data(session: Session, sku_ids: List[int]) -> List[Tuple[int, int, int, int, str, str]]:
+    """
+        (sku_id, card_id, printing_id, condition_id, printing_name, condition_name) of sku_ids, what the sales requests
+        of a SKU need and the names card_sales identifies it by
+    """
+    return session.query(SKU.id, SKU.card_id, SKU.printing_id, SKU.condition_id, Printing.name, Condition.name) \
+        .join(Printing, Printing.id == SKU.printing_id) \
+        .join(Condition, Condition.id == SKU.condition_id) \
+        .filter(SKU.id.in_(sku_ids)) \
+        .all()
+
+
+def _get_listing_rollup_since(start_date: datetime, *column_names: str) -> Subquery:
+    """
+        sku_id, bucket and column_names of the rolled up batch aggregate buckets from start_date until now. The partial
+        day at the start of the window comes from the hourly rollup and every full day after it from the daily one, so
+        first()/last() over the buckets ordered by bucket give the same result as over the raw snapshots, to the hour.
+    """
+    start_of_day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    first_full_day = start_of_day if start_of_day == start_date else start_of_day + timedelta(days=1)
+
+    hourly = sku_listings_batch_aggregate_hourly
+    daily = sku_listings_batch_aggregate_daily
+
+    def select_columns(rollup):
+        return select(rollup.c.sku_id, rollup.c.bucket, *[rollup.c[column_name] for column_name in column_names])
+
+    return union_all(
+        select_columns(hourly)
+        .filter(hourly.c.bucket >= start_date.replace(minute=0, second=0, microsecond=0))
+        .filter(hourly.c.bucket < first_full_day),
+        select_columns(daily).filter(daily.c.bucket >= first_full_day),
+    ).subquery()
+
+
 def get_past_top_listings_by_listings_delta(session: Session, delta: timedelta):
     start_date = datetime.now() - delta
+    rollup = _get_listing_rollup_since(start_date, 'first_total_listings_count', 'last_total_listings_count')
 
     copies_delta_subquery = session.query(
-        SKUListingsBatchAggregateData.sku_id,
-        (func.first(SKUListingsBatchAggregateData.total_listings_count, SKUListingsBatchAggregateData.timestamp) -
-         func.last(SKUListingsBatchAggregateData.total_listings_count, SKUListingsBatchAggregateData.timestamp))
+        rollup.c.sku_id,
+        (func.first(rollup.c.first_total_listings_count, rollup.c.bucket) -
+         func.last(rollup.c.last_total_listings_count, rollup.c.bucket))
             .label("listings_delta"),
-    ).filter(SKUListingsBatchAggregateData.timestamp >= start_date) \
-        .group_by(SKUListingsBatchAggregateData.sku_id) \
+    ).group_by(rollup.c.sku_id) \
         .subquery()
 
     return session.query(SKU, copies_delta_subquery.c.listings_delta) \
@@ -42,20 +143,30 @@ def get_past_top_listings_by_listings_delta(session: Session, delta: timedelta):
 
 def get_top_lowest_listing_price_changes_past_3_days(session: Session):
     start_date = datetime.now() - timedelta(days=3)
+    rollup = _get_listing_rollup_since(start_date, 'first_lowest_listing_price', 'last_lowest_listing_price')
 
     return session.query(
         SKU,
-        ((func.last(SKUListingsBatchAggregateData.lowest_listing_price, SKUListingsBatchAggregateData.timestamp) -
-          func.first(SKUListingsBatchAggregateData.lowest_listing_price, SKUListingsBatchAggregateData.timestamp)) /
-         func.first(SKUListingsBatchAggregateData.lowest_listing_price, SKUListingsBatchAggregateData.timestamp))
+        ((func.last(rollup.c.last_lowest_listing_price, rollup.c.bucket) -
+          func.first(rollup.c.first_lowest_listing_price, rollup.c.bucket)) /
+         func.first(rollup.c.first_lowest_listing_price, rollup.c.bucket))
             .label("price_change"),
-    ).join(SKUListingsBatchAggregateData.sku) \
-        .filter(SKUListingsBatchAggregateData.timestamp >= start_date) \
-        .group_by(SKU.card_id, SKUListingsBatchAggregateData.sku_id) \
+    ).join(SKU, SKU.id == rollup.c.sku_id) \
+        .group_by(SKU.card_id, rollup.c.sku_id, SKU.id) \
         .order_by(desc("price_change")) \
         .subquery()
 
 
+def get_set_modified_dates(session: Session) -> Dict[int, Optional[datetime]]:
+    """modified_date of every set, so the catalog sync can diff the sets in memory"""
+    return dict(session.query(Set.id, Set.modified_date).all())
+
+
+def get_card_modified_dates(session: Session, set_ids: List[int]) -> Dict[int, Optional[datetime]]:
+    """modified_date of every card of set_ids, None for the cards stored before cards had one"""
+    return dict(session.query(Card.id, Card.modified_date).filter(Card.set_id.in_(set_ids)).all())
+
+
 def get_skus(session: Session):
     return session.query(SKU).join(SKUListingsBatchAggregateData.sku)
 
@@ -74,37 +185,129 @@ def query_most_recent_lowest_listing_price(session: Session, card_id: int, delta
         .order_by(asc(SKUListingsBatchAggregateData.timestamp))
 
 
-def get_listing_sku_ids(session: Session) -> List[int]:
-    return session.scalars(select(SKUListing.sku_id).distinct()).all()
+def get_listing_sku_ids(session: Session, timestamp: Optional[datetime] = None) -> List[int]:
+    """SKUs with listings in the snapshot at timestamp, the latest complete one by default"""
+    timestamp = timestamp or get_latest_complete_snapshot_timestamp(session)
+    if timestamp is None:
+        return []
+
+    return session.scalars(select(SKUListing.sku_id).filter(SKUListing.timestamp == timestamp).distinct()).all()
+
+
+def get_latest_listings_for_skus(
+        session: Session,
+        sku_ids: Optional[List[int]] = None,
+        timestamp: Optional[datetime] = None,
+) -> List[SKUListing]:
+    """
+        Listings of the SKUs, all of them if sku_ids is None, in the snapshot at timestamp, the latest complete one by
+        default. The equality on timestamp keeps the scan to the one chunk holding the snapshot.
+    """
+    timestamp = timestamp or get_latest_complete_snapshot_timestamp(session)
+    if timestamp is None:
+        return []
 
+    query = session.query(SKUListing).filter(SKUListing.timestamp == timestamp)
+    if sku_ids is not None:
+        query = query.filter(SKUListing.sku_id.in_(sku_ids))
 
-def get_latest_listings_for_skus(session: Session, sku_ids: List[int]) -> List[SKUListing]:
-    latest_timestamp_subquery: datetime = session.query(
-        func.last(SKUListing.timestamp, SKUListing.timestamp).label('latest_timestamp')).scalar()
+    return query.all()
 
-    return session.query(SKUListing).filter(SKUListing.sku_id.in_(sku_ids)).filter(
-        SKUListing.timestamp == latest_timestamp_subquery).all()
+
+def get_listing_order_book_rows(session: Session, sku_ids: List[int], timestamp: datetime) -> List[Tuple]:
+    """(sku_id, price_cents, shipping_price_cents, quantity) of the listings of the SKUs in the snapshot at timestamp"""
+    return session.query(
+        SKUListing.sku_id, SKUListing.price_cents, SKUListing.shipping_price_cents, SKUListing.quantity
+    ) \
+        .filter(SKUListing.timestamp == timestamp) \
+        .filter(SKUListing.sku_id.in_(sku_ids)) \
+        .all()
 
 
 def get_copies_delta_for_skus(session: Session, sku_ids: List[int], delta: timedelta) -> List[Tuple[int, int]]:
     start_date = datetime.now() - delta
+    rollup = _get_listing_rollup_since(start_date, 'first_total_copies_count', 'last_total_copies_count')
 
     return session.query(
-        SKUListingsBatchAggregateData.sku_id,
+        rollup.c.sku_id,
         (
-                func.last(
-                    SKUListingsBatchAggregateData.total_copies_count,
-                    SKUListingsBatchAggregateData.timestamp
-                ) -
-                func.first(
-                    SKUListingsBatchAggregateData.total_copies_count,
-                    SKUListingsBatchAggregateData.timestamp)
+                func.last(rollup.c.last_total_copies_count, rollup.c.bucket) -
+                func.first(rollup.c.first_total_copies_count, rollup.c.bucket)
         )
-    ).filter(SKUListingsBatchAggregateData.sku_id.in_(sku_ids)) \
-        .filter(SKUListingsBatchAggregateData.timestamp >= start_date) \
-        .group_by(SKUListingsBatchAggregateData.sku_id) \
+    ).filter(rollup.c.sku_id.in_(sku_ids)) \
+        .group_by(rollup.c.sku_id) \
+        .all()
+
+
+def get_latest_complete_snapshot_timestamp(session: Session, since: Optional[datetime] = None) -> Optional[datetime]:
+    """Timestamp of the newest listing sweep that finished writing, read off the end of the snapshot primary key"""
+    query = session.query(ListingSnapshot.timestamp) \
+        .filter(ListingSnapshot.status == ListingSnapshotStatus.COMPLETE)
+
+    if since is not None:
+        query = query.filter(ListingSnapshot.timestamp >= since)
+
+    return query.order_by(desc(ListingSnapshot.timestamp)).limit(1).scalar()
+
+
+def start_listing_snapshot(session: Session, timestamp: datetime) -> None:
+    session.add(ListingSnapshot(timestamp=timestamp, status=ListingSnapshotStatus.IN_PROGRESS))
+    session.commit()
+
+
+def finish_listing_snapshot(
+        session: Session,
+        timestamp: datetime,
+        status: ListingSnapshotStatus,
+        product_count: Optional[int] = None,
+        row_count: Optional[int] = None,
+) -> None:
+    snapshot = session.get(ListingSnapshot, timestamp)
+    snapshot.status = status
+    snapshot.product_count = product_count
+    snapshot.row_count = row_count
+    snapshot.completed_at = datetime.utcnow()
+
+    session.commit()
+
+
+def get_batch_aggregate_data_at_timestamp(session: Session, timestamp: datetime) -> List[SKUListingsBatchAggregateData]:
+    return session.query(SKUListingsBatchAggregateData) \
+        .filter(SKUListingsBatchAggregateData.timestamp == timestamp) \
         .all()
 
 
+def carry_forward_listing_snapshot(
+        session: Session,
+        sku_ids: List[int],
+        from_timestamp: datetime,
+        to_timestamp: datetime,
+) -> int:
+    """
+        Copies the listings and batch aggregate rows of the SKUs at from_timestamp to to_timestamp, in the database.
+        Returns the number of listings copied.
+    """
+    listing_columns = [column.name for column in SKUListing.__table__.columns]
+    aggregate_columns = [column.name for column in SKUListingsBatchAggregateData.__table__.columns]
+
+    def select_at_to_timestamp(model, columns):
+        return select(*[
+            literal(to_timestamp).label(column) if column == 'timestamp' else getattr(model, column)
+            for column in columns
+        ]).filter(model.timestamp == from_timestamp).filter(model.sku_id.in_(sku_ids))
+
+    listing_row_count = session.execute(
+        insert(SKUListing).from_select(listing_columns, select_at_to_timestamp(SKUListing, listing_columns))
+    ).rowcount
+    session.execute(
+        insert(SKUListingsBatchAggregateData).from_select(
+            aggregate_columns,
+            select_at_to_timestamp(SKUListingsBatchAggregateData, aggregate_columns),
+        )
+    )
+
+    return listing_row_count
+
+
 if __name__ == "__main__":
     print(get_top_lowest_listing_price_changes_past_3_days(db_sessionmaker()).all())
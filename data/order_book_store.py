@@ -0,0 +1,193 @@
+import logging
+from datetime import datetime
+from threading import Lock
+from typing import List, NamedTuple, Optional, Sequence, Iterable
+
+import numpy as np
+
+from tasks.custom_types import SKUListingResponse
+from utils.money import to_cents
+
+logger = logging.getLogger(__name__)
+
+
+class BookListing(NamedTuple):
+    """A listing of an order book, with the fields the profit code reads off SKUListing"""
+    price_cents: int
+    shipping_price_cents: int
+    quantity: int
+
+    @property
+    def total_price_cents(self) -> int:
+        return self.price_cents + self.shipping_price_cents
+
+
+class OrderBookSnapshot:
+    """
+        The listings of every SKU of one listing snapshot, in flat arrays sorted by SKU and then by price + shipping.
+        The order book of sku_ids[k] is at offsets[k]:offsets[k + 1]. Snapshots are never modified once built, so
+        readers can use them without locking while the next one is being built.
+    """
+
+    def __init__(
+            self,
+            timestamp: datetime,
+            sku_ids: np.ndarray,
+            offsets: np.ndarray,
+            price_cents: np.ndarray,
+            shipping_price_cents: np.ndarray,
+            quantity: np.ndarray,
+    ):
+        self.timestamp = timestamp
+        self.sku_ids = sku_ids
+        self.offsets = offsets
+        self.price_cents = price_cents
+        self.shipping_price_cents = shipping_price_cents
+        self.quantity = quantity
+
+    def __len__(self):
+        return len(self.sku_ids)
+
+    @property
+    def listing_count(self) -> int:
+        return len(self.quantity)
+
+    def get_sku_indexes(self, sku_ids: Sequence[int]) -> np.ndarray:
+        """Positions of sku_ids in the snapshot, -1 for the SKUs it has no listings for"""
+        sku_ids = np.asarray(sku_ids, dtype=self.sku_ids.dtype)
+        if len(self.sku_ids) == 0:
+            return np.full(len(sku_ids), -1)
+
+        indexes = np.searchsorted(self.sku_ids, sku_ids)
+        indexes[indexes == len(self.sku_ids)] = 0
+
+        return np.where(self.sku_ids[indexes] == sku_ids, indexes, -1)
+
+    def get_listing_indexes(self, sku_indexes: np.ndarray) -> np.ndarray:
+        """Positions in the flat arrays of every listing of the SKUs at sku_indexes, book after book"""
+        starts = self.offsets[sku_indexes]
+        counts = self.offsets[sku_indexes + 1] - starts
+        book_starts = np.repeat(np.cumsum(counts) - counts, counts)
+
+        return np.repeat(starts, counts) + np.arange(counts.sum()) - book_starts
+
+    def get_book(self, sku_id: int) -> List[BookListing]:
+        index = self.get_sku_indexes([sku_id])[0]
+        if index < 0:
+            return []
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return [
+            BookListing(int(price_cents), int(shipping_price_cents), int(quantity))
+            for price_cents, shipping_price_cents, quantity in zip(
+                self.price_cents[start:end], self.shipping_price_cents[start:end], self.quantity[start:end]
+            )
+        ]
+
+
+class OrderBookSnapshotBuilder:
+    """
+        Collects the listings of a snapshot while the sweep writes them. The writer threads add listings as they go,
+        build sorts everything into a snapshot once the sweep is done.
+    """
+
+    def __init__(self, timestamp: datetime):
+        self.timestamp = timestamp
+        self._chunks: List[tuple] = []
+        self._lock = Lock()
+
+    def add(self, sku_listing_responses: Iterable[SKUListingResponse]):
+        self.add_rows(
+            (
+                response['productConditionId'],
+                to_cents(response['price']),
+                to_cents(response['shippingPrice']),
+                response['quantity'],
+            )
+            for response in sku_listing_responses
+        )
+
+    def add_rows(self, rows: Iterable[tuple]):
+        """Adds (sku_id, price_cents, shipping_price_cents, quantity) rows"""
+        rows = list(rows)
+        if not rows:
+            return
+
+        chunk = tuple(np.array(column, dtype=np.int32) for column in zip(*rows))
+
+        with self._lock:
+            self._chunks.append(chunk)
+
+    def build(
+            self,
+            carry_forward_sku_ids: Sequence[int] = (),
+            previous_snapshot: Optional[OrderBookSnapshot] = None,
+    ) -> OrderBookSnapshot:
+        """Sorts the collected listings into a snapshot, with the books of carry_forward_sku_ids of previous_snapshot"""
+        with self._lock:
+            chunks = list(self._chunks)
+
+        if len(carry_forward_sku_ids) and previous_snapshot is not None:
+            sku_indexes = previous_snapshot.get_sku_indexes(carry_forward_sku_ids)
+            sku_indexes = sku_indexes[sku_indexes >= 0]
+            listing_indexes = previous_snapshot.get_listing_indexes(sku_indexes)
+
+            chunks.append((
+                np.repeat(previous_snapshot.sku_ids[sku_indexes], np.diff(previous_snapshot.offsets)[sku_indexes]),
+                previous_snapshot.price_cents[listing_indexes],
+                previous_snapshot.shipping_price_cents[listing_indexes],
+                previous_snapshot.quantity[listing_indexes],
+            ))
+
+        if chunks:
+            sku_ids, price_cents, shipping_price_cents, quantity = (np.concatenate(column) for column in zip(*chunks))
+        else:
+            sku_ids, price_cents, shipping_price_cents, quantity = (np.zeros(0, dtype=np.int32) for _ in range(4))
+
+        # lexsort is stable, listings with the same cost stay in the order they were fetched in
+        order = np.lexsort((price_cents.astype(np.int64) + shipping_price_cents, sku_ids))
+        sku_ids = sku_ids[order]
+
+        book_starts = np.flatnonzero(np.diff(sku_ids, prepend=-1))
+
+        return OrderBookSnapshot(
+            timestamp=self.timestamp,
+            sku_ids=sku_ids[book_starts],
+            offsets=np.append(book_starts, len(sku_ids)).astype(np.int64),
+            price_cents=price_cents[order],
+            shipping_price_cents=shipping_price_cents[order],
+            quantity=quantity[order],
+        )
+
+
+class OrderBookStore:
+    """
+        Latest complete order book snapshot of the listing sweep, for the analysis jobs running in the same process.
+        Publishing swaps the whole snapshot at once, so readers either see the previous sweep or the new one.
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[OrderBookSnapshot] = None
+        self._lock = Lock()
+
+    def latest(self) -> Optional[OrderBookSnapshot]:
+        """None on a cold start, the listings then have to come from the database"""
+        with self._lock:
+            return self._snapshot
+
+    def publish(self, snapshot: OrderBookSnapshot):
+        with self._lock:
+            self._snapshot = snapshot
+
+        logger.info(
+            f'Published the order books of {len(snapshot)} SKUs ({snapshot.listing_count} listings) of '
+            f'{snapshot.timestamp}'
+        )
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+
+order_book_store = OrderBookStore()
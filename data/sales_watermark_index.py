@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from data.dao import get_sales_watermarks_for_cards, get_card_sales_watermarks
+
+Variant = Tuple[int, str, str]
+"""(card_id, printing_name, condition_name), the columns card_sales identifies a SKU by"""
+
+
+class SalesWatermarkIndex:
+    """
+        Watermarks of the sales already in card_sales, so sales fetches only request the sales after them. Every
+        variant of a card has the latest order_date card_sales has for it. Every card has the sales_watermark of its
+        card_sync_data row, up to which the sales of all its variants were fetched. The two differ because fetches of
+        single variants only move the variant's watermark. They're loaded in two queries before a fetch starts and
+        advanced as the fetched sales are inserted, instead of querying every card's latest sale in the fetch itself.
+
+        Order dates are the UTC ones card_sales stores, get and get_variant give them back timezone aware like the
+        dates of the sales endpoint.
+    """
+
+    def __init__(self, variant_watermarks: Dict[Variant, datetime], card_watermarks: Dict[int, datetime] = None):
+        self._variant_watermarks: Dict[Variant, datetime] = {}
+        self._card_watermarks: Dict[int, datetime] = {}
+        self._lock = Lock()
+
+        self._advance(variant_watermarks.items())
+        self.advance_cards(card_watermarks or {})
+
+    @staticmethod
+    def load(session: Session, card_ids: List[int], start_date: datetime) -> 'SalesWatermarkIndex':
+        """Watermarks of the cards of card_ids, sales before start_date aren't looked at for the variant ones"""
+        return SalesWatermarkIndex(
+            {
+                (card_id, printing_name, condition_name): order_date
+                for card_id, printing_name, condition_name, order_date in get_sales_watermarks_for_cards(
+                    session, card_ids, start_date
+                )
+            },
+            dict(get_card_sales_watermarks(session, card_ids)),
+        )
+
+    def get(self, card_id: int) -> Optional[datetime]:
+        with self._lock:
+            return self._to_utc(self._card_watermarks.get(card_id))
+
+    def get_variant(self, card_id: int, printing_name: str, condition_name: str) -> Optional[datetime]:
+        with self._lock:
+            return self._to_utc(self._variant_watermarks.get((card_id, printing_name, condition_name)))
+
+    def is_new(self, card_id: int, printing_name: str, condition_name: str, order_date: datetime) -> bool:
+        """Whether a sale of the variant (timezone aware order_date) is after the variant's watermark"""
+        variant_watermark = self.get_variant(card_id, printing_name, condition_name)
+
+        return variant_watermark is None or order_date > variant_watermark
+
+    def advance(self, sales: Iterable) -> None:
+        """
+            Moves the variant watermarks past sales (anything with card_id, printing_name, condition_name and
+            order_date)
+        """
+        self._advance(
+            ((sale.card_id, sale.printing_name, sale.condition_name), self._to_naive_utc(sale.order_date))
+            for sale in sales
+        )
+
+    def _advance(self, variant_order_dates: Iterable[Tuple[Variant, datetime]]) -> None:
+        with self._lock:
+            for variant, order_date in variant_order_dates:
+                if variant not in self._variant_watermarks or order_date > self._variant_watermarks[variant]:
+                    self._variant_watermarks[variant] = order_date
+
+    def advance_cards(self, card_watermarks: Dict[int, datetime]) -> None:
+        """Moves the card watermarks, after the sales of every variant of the cards up to them are in card_sales"""
+        with self._lock:
+            for card_id, order_date in card_watermarks.items():
+                order_date = self._to_naive_utc(order_date)
+                if card_id not in self._card_watermarks or order_date > self._card_watermarks[card_id]:
+                    self._card_watermarks[card_id] = order_date
+
+    @staticmethod
+    def _to_naive_utc(order_date: datetime) -> datetime:
+        if order_date.tzinfo is None:
+            return order_date
+
+        return order_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @staticmethod
+    def _to_utc(order_date: Optional[datetime]) -> Optional[datetime]:
+        return order_date.replace(tzinfo=timezone.utc) if order_date is not None else None
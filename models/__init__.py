@@ -1,12 +1,16 @@
 import os
+from threading import Lock
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+
+from utils.metrics import instrument_database
 
 Base = declarative_base()
 
-# We need to import new models to have them automatically created
+# We need to import new models to have them created by models/migrate.py
 from models.card import Card
 from models.condition import Condition
 from models.printing import Printing
@@ -17,48 +21,37 @@ from models.card_sale import CardSale
 from models.card_sync_data import CardSyncData
 from models.sku_listings_batch_aggregate_data import SKUListingsBatchAggregateData
 from models.sku_max_profit import SKUMaxProfit
+from models.listing_snapshot import ListingSnapshot
 
 load_dotenv()
 
-DATABASE_URI = os.environ.get("DATABASE_URI")
-engine = create_engine(DATABASE_URI, future=True)
-
-Base.metadata.create_all(engine)
+_engine = None
+_engine_lock = Lock()
 
-db_sessionmaker = sessionmaker(engine)
 
-LISTINGS_CHUNK_TIME_INTERVAL = '1 day'
-SALES_CHUNK_TIME_INTERVAL = '7 day'
+def get_engine() -> Engine:
+    """
+        The engine of DATABASE_URI, created when the first session needs a connection so that importing the models
+        connects to nothing. The schema is set up by models/migrate.py.
+    """
+    global _engine
 
-create_sku_listing_hypertable_sql = text(f"SELECT create_hypertable('{SKUListing.__tablename__}',"
-                                         f"'timestamp',"
-                                         f"if_not_exists => TRUE);"
-                                         )
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(os.environ.get("DATABASE_URI"), future=True)
+            instrument_database(_engine, db_sessionmaker)
 
-create_card_sales_hypertable_sql = text(f"SELECT create_hypertable('{CardSale.__tablename__}',"
-                                        f"'order_date',"
-                                        f"if_not_exists => TRUE);"
-                                        )
+    return _engine
 
-create_sku_listings_batch_aggregate_data_hypertable_sql = text(
-    f"SELECT create_hypertable('{SKUListingsBatchAggregateData.__tablename__}',"
-    f"'timestamp',"                                               
-    f"if_not_exists => TRUE);"
-)
 
-enable_sku_listings_batch_aggregate_data_compression_Sql = text(
-    f"ALTER TABLE {SKUListingsBatchAggregateData.__tablename__} SET (timescaledb.compress, timescaledb.compress_segmentby = 'sku_id')"
-)
+class LazyEngineSession(Session):
+    """Session bound to get_engine() once it first needs a connection"""
 
-with engine.connect() as connection:
-    connection.execute(create_sku_listing_hypertable_sql)
-    connection.execute(create_sku_listings_batch_aggregate_data_hypertable_sql)
-    connection.execute(enable_sku_listings_batch_aggregate_data_compression_Sql)
+    def get_bind(self, *args, **kwargs):
+        if self.bind is None:
+            self.bind = get_engine()
 
-    connection.execute(create_card_sales_hypertable_sql)
+        return super().get_bind(*args, **kwargs)
 
-    connection.execute(text(f"SELECT add_retention_policy('{SKUListing.__tablename__}', INTERVAL '24 hours', if_not_exists => TRUE);"))
-    connection.execute(text(f"SELECT add_retention_policy('{SKUListingsBatchAggregateData.__tablename__}', INTERVAL '30 days', if_not_exists => TRUE);"))
-    connection.execute(text(f"SELECT add_compression_policy('{SKUListingsBatchAggregateData.__tablename__}', INTERVAL '7 days', if_not_exists => TRUE);"))
 
-    connection.commit()
+db_sessionmaker = sessionmaker(class_=LazyEngineSession)
@@ -1,6 +1,7 @@
+from datetime import datetime
 from typing import List
 
-from sqlalchemy import Integer, String, ForeignKey, Text
+from sqlalchemy import Integer, String, ForeignKey, Text, DateTime
 from sqlalchemy.orm import relationship, mapped_column
 
 from models import Base
@@ -31,6 +32,7 @@ class Card(Base):
     attack = mapped_column(String(255))
     defense = mapped_column(String(255))
     description = mapped_column(Text)
+    modified_date = mapped_column(DateTime)
     skus = relationship("SKU", back_populates="card")
     sales = relationship("CardSale", back_populates="card")
 
@@ -56,8 +58,16 @@ class Card(Base):
             attack=card_metadata.get('Attack'),
             defense=card_metadata.get('Defense'),
             description=card_metadata.get('Description'),
+            modified_date=Card._parse_response_modified_date(response['modifiedOn']),
         )
 
+    @staticmethod
+    def _parse_response_modified_date(date: str):
+        # 2022-07-20T20:42:36.44
+        # We only take up to including seconds
+        date = date[0:19]
+        return datetime.strptime(date, "%Y-%m-%dT%H:%M:%S")
+
 
 # Not fetching card sale data for now...
 # # Define the trigger as a raw SQL statement
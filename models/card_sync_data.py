@@ -1,6 +1,6 @@
 from enum import Enum
 
-from sqlalchemy import Column, Integer, ForeignKey, Enum as SQLEnum
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Enum as SQLEnum
 
 from models import Base
 
@@ -16,3 +16,6 @@ class CardSyncData(Base):
 
     card_id = Column(Integer, ForeignKey('card.id'), primary_key=True)
     sync_frequency = Column(SQLEnum(SyncFrequency))
+    # UTC order date of the newest sale a fetch of every variant of the card got back, card_sales has every sale of the
+    # card up to it. Fetches of single variants don't move it.
+    sales_watermark = Column(DateTime)
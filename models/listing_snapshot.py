@@ -0,0 +1,27 @@
+from enum import Enum
+
+from sqlalchemy import Column, Integer, DateTime, Enum as SQLEnum
+
+from models import Base
+
+
+class ListingSnapshotStatus(Enum):
+    IN_PROGRESS = 1
+    COMPLETE = 2
+    FAILED = 3
+    PARTIAL = 4  # Only has the products fetched by the sweep, nothing was carried forward into it
+
+
+class ListingSnapshot(Base):
+    """
+        One row per listing sweep, keyed by the timestamp its sku_listing and batch aggregate rows are written at. Only
+        COMPLETE snapshots are read, so analysis never sees a sweep that's still being written or one that only has some
+        of the products.
+    """
+    __tablename__ = 'listing_snapshot'
+
+    timestamp = Column(DateTime, primary_key=True)
+    status = Column(SQLEnum(ListingSnapshotStatus), nullable=False)
+    product_count = Column(Integer)  # Products fetched or probed by the sweep, carried forward ones aren't counted
+    row_count = Column(Integer)  # sku_listing rows in the snapshot, carried forward ones included
+    completed_at = Column(DateTime)
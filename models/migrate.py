@@ -0,0 +1,128 @@
+"""
+    Creates the tables and sets up TimescaleDB on them: the hypertables, compression, the rollup views and the
+    retention, compression and refresh policies. Importing the models doesn't touch the database, so this runs as its
+    own step, on deploy and whenever the models change. Every statement is idempotent.
+
+    python models/migrate.py
+"""
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from models import Base, get_engine, Card, CardSale, CardSyncData, SKUListing, SKUListingsBatchAggregateData
+from models.listing_snapshot import ListingSnapshotStatus
+from models.sku_listings_batch_aggregate_rollup import sku_listings_batch_aggregate_hourly, \
+    sku_listings_batch_aggregate_daily, get_create_rollup_view_sql
+
+logger = logging.getLogger(__name__)
+
+LISTINGS_CHUNK_TIME_INTERVAL = '1 day'
+SALES_CHUNK_TIME_INTERVAL = '7 day'
+
+create_sku_listing_hypertable_sql = text(f"SELECT create_hypertable('{SKUListing.__tablename__}',"
+                                         f"'timestamp',"
+                                         f"if_not_exists => TRUE);"
+                                         )
+
+create_card_sales_hypertable_sql = text(f"SELECT create_hypertable('{CardSale.__tablename__}',"
+                                        f"'order_date',"
+                                        f"if_not_exists => TRUE);"
+                                        )
+
+create_sku_listings_batch_aggregate_data_hypertable_sql = text(
+    f"SELECT create_hypertable('{SKUListingsBatchAggregateData.__tablename__}',"
+    f"'timestamp',"                                               
+    f"if_not_exists => TRUE);"
+)
+
+enable_sku_listings_batch_aggregate_data_compression_Sql = text(
+    f"ALTER TABLE {SKUListingsBatchAggregateData.__tablename__} SET (timescaledb.compress, timescaledb.compress_segmentby = 'sku_id')"
+)
+
+add_sku_listings_batch_aggregate_data_first_page_fingerprint_sql = text(
+    f"ALTER TABLE {SKUListingsBatchAggregateData.__tablename__} "
+    f"ADD COLUMN IF NOT EXISTS first_page_fingerprint BIGINT"
+)
+
+add_card_sync_data_sales_watermark_sql = text(
+    f"ALTER TABLE {CardSyncData.__tablename__} ADD COLUMN IF NOT EXISTS sales_watermark TIMESTAMP WITHOUT TIME ZONE"
+)
+
+add_card_modified_date_sql = text(
+    f"ALTER TABLE {Card.__tablename__} ADD COLUMN IF NOT EXISTS modified_date TIMESTAMP WITHOUT TIME ZONE"
+)
+
+add_listing_snapshot_partial_status_sql = text(
+    f"ALTER TYPE listingsnapshotstatus ADD VALUE IF NOT EXISTS '{ListingSnapshotStatus.PARTIAL.name}'"
+)
+
+create_sku_listings_batch_aggregate_hourly_sql = text(
+    get_create_rollup_view_sql(sku_listings_batch_aggregate_hourly, '1 hour')
+)
+
+ROLLUP_REFRESH_END_OFFSETS = (
+    (sku_listings_batch_aggregate_hourly, '1 hour'),
+    (sku_listings_batch_aggregate_daily, '1 day'),
+)
+"""end_offset of each rollup's refresh policy, the backfill materializes everything up to the same point"""
+
+create_sku_listings_batch_aggregate_daily_sql = text(
+    get_create_rollup_view_sql(sku_listings_batch_aggregate_daily, '1 day')
+)
+
+
+def migrate(engine: Engine = None):
+    engine = engine if engine is not None else get_engine()
+
+    Base.metadata.create_all(engine)
+
+    with engine.connect() as connection:
+        connection.execute(create_sku_listing_hypertable_sql)
+        connection.execute(create_sku_listings_batch_aggregate_data_hypertable_sql)
+        connection.execute(enable_sku_listings_batch_aggregate_data_compression_Sql)
+        # create_all doesn't add columns to existing tables
+        connection.execute(add_sku_listings_batch_aggregate_data_first_page_fingerprint_sql)
+        connection.execute(add_card_modified_date_sql)
+        connection.execute(add_card_sync_data_sales_watermark_sql)
+        # Nor values to existing enum types
+        connection.execute(add_listing_snapshot_partial_status_sql)
+
+        connection.execute(create_sku_listings_batch_aggregate_hourly_sql)
+        connection.execute(create_sku_listings_batch_aggregate_daily_sql)
+
+        connection.execute(create_card_sales_hypertable_sql)
+
+        connection.execute(text(f"SELECT add_retention_policy('{SKUListing.__tablename__}', INTERVAL '24 hours', if_not_exists => TRUE);"))
+        connection.execute(text(f"SELECT add_retention_policy('{SKUListingsBatchAggregateData.__tablename__}', INTERVAL '30 days', if_not_exists => TRUE);"))
+        connection.execute(text(f"SELECT add_compression_policy('{SKUListingsBatchAggregateData.__tablename__}', INTERVAL '7 days', if_not_exists => TRUE);"))
+
+        # Recent buckets are re-materialized on a schedule so carried forward and late snapshots get rolled up too
+        connection.execute(text(f"SELECT add_continuous_aggregate_policy('{sku_listings_batch_aggregate_hourly.name}', start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '30 minutes', if_not_exists => TRUE);"))
+        connection.execute(text(f"SELECT add_continuous_aggregate_policy('{sku_listings_batch_aggregate_daily.name}', start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 day', schedule_interval => INTERVAL '1 hour', if_not_exists => TRUE);"))
+        # Hourly buckets are only read for the partial day at the start of a window, the daily ones are kept as history
+        connection.execute(text(f"SELECT add_retention_policy('{sku_listings_batch_aggregate_hourly.name}', INTERVAL '35 days', if_not_exists => TRUE);"))
+
+        connection.commit()
+
+    _backfill_rollups(engine)
+
+    logger.info('Migrated the database')
+
+
+def _backfill_rollups(engine: Engine):
+    # The views are created empty and the refresh policies only look 3 days back. Once a policy has run, real-time
+    # aggregation stops covering the raw rows before its watermark, so older history has to be materialized here.
+    # Regions that are already materialized and unchanged are skipped, so running this again is cheap.
+    # Continuous aggregates can't be refreshed in a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for rollup, end_offset in ROLLUP_REFRESH_END_OFFSETS:
+            connection.execute(text(
+                f"CALL refresh_continuous_aggregate('{rollup.name}', NULL, now() - INTERVAL '{end_offset}');"
+            ))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    migrate()
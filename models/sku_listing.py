@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, Boolean, String, Numeric, ForeignKey, DateTime, ForeignKeyConstraint, Index
+from sqlalchemy import Column, Integer, Boolean, String, Numeric, ForeignKey, DateTime, ForeignKeyConstraint, Index, \
+    cast
 from sqlalchemy.orm import relationship, column_property
 
 from models import Base
 from tasks.custom_types import SKUListingResponse
+from utils.money import to_cents, from_cents
 
 
 class SKUListing(Base):
@@ -18,6 +20,13 @@ class SKUListing(Base):
     seller_name = Column(String)
     price = Column(Numeric(precision=10, scale=2))  # Numeric for price
     shipping_price = Column(Numeric(precision=10, scale=2))  # Numeric for shipping_price
+    # Integer cents straight from the database for the analysis code, the Numeric columns are exact to the cent
+    price_cents = column_property(cast(price * 100, Integer))
+    shipping_price_cents = column_property(cast(shipping_price * 100, Integer))
+
+    @property
+    def total_price_cents(self) -> int:
+        return self.price_cents + self.shipping_price_cents
 
     @staticmethod
     def from_tcgplayer_response(response: SKUListingResponse, timestamp):
@@ -29,8 +38,8 @@ class SKUListing(Base):
             gold_seller=response['goldSeller'],
             quantity=response['quantity'],
             seller_name=response['sellerName'],
-            price=response['price'],
-            shipping_price=response['shippingPrice'],
+            price=from_cents(to_cents(response['price'])),
+            shipping_price=from_cents(to_cents(response['shippingPrice'])),
         )
 
 
@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey, Integer, Column, Numeric, DateTime
+from sqlalchemy import ForeignKey, Integer, Column, Numeric, DateTime, BigInteger
 from sqlalchemy.orm import relationship
 
 from models import Base
@@ -13,3 +13,6 @@ class SKUListingsBatchAggregateData(Base):
     lowest_listing_price = Column(Numeric(precision=10, scale=2))  # Numeric for price
     total_listings_count = Column(Integer)
     total_copies_count = Column(Integer)
+    # Hash of the first page of listings of the SKU's product, lets the listing sweep tell if a product changed from
+    # its first page alone
+    first_page_fingerprint = Column(BigInteger)
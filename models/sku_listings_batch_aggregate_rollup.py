@@ -0,0 +1,54 @@
+from sqlalchemy import Table, Column, Integer, Numeric, DateTime, MetaData
+
+from models.sku_listings_batch_aggregate_data import SKUListingsBatchAggregateData
+
+# The rollups are TimescaleDB continuous aggregates created in models/migrate.py, they live on their own metadata so
+# create_all doesn't try to create them as tables
+rollup_metadata = MetaData()
+
+ROLLUP_AGGREGATES = ('first', 'last', 'min', 'max')
+ROLLUP_SOURCE_COLUMNS = {
+    'lowest_listing_price': Numeric(precision=10, scale=2),
+    'total_listings_count': Integer,
+    'total_copies_count': Integer,
+}
+
+
+def _create_rollup_table(name: str) -> Table:
+    return Table(
+        name,
+        rollup_metadata,
+        Column('bucket', DateTime, primary_key=True),
+        Column('sku_id', Integer, primary_key=True),
+        *[
+            Column(f'{aggregate}_{source_column}', column_type)
+            for source_column, column_type in ROLLUP_SOURCE_COLUMNS.items()
+            for aggregate in ROLLUP_AGGREGATES
+        ],
+    )
+
+
+sku_listings_batch_aggregate_hourly = _create_rollup_table(f'{SKUListingsBatchAggregateData.__tablename__}_hourly')
+sku_listings_batch_aggregate_daily = _create_rollup_table(f'{SKUListingsBatchAggregateData.__tablename__}_daily')
+
+
+def get_create_rollup_view_sql(rollup: Table, bucket_width: str) -> str:
+    """CREATE statement of the continuous aggregate backing a rollup table, bucketed every bucket_width"""
+    source_table = SKUListingsBatchAggregateData.__tablename__
+
+    aggregates = ', '.join(
+        f'{aggregate}({source_column}, timestamp) AS {aggregate}_{source_column}'
+        if aggregate in ('first', 'last') else
+        f'{aggregate}({source_column}) AS {aggregate}_{source_column}'
+        for source_column in ROLLUP_SOURCE_COLUMNS
+        for aggregate in ROLLUP_AGGREGATES
+    )
+
+    # WITH NO DATA because materializing can't run in a transaction. models/migrate.py backfills the history outside of
+    # one, the refresh policies keep the recent buckets up to date and real-time aggregation covers the rest
+    return f"CREATE MATERIALIZED VIEW IF NOT EXISTS {rollup.name} " \
+           f"WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS " \
+           f"SELECT time_bucket(INTERVAL '{bucket_width}', timestamp) AS bucket, sku_id, {aggregates} " \
+           f"FROM {source_table} " \
+           f"GROUP BY bucket, sku_id " \
+           f"WITH NO DATA;"
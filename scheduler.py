@@ -1,16 +1,19 @@
-from constants import SYNC_FREQUENCY_INTERVAL_HOURS
+import os
+
 from services.find_profitable_skus import find_profitable_skus
 from tasks import scheduler
-from tasks.fetch_card_listings import fetch_all_near_mint_card_listing_data
+from tasks.tiered_listing_sweep import fetch_due_near_mint_card_listing_data
 from tasks.update_card_database import update_card_database  # Import your task
-from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
+from utils.metrics import start_metrics_server
+from apscheduler.events import EVENT_JOB_EXECUTED
 
 scheduler.add_job(update_card_database, trigger='interval', days=1)  # Schedule to run every day
+# Each tick only fetches the cards whose sync frequency says they're due, see tasks/tiered_listing_sweep.py
 scheduler.add_job(
-    fetch_all_near_mint_card_listing_data,
+    fetch_due_near_mint_card_listing_data,
     id="fetch_all_near_mint_listing",
     trigger='cron',
-    hour=','.join([f'{i * SYNC_FREQUENCY_INTERVAL_HOURS}' for i in range(6)])
+    minute=0,
 )
 
 
@@ -18,12 +21,17 @@ scheduler.add_job(
 # is not rate limited
 
 def job_listener(event):
-    if event.job_id == 'fetch_all_near_mint_listing':
+    # Only the ticks that write a complete snapshot give find_profitable_skus new listings to read
+    if event.job_id == 'fetch_all_near_mint_listing' and event.retval:
         scheduler.add_job(find_profitable_skus)
 
 
-scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED)
 
 if __name__ == "__main__":
+    # Prometheus can scrape the jobs' metrics at http://METRICS_HOST:METRICS_PORT/metrics
+    if os.environ.get('METRICS_PORT'):
+        start_metrics_server(int(os.environ['METRICS_PORT']), os.environ.get('METRICS_HOST', 'localhost'))
+
     scheduler.add_job(update_card_database)
     scheduler.start()
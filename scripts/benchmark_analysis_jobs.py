@@ -0,0 +1,297 @@
+"""
+    Times the stages of the analysis jobs against synthetic markets of several sizes and writes a JSON report, so runs
+    on different commits can be compared. For every scale point the synthetic market is regenerated with
+    scripts/generate_synthetic_market.py, then each stage runs --repeat times:
+
+        find_profitable_skus    query, group, compute and write of get_potentially_profitable_skus, batch by batch on
+                                one thread, then the whole of it with its thread and process pools (pipeline). forecast
+                                is get_copies_sold_per_day_forecasts over every listed SKU, the most a run can forecast.
+        find_potential_pickups  query, group and compute of find_potential_pickups
+        dao                     the rollup and sales queries the other jobs run
+
+    Sales fetches go to TCGplayer and aren't timed. With --baseline, the stages of the scale points both reports have
+    are compared and the ones more than --tolerance slower are listed. Point it at a local TimescaleDB.
+
+    python scripts/benchmark_analysis_jobs.py --cards 1000 10000 50000 --output report.json --baseline previous.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from collections import defaultdict
+from dataclasses import asdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from constants import BATCH_SIZE, COPIES_TIME_DELTA_DAYS, MAX_PROFIT_CUTOFF_CENTS, PROFIT_WORKERS, \
+    SALES_TIME_DELTA_DAYS
+from data.dao import get_latest_listings_for_skus, get_copies_delta_for_skus, get_past_top_listings_by_listings_delta, \
+    get_top_lowest_listing_price_changes_past_3_days, get_sales_counts_since_date, get_sales_for_skus
+from data.order_book_store import BookListing
+from models import db_sessionmaker
+from models.sku_max_profit import SKUMaxProfit
+from scripts.generate_synthetic_market import MarketConfig, generate_market, clear_market, refresh_rollups
+from services.find_profitable_skus import get_copies_sold_per_day_forecasts, get_potentially_profitable_skus
+from services.profit_engine import pack_listings, compute_profitable_skus
+from tasks.find_potential_pickups import compute_top_pickups
+from tasks.utils import ExecutionMode, create_cpu_executor, split_into_segments
+from utils.money import from_cents
+
+TOP_PICKUPS_LIMIT = 20
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+class StageTimer:
+    """Runs stages repeat times each and keeps their timings by name"""
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.stages: Dict[str, dict] = {}
+
+    def run(self, name: str, stage_fn: Callable[[], Any]) -> Any:
+        durations = []
+        result = None
+
+        for _ in range(self.repeat):
+            start_time = time.perf_counter()
+            result = stage_fn()
+            durations.append(time.perf_counter() - start_time)
+
+        self.stages[name] = dict(
+            median_sec=statistics.median(durations),
+            min_sec=min(durations),
+            max_sec=max(durations),
+            rows=len(result) if hasattr(result, '__len__') else None,
+        )
+        print(f'  {name:<52} {self.stages[name]["median_sec"]:8.3f}s')
+
+        return result
+
+
+def benchmark_find_profitable_skus(timer: StageTimer, execution_mode: ExecutionMode):
+    def query():
+        with db_sessionmaker() as db_session:
+            listings = get_latest_listings_for_skus(db_session)
+            sku_ids = sorted({listing.sku_id for listing in listings})
+            batches = [sku_ids[offset:offset + BATCH_SIZE] for offset in range(0, len(sku_ids), BATCH_SIZE)]
+
+            return [
+                (
+                    get_latest_listings_for_skus(db_session, batch),
+                    get_copies_delta_for_skus(db_session, batch, timedelta(days=COPIES_TIME_DELTA_DAYS)),
+                )
+                for batch in batches
+            ]
+
+    batch_rows = timer.run('find_profitable_skus.query', query)
+
+    def group():
+        packed_batches = []
+
+        for listings, copies_deltas in batch_rows:
+            sku_id_to_listings = defaultdict(list)
+            for listing in listings:
+                sku_id_to_listings[listing.sku_id].append(listing)
+
+            quantity_limits = {sku_id: -copies for sku_id, copies in copies_deltas}
+            packed_batches.append(pack_listings(sku_id_to_listings, quantity_limits))
+
+        return packed_batches
+
+    packed_batches = timer.run('find_profitable_skus.group', group)
+
+    records = timer.run('find_profitable_skus.compute', lambda: [
+        record for packed in packed_batches for record in compute_profitable_skus(packed, MAX_PROFIT_CUTOFF_CENTS)
+    ])
+
+    listed_sku_ids = [int(sku_id) for packed in packed_batches for sku_id in packed.sku_ids]
+    sales_start_date = datetime.now(tz=timezone.utc).replace(tzinfo=None) - timedelta(days=SALES_TIME_DELTA_DAYS)
+
+    def query_sales():
+        with db_sessionmaker() as db_session:
+            return get_sales_for_skus(db_session, listed_sku_ids, sales_start_date)
+
+    timer.run('find_profitable_skus.query_sales', query_sales)
+    timer.run('find_profitable_skus.forecast', lambda: get_copies_sold_per_day_forecasts(listed_sku_ids))
+
+    def write():
+        # Like find_profitable_skus, but rolled back
+        with db_sessionmaker() as db_session:
+            db_session.execute(delete(SKUMaxProfit))
+            if records:
+                db_session.execute(insert(SKUMaxProfit).values([
+                    dict(
+                        sku_id=record.sku_id,
+                        max_profit=from_cents(record.max_profit_cents),
+                        num_cards=record.num_cards,
+                        cost=from_cents(record.cost_cents),
+                    )
+                    for record in records
+                ]))
+            db_session.rollback()
+
+        return records
+
+    timer.run('find_profitable_skus.write', write)
+    timer.run('find_profitable_skus.pipeline', lambda: get_potentially_profitable_skus(execution_mode=execution_mode))
+
+
+def benchmark_find_potential_pickups(timer: StageTimer, execution_mode: ExecutionMode):
+    def query():
+        with db_sessionmaker() as db_session:
+            return get_latest_listings_for_skus(db_session)
+
+    listings = timer.run('find_potential_pickups.query', query)
+
+    def group():
+        sku_id_to_listings = defaultdict(list)
+        for listing in listings:
+            sku_id_to_listings[listing.sku_id].append(
+                BookListing(listing.price_cents, listing.shipping_price_cents, listing.quantity)
+            )
+
+        return split_into_segments(list(sku_id_to_listings.items()), PROFIT_WORKERS)
+
+    segments = timer.run('find_potential_pickups.group', group)
+
+    def compute():
+        with create_cpu_executor(execution_mode, PROFIT_WORKERS) as executor:
+            return [
+                pickup
+                for pickups in executor.map(compute_top_pickups, segments, [TOP_PICKUPS_LIMIT] * len(segments))
+                for pickup in pickups
+            ]
+
+    timer.run('find_potential_pickups.compute', compute)
+
+
+def benchmark_dao(timer: StageTimer):
+    def run_query(query_fn: Callable):
+        def stage():
+            with db_sessionmaker() as db_session:
+                return query_fn(db_session)
+
+        return stage
+
+    timer.run('dao.get_past_top_listings_by_listings_delta', run_query(
+        lambda db_session: get_past_top_listings_by_listings_delta(db_session, timedelta(days=7)).all()
+    ))
+    timer.run('dao.get_top_lowest_listing_price_changes_past_3_days', run_query(
+        lambda db_session: db_session.execute(
+            select(func.count()).select_from(get_top_lowest_listing_price_changes_past_3_days(db_session))
+        ).all()
+    ))
+    timer.run('dao.get_sales_counts_since_date', run_query(
+        lambda db_session: get_sales_counts_since_date(db_session, datetime.now() - timedelta(days=7))
+    ))
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Stages slower than in baseline by more than tolerance, at the scale points of both"""
+    baseline_scales = {scale['cards']: scale for scale in baseline['scales']}
+    regressions = []
+
+    for scale in report['scales']:
+        baseline_scale = baseline_scales.get(scale['cards'])
+        if baseline_scale is None:
+            continue
+
+        for name, timing in scale['stages'].items():
+            baseline_timing = baseline_scale['stages'].get(name)
+            if baseline_timing is None or baseline_timing['median_sec'] <= 0:
+                continue
+
+            ratio = timing['median_sec'] / baseline_timing['median_sec']
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f'{scale["cards"]} cards {name}: {baseline_timing["median_sec"]:.3f}s -> '
+                    f'{timing["median_sec"]:.3f}s ({ratio:.2f}x)'
+                )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, nargs='+', default=[1_000, 10_000, 50_000])
+    parser.add_argument('--skus-per-card', type=int, default=5)
+    parser.add_argument('--listing-depth-alpha', type=float, default=1.2)
+    parser.add_argument('--weeks', type=int, default=2)
+    parser.add_argument('--sales-per-day', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--execution-mode', type=ExecutionMode, default=ExecutionMode.PROCESSES)
+    parser.add_argument('--output', default=f'benchmark-analysis-jobs-{get_commit()[:8]}.json')
+    parser.add_argument('--baseline', help='Report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--keep', action='store_true', help="Leave the last synthetic market in the database")
+    args = parser.parse_args()
+
+    report = dict(
+        commit=get_commit(),
+        created_at=datetime.now(tz=timezone.utc).isoformat(),
+        python=platform.python_version(),
+        cpu_count=os.cpu_count(),
+        profit_workers=PROFIT_WORKERS,
+        execution_mode=args.execution_mode.value,
+        repeat=args.repeat,
+        scales=[],
+    )
+
+    try:
+        for cards in args.cards:
+            config = MarketConfig(
+                cards=cards,
+                skus_per_card=args.skus_per_card,
+                listing_depth_alpha=args.listing_depth_alpha,
+                weeks=args.weeks,
+                sales_per_day=args.sales_per_day,
+                seed=args.seed,
+            )
+            market = generate_market(config)
+            print(f'{cards} cards: {market.skus} SKUs, {market.listings} listings, {market.sales} sales')
+
+            timer = StageTimer(args.repeat)
+            benchmark_find_profitable_skus(timer, args.execution_mode)
+            benchmark_find_potential_pickups(timer, args.execution_mode)
+            benchmark_dao(timer)
+
+            report['scales'].append(
+                dict(cards=cards, config=asdict(config), market=asdict(market), stages=timer.stages)
+            )
+    finally:
+        if not args.keep:
+            with db_sessionmaker() as db_session:
+                clear_market(db_session)
+
+            refresh_rollups()
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print(f'Wrote {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_with_baseline(report, json.load(file), args.tolerance)
+
+        if regressions:
+            print('\n'.join(regressions))
+        else:
+            print(f'No stage more than {args.tolerance:.0%} slower than in {args.baseline}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+    Compares the sku_listing ingest throughput (rows/s) of the ORM path, Core executemany and COPY against the database
+    in DATABASE_URI. Point it at a local TimescaleDB with the catalog loaded, the listings are generated for existing
+    SKUs. Every mode writes at its own throwaway timestamp, which is deleted afterward.
+
+    python scripts/benchmark_listing_ingest.py --rows 200000
+"""
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select
+
+from models import db_sessionmaker, SKU
+from models.sku_listing import SKUListing
+from models.sku_listings_batch_aggregate_data import SKUListingsBatchAggregateData
+from tasks.listing_writer import ListingCopyIngester, SKU_LISTING_COPY_COLUMNS, compute_batch_aggregate_data, \
+    to_sku_listing_row
+
+LISTINGS_PER_PRODUCT = 50
+SKUS_PER_PRODUCT = 4
+
+
+def generate_product_responses(sku_ids, num_rows):
+    """
+        Listings of num_rows split into products of LISTINGS_PER_PRODUCT. Like real products, every product has SKUs of
+        its own, so each SKU gets one aggregate row per timestamp.
+    """
+    return [
+        generate_listing_responses(
+            sku_ids[product * SKUS_PER_PRODUCT:(product + 1) * SKUS_PER_PRODUCT],
+            range(offset, min(offset + LISTINGS_PER_PRODUCT, num_rows)),
+        )
+        for product, offset in enumerate(range(0, num_rows, LISTINGS_PER_PRODUCT))
+    ]
+
+
+def generate_listing_responses(sku_ids, listing_ids):
+    return [
+        dict(
+            listingId=listing_id,
+            productConditionId=random.choice(sku_ids),
+            verifiedSeller=random.random() < 0.5,
+            goldSeller=random.random() < 0.2,
+            quantity=random.randint(1, 8),
+            sellerName=f'seller {random.randint(0, 5000)}',
+            sellerShippingPrice=0.99,
+            price=round(random.uniform(0.1, 200), 2),
+            shippingPrice=0.99,
+        )
+        for listing_id in listing_ids
+    ]
+
+
+def ingest_orm(session, products, timestamp):
+    for product_responses in products:
+        session.add_all(
+            SKUListingsBatchAggregateData(**row) for row in compute_batch_aggregate_data(product_responses, timestamp)
+        )
+        session.commit()
+        session.add_all(SKUListing.from_tcgplayer_response(response, timestamp) for response in product_responses)
+
+    session.commit()
+
+
+def ingest_executemany(session, products, timestamp):
+    aggregate_rows = []
+    for product_responses in products:
+        aggregate_rows += compute_batch_aggregate_data(product_responses, timestamp)
+
+    session.execute(insert(SKUListingsBatchAggregateData), aggregate_rows)
+    session.execute(
+        insert(SKUListing),
+        [
+            dict(zip(SKU_LISTING_COPY_COLUMNS, to_sku_listing_row(response, timestamp)))
+            for product_responses in products
+            for response in product_responses
+        ],
+    )
+    session.commit()
+
+
+def ingest_copy(session, products, timestamp):
+    ingester = ListingCopyIngester(session, timestamp)
+
+    for product_responses in products:
+        ingester.add(product_responses)
+
+    ingester.flush()
+
+
+def cleanup(session, timestamp):
+    session.execute(delete(SKUListing).where(SKUListing.timestamp == timestamp))
+    session.execute(delete(SKUListingsBatchAggregateData).where(SKUListingsBatchAggregateData.timestamp == timestamp))
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--modes', nargs='+', default=['orm', 'executemany', 'copy'])
+    args = parser.parse_args()
+
+    session = db_sessionmaker()
+    # Ordered by card, so the SKUs of a product mostly belong to the same card
+    num_skus = math.ceil(args.rows / LISTINGS_PER_PRODUCT) * SKUS_PER_PRODUCT
+    sku_ids = session.scalars(select(SKU.id).order_by(SKU.card_id, SKU.id).limit(num_skus)).all()
+    if len(sku_ids) < num_skus:
+        raise SystemExit(f'{args.rows} rows need {num_skus} SKUs and the database has {len(sku_ids)}, run '
+                         f'update_card_database first or pass fewer --rows')
+
+    products = generate_product_responses(sku_ids, args.rows)
+    ingest_fns = dict(orm=ingest_orm, executemany=ingest_executemany, copy=ingest_copy)
+
+    # Timestamps in the future so they can't collide with a real sweep
+    base_timestamp = datetime.utcnow() + timedelta(days=1)
+
+    for index, mode in enumerate(args.modes):
+        timestamp = base_timestamp + timedelta(minutes=index)
+
+        start_time = time.perf_counter()
+        ingest_fns[mode](session, products, timestamp)
+        elapsed = time.perf_counter() - start_time
+
+        cleanup(session, timestamp)
+
+        print(f'{mode:>12}: {args.rows} rows in {elapsed:.2f}s ({args.rows / elapsed:,.0f} rows/s)')
+
+
+if __name__ == "__main__":
+    main()
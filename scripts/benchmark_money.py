@@ -0,0 +1,118 @@
+"""
+    Per-SKU time of compute_profit_from_listings with integer cents against the Decimal arithmetic it used before, on
+    synthetic listings. The Decimal version is kept here as it was, listings carry both representations so both loops
+    see the same data.
+
+    python scripts/benchmark_money.py --skus 20000
+"""
+import argparse
+import random
+import time
+from decimal import Decimal
+from typing import NamedTuple
+
+from services.find_profitable_skus import compute_max_profit_for_listings
+from utils.money import from_cents
+
+DECIMAL_TAX = Decimal(0.10)
+DECIMAL_SELLER_COST = Decimal(0.85)
+
+
+class SyntheticListing(NamedTuple):
+    price: Decimal
+    shipping_price: Decimal
+    price_cents: int
+    shipping_price_cents: int
+    quantity: int
+
+
+def compute_profit_from_listings_decimal(listings, quantity_limit: int):
+    max_profit, max_profit_num_cards, max_profit_cost = Decimal(0.0), 0, Decimal(0.0)
+    running_cost = Decimal(0.0)
+    running_quantity = 0
+
+    if quantity_limit <= 0:
+        return max_profit, max_profit_num_cards, max_profit_cost
+
+    for i in range(len(listings) - 1):
+        listing = listings[i]
+
+        num_cards_to_buy_from_listing = min(quantity_limit - running_quantity, listing.quantity)
+
+        running_cost += listing.price * num_cards_to_buy_from_listing + listing.shipping_price
+        running_quantity += num_cards_to_buy_from_listing
+
+        next_listing = listings[i + 1]
+        shipping_cost = 4 if next_listing.price >= 40 else 0
+
+        revenue = (Decimal(next_listing.price) - shipping_cost) * running_quantity * DECIMAL_SELLER_COST
+
+        total_cost = running_cost * (1 + DECIMAL_TAX)
+
+        profit = (revenue - total_cost)
+        if profit > max_profit:
+            max_profit, max_profit_num_cards, max_profit_cost = profit, running_quantity, running_cost
+
+        if running_quantity == quantity_limit:
+            break
+
+    return max_profit, max_profit_num_cards, max_profit_cost
+
+
+def compute_max_profit_for_listings_decimal(listings, purchase_copies_limit: int):
+    return compute_profit_from_listings_decimal(
+        sorted(listings, key=lambda x: x.price + x.shipping_price),
+        purchase_copies_limit,
+    )
+
+
+def generate_listings(num_skus: int):
+    sku_listings = []
+
+    for _ in range(num_skus):
+        sku_price_cents = random.lognormvariate(6.2, 1.2)
+        listings = []
+
+        for _ in range(random.randint(1, 30)):
+            price_cents = max(1, round(sku_price_cents * random.uniform(0.7, 1.3)))
+            shipping_price_cents = random.choice([0, 99, 131])
+            listings.append(SyntheticListing(
+                from_cents(price_cents), from_cents(shipping_price_cents), price_cents, shipping_price_cents,
+                random.randint(1, 4),
+            ))
+
+        sku_listings.append((listings, random.randint(0, 20)))
+
+    return sku_listings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skus', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sku_listings = generate_listings(args.skus)
+
+    start_time = time.perf_counter()
+    decimal_results = [compute_max_profit_for_listings_decimal(listings, limit) for listings, limit in sku_listings]
+    decimal_sec = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    cents_results = [compute_max_profit_for_listings(listings, limit) for listings, limit in sku_listings]
+    cents_sec = time.perf_counter() - start_time
+
+    # Cents round every step to the cent, so the profits can differ from the unrounded Decimal ones by a cent or so
+    max_difference_cents = max([
+        abs(from_cents(cents.max_profit_cents) - decimal[0]) * 100
+        for decimal, cents in zip(decimal_results, cents_results)
+    ], default=0)
+
+    print(f'Decimal: {decimal_sec / args.skus * 1e6:.1f}us per SKU')
+    print(f'  cents: {cents_sec / args.skus * 1e6:.1f}us per SKU ({decimal_sec / cents_sec:.1f}x)')
+    print(f'Largest profit difference: {max_difference_cents:.2f} cents')
+
+
+if __name__ == "__main__":
+    main()
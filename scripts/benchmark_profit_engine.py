@@ -0,0 +1,117 @@
+"""
+    Compares the vectorized profit engine against running compute_max_profit_for_listings on every SKU, on synthetic
+    listings. The engine runs on every SKU, the per-SKU loop on a sample of them (it would take minutes at 1M SKUs) and
+    its time is extrapolated. The results of the sample are checked to match exactly.
+
+    python scripts/benchmark_profit_engine.py --skus 10000 100000 1000000
+"""
+import argparse
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from services.find_profitable_skus import compute_max_profit_for_listings, ProfitData
+from services.profit_engine import PackedListings, compute_max_profits, pack_listings
+
+REFERENCE_SAMPLE_SKUS = 10_000
+MAX_LISTINGS_PER_SKU = 30
+
+
+class SyntheticListing(NamedTuple):
+    price_cents: int
+    shipping_price_cents: int
+    quantity: int
+
+
+def generate_packed_listings(num_skus: int, rng: np.random.Generator) -> PackedListings:
+    counts = rng.integers(1, MAX_LISTINGS_PER_SKU + 1, size=num_skus)
+    offsets = np.zeros(num_skus + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    num_listings = int(offsets[-1])
+
+    segment_ids = np.repeat(np.arange(num_skus), counts)
+    # Log-normal SKU prices around a few dollars, listings spread +-30% around their SKU's price
+    sku_price_cents = np.exp(rng.normal(np.log(500), 1.2, size=num_skus))
+    price_cents = np.maximum(1, np.rint(sku_price_cents[segment_ids] * rng.uniform(0.7, 1.3, num_listings)))
+    price_cents = price_cents.astype(np.int64)
+    shipping_cents = rng.choice(np.array([0, 99, 131], dtype=np.int64), size=num_listings)
+    quantity = rng.integers(1, 5, size=num_listings)
+
+    order = np.lexsort((price_cents + shipping_cents, segment_ids))
+
+    return PackedListings(
+        sku_ids=np.arange(num_skus, dtype=np.int64),
+        offsets=offsets,
+        price_cents=price_cents[order],
+        shipping_cents=shipping_cents[order],
+        quantity=quantity[order],
+        quantity_limits=rng.integers(0, 20, size=num_skus),
+    )
+
+
+def unpack_listings(packed: PackedListings, num_skus: int):
+    sku_id_to_listings = {}
+
+    for index in range(num_skus):
+        start, end = packed.offsets[index], packed.offsets[index + 1]
+        sku_id_to_listings[int(packed.sku_ids[index])] = [
+            SyntheticListing(int(price), int(shipping), int(quantity))
+            for price, shipping, quantity in zip(
+                packed.price_cents[start:end], packed.shipping_cents[start:end], packed.quantity[start:end]
+            )
+        ]
+
+    return sku_id_to_listings
+
+
+def benchmark(num_skus: int, rng: np.random.Generator):
+    packed = generate_packed_listings(num_skus, rng)
+
+    start_time = time.perf_counter()
+    profits = compute_max_profits(packed)
+    engine_sec = time.perf_counter() - start_time
+
+    sample_size = min(num_skus, REFERENCE_SAMPLE_SKUS)
+    sku_id_to_listings = unpack_listings(packed, sample_size)
+    sku_id_to_limit = {int(packed.sku_ids[index]): int(packed.quantity_limits[index]) for index in range(sample_size)}
+
+    start_time = time.perf_counter()
+    pack_listings(sku_id_to_listings, sku_id_to_limit)
+    pack_sec = (time.perf_counter() - start_time) * num_skus / sample_size
+
+    start_time = time.perf_counter()
+    reference = [
+        compute_max_profit_for_listings(sku_id_to_listings[sku_id], sku_id_to_limit[sku_id])
+        for sku_id in sku_id_to_listings
+    ]
+    reference_sec = (time.perf_counter() - start_time) * num_skus / sample_size
+
+    mismatches = sum(
+        profit_data != ProfitData(
+            int(profits.max_profit_cents[index]), int(profits.num_cards[index]), int(profits.cost_cents[index])
+        )
+        for index, profit_data in enumerate(reference)
+    )
+
+    print(
+        f'{num_skus:>9} SKUs, {len(packed.quantity):>10} listings: engine {engine_sec:.2f}s, packing ~{pack_sec:.2f}s, '
+        f'per-SKU loop ~{reference_sec:.2f}s ({reference_sec / engine_sec:.0f}x), '
+        f'{mismatches} mismatches in {sample_size} sampled SKUs'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skus', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+
+    for num_skus in args.skus:
+        benchmark(num_skus, rng)
+
+
+if __name__ == "__main__":
+    main()
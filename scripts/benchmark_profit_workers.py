@@ -0,0 +1,86 @@
+"""
+    Scaling of the profit stage of get_potentially_profitable_skus over worker counts, on synthetic packed listings
+    split in BATCH_SIZE batches like the job splits them. Every run sends the same batches through
+    compute_profitable_skus, the time includes pickling the batches to the workers and the records back. Threads are
+    run too, as the baseline the process pool replaces.
+
+    python scripts/benchmark_profit_workers.py --skus 1000000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import as_completed
+from typing import List
+
+import numpy as np
+
+from constants import BATCH_SIZE, MAX_PROFIT_CUTOFF_CENTS
+from scripts.benchmark_profit_engine import generate_packed_listings
+from services.profit_engine import PackedListings, compute_profitable_skus, ProfitRecord
+from tasks.utils import ExecutionMode, create_cpu_executor
+
+
+def split_into_batches(packed: PackedListings, batch_size: int) -> List[PackedListings]:
+    batches = []
+
+    for start in range(0, len(packed), batch_size):
+        end = min(start + batch_size, len(packed))
+        listing_start, listing_end = packed.offsets[start], packed.offsets[end]
+
+        batches.append(PackedListings(
+            sku_ids=packed.sku_ids[start:end],
+            offsets=packed.offsets[start:end + 1] - listing_start,
+            price_cents=packed.price_cents[listing_start:listing_end],
+            shipping_cents=packed.shipping_cents[listing_start:listing_end],
+            quantity=packed.quantity[listing_start:listing_end],
+            quantity_limits=packed.quantity_limits[start:end],
+        ))
+
+    return batches
+
+
+def run(batches: List[PackedListings], execution_mode: ExecutionMode, num_workers: int):
+    records: List[ProfitRecord] = []
+
+    start_time = time.perf_counter()
+
+    with create_cpu_executor(execution_mode, num_workers) as executor:
+        futures = [executor.submit(compute_profitable_skus, batch, MAX_PROFIT_CUTOFF_CENTS) for batch in batches]
+
+        for future in as_completed(futures):
+            records += future.result()
+
+    return time.perf_counter() - start_time, sorted(records)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skus', type=int, default=1_000_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cpu_count = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({2 ** power for power in range(cpu_count.bit_length())} | {cpu_count})
+
+    batches = split_into_batches(generate_packed_listings(args.skus, np.random.default_rng(args.seed)), BATCH_SIZE)
+    print(f'{args.skus} SKUs in {len(batches)} batches, {cpu_count} cores')
+
+    baseline_sec, reference = None, None
+
+    for execution_mode in (ExecutionMode.THREADS, ExecutionMode.PROCESSES):
+        for num_workers in worker_counts:
+            elapsed_sec, records = run(batches, execution_mode, num_workers)
+
+            if reference is None:
+                baseline_sec, reference = elapsed_sec, records
+
+            print(
+                f'{execution_mode.value:>9} x {num_workers:>3}: {elapsed_sec:.2f}s, '
+                f'{args.skus / elapsed_sec / 1e6:.2f}M SKUs/s, {baseline_sec / elapsed_sec:.1f}x the single thread, '
+                f'{len(records)} profitable SKUs{"" if records == reference else ", RESULTS DIFFER"}'
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+    Compares the batched damped Holt forecaster against fitting statsmodels' Holt(damped_trend=True) on every series,
+    like determine_num_copies_sold_per_day did, on synthetic Poisson sales with a drifting rate. statsmodels runs on a
+    sample of the series and its time is extrapolated. Degenerate forecasts are the ones that are ~0 (< 1e-3) for a
+    series that sold copies in its last day.
+
+    python scripts/benchmark_sales_forecaster.py --skus 1000 10000 100000
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+from statsmodels.tsa.holtwinters import Holt
+
+from constants import SALES_TIME_DELTA_DAYS, SYNC_FREQUENCY_INTERVAL_HOURS
+from services.sales_forecaster import forecast_sales
+
+REFERENCE_SAMPLE_SKUS = 200
+HORIZON = 24 // SYNC_FREQUENCY_INTERVAL_HOURS
+NUM_BUCKETS = SALES_TIME_DELTA_DAYS * 24 // SYNC_FREQUENCY_INTERVAL_HOURS
+
+
+def generate_sales(num_skus: int, rng: np.random.Generator) -> np.ndarray:
+    # Most SKUs sell a copy every few days, a few sell several per bucket
+    rates = np.exp(rng.normal(-2, 1.5, size=num_skus))
+    drift = np.exp(rng.normal(0, 0.5, size=num_skus))[:, np.newaxis] ** np.linspace(-1, 1, NUM_BUCKETS)
+
+    return rng.poisson(rates[:, np.newaxis] * drift).astype(np.float64)
+
+
+def forecast_with_statsmodels(row: np.ndarray) -> float:
+    # 'estimated' is what Holt defaulted to when determine_num_copies_sold_per_day was written
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model = Holt(row, damped_trend=True, initialization_method='estimated').fit()
+
+        return sum(model.forecast(steps=HORIZON))
+
+
+def count_degenerate(series: np.ndarray, forecasts: np.ndarray) -> int:
+    return int(np.count_nonzero((forecasts < 1e-3) & (series[:, -HORIZON:].sum(axis=1) > 0)))
+
+
+def benchmark(num_skus: int, rng: np.random.Generator):
+    series = generate_sales(num_skus, rng)
+
+    start_time = time.perf_counter()
+    forecasts = forecast_sales(series, HORIZON)
+    batched_sec = time.perf_counter() - start_time
+
+    sample = series[:min(num_skus, REFERENCE_SAMPLE_SKUS)]
+
+    start_time = time.perf_counter()
+    reference = np.array([forecast_with_statsmodels(row) for row in sample])
+    reference_sec = (time.perf_counter() - start_time) * num_skus / len(sample)
+
+    print(
+        f'{num_skus:>7} SKUs: batched {batched_sec:.2f}s, statsmodels ~{reference_sec:.2f}s '
+        f'({reference_sec / batched_sec:.0f}x), degenerate forecasts in the {len(sample)} sampled SKUs: '
+        f'{count_degenerate(sample, forecasts[:len(sample)])} batched, '
+        f'{count_degenerate(sample, reference)} statsmodels'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--skus', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+
+    for num_skus in args.skus:
+        benchmark(num_skus, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""
+    Local stand-in for the TCGplayer endpoints the jobs call, serving seeded synthetic data so the fetch pipeline can
+    run end-to-end, and be benchmarked repeatably, without touching production:
+
+        api.tcgplayer.com      POST /token, GET /catalog/categories/2/{printings,conditions,rarities,groups},
+                               GET /catalog/products
+        mp-search-api          POST /v1/product/{id}/listings
+        mpapi                  POST /v2/product/{id}/latestsales
+
+    Every response waits out a log-normal latency. Each route group (catalog, listings, sales) can also fail a share of
+    requests with a 503, throttle everything with 429 bursts on a schedule, or hold a requests-per-second limit, all
+    429s carrying a Retry-After. The same seed always serves the same catalog, listings and sales.
+
+    python scripts/fake_tcgplayer_server.py --sets 20 --cards-per-set 100 --latency-median-ms 80 --error-rate 0.01 \\
+        --listings-throttle-every-sec 60 --listings-throttle-burst-sec 5
+
+    and point the jobs at it with
+
+    export TCGPLAYER_BASE_URL=http://localhost:8787 TCGPLAYER_LISTINGS_API_URL=http://localhost:8787 \\
+        TCGPLAYER_SALES_API_URL=http://localhost:8787
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+PRINTINGS = [(1, '1st Edition'), (2, 'Unlimited'), (3, 'Limited')]
+CONDITIONS = [
+    (1, 'Near Mint', 'NM'),
+    (2, 'Lightly Played', 'LP'),
+    (3, 'Moderately Played', 'MP'),
+    (4, 'Heavily Played', 'HP'),
+    (5, 'Damaged', 'DMG'),
+]
+RARITIES = ['Common', 'Rare', 'Super Rare', 'Ultra Rare', 'Secret Rare']
+CONDITION_PRICE_FACTORS = {1: 1.0, 2: 0.85, 3: 0.7, 4: 0.5, 5: 0.35}
+SHIPPING_PRICES = [0.0, 0.99, 1.31]
+MAX_LISTINGS_PER_SKU = 2000
+LISTINGS_CACHE_PRODUCTS = 50_000
+STATS_LOG_INTERVAL_SEC = 10
+
+
+@dataclass
+class RouteBehaviour:
+    latency_median_ms: float
+    latency_sigma: float
+    error_rate: float
+    throttle_every_sec: float
+    throttle_burst_sec: float
+    retry_after_sec: float
+    max_requests_per_sec: Optional[float]
+
+
+class FaultInjector:
+    """Latency, 5xx, 429 bursts and a requests-per-second limit of one route group"""
+
+    def __init__(self, behaviour: RouteBehaviour, rng: random.Random):
+        self.behaviour = behaviour
+        self.rng = rng
+        self.start_time = time.monotonic()
+        self._tokens = behaviour.max_requests_per_sec or 0.0
+        self._tokens_time = self.start_time
+
+    def _in_throttle_burst(self, now: float) -> bool:
+        if self.behaviour.throttle_every_sec <= 0:
+            return False
+
+        return (now - self.start_time) % self.behaviour.throttle_every_sec < self.behaviour.throttle_burst_sec
+
+    def _take_token(self, now: float) -> bool:
+        max_requests_per_sec = self.behaviour.max_requests_per_sec
+        if max_requests_per_sec is None:
+            return True
+
+        self._tokens = min(max_requests_per_sec, self._tokens + (now - self._tokens_time) * max_requests_per_sec)
+        self._tokens_time = now
+
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    async def apply(self) -> Optional[web.Response]:
+        """Waits out the latency, then returns the error response to send instead of the real one, if any"""
+        if self.behaviour.latency_median_ms > 0:
+            latency_ms = self.rng.lognormvariate(
+                math.log(self.behaviour.latency_median_ms), self.behaviour.latency_sigma
+            )
+            await asyncio.sleep(latency_ms / 1000)
+
+        now = time.monotonic()
+        retry_after = {'Retry-After': str(self.behaviour.retry_after_sec)}
+
+        if self._in_throttle_burst(now) or not self._take_token(now):
+            return web.json_response({'errors': ['Too Many Requests']}, status=429, headers=retry_after)
+
+        if self.rng.random() < self.behaviour.error_rate:
+            return web.json_response({'errors': ['Service Unavailable']}, status=503)
+
+        return None
+
+
+def format_order_date(order_date: datetime) -> str:
+    return order_date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+00:00'
+
+
+class FakeMarket:
+    """
+        The synthetic catalog, built up front, and the listings and sales of every SKU, generated on demand from a
+        seed derived from the SKU so they're the same on every request and every run.
+    """
+
+    def __init__(self, seed: int, num_sets: int, cards_per_set: int, listing_depth_alpha: float, sales_per_day: float,
+                 sales_days: int):
+        self.seed = seed
+        self.listing_depth_alpha = listing_depth_alpha
+        self.sales_per_day = sales_per_day
+        # Sales run from sales_days back until a day after the start, only the ones in the past are served
+        self.sales_start = datetime.now(tz=timezone.utc) - timedelta(days=sales_days)
+        self.sales_end = datetime.now(tz=timezone.utc) + timedelta(days=1)
+
+        rng = random.Random(seed)
+        self.sets: List[dict] = []
+        self.products: List[dict] = []
+        self.products_by_set: Dict[int, List[dict]] = {}
+        self.products_by_id: Dict[int, dict] = {}
+
+        for set_index in range(num_sets):
+            group_id = 1000 + set_index
+            published_on = datetime(2002, 3, 8) + timedelta(days=set_index * 90)
+
+            self.sets.append({
+                'groupId': group_id,
+                'name': f'Synthetic Set {set_index}',
+                'abbreviation': f'SYN{set_index}',
+                'isSupplemental': False,
+                'publishedOn': published_on.strftime('%Y-%m-%dT%H:%M:%S'),
+                'modifiedOn': (published_on + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-4],
+                'categoryId': 2,
+            })
+
+            set_products = []
+            for card_index in range(cards_per_set):
+                product_id = group_id * 10_000 + card_index
+                printing_ids = sorted(rng.sample([printing_id for printing_id, _ in PRINTINGS], rng.randint(1, 2)))
+
+                product = {
+                    'productId': product_id,
+                    'name': f'Synthetic Card {set_index}-{card_index}',
+                    'cleanName': f'Synthetic Card {set_index} {card_index}',
+                    'imageUrl': f'https://example.com/{product_id}.jpg',
+                    'categoryId': 2,
+                    'groupId': group_id,
+                    'url': f'https://example.com/product/{product_id}',
+                    'modifiedOn': (published_on + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-4],
+                    'imageCount': 1,
+                    'presaleInfo': {'isPresale': False, 'releasedOn': None, 'note': None},
+                    'extendedData': [
+                        {'name': 'Number', 'value': f'SYN{set_index}-EN{card_index:03d}'},
+                        {'name': 'Rarity', 'value': rng.choice(RARITIES)},
+                        {'name': 'Card Type', 'value': 'Normal Monster'},
+                        {'name': 'Attack', 'value': str(rng.randrange(0, 3100, 100))},
+                        {'name': 'Defense', 'value': str(rng.randrange(0, 3100, 100))},
+                    ],
+                    'skus': [
+                        {
+                            'skuId': product_id * 100 + printing_id * 10 + condition_id,
+                            'productId': product_id,
+                            'languageId': 1,
+                            'printingId': printing_id,
+                            'conditionId': condition_id,
+                        }
+                        for printing_id in printing_ids
+                        for condition_id, _, _ in CONDITIONS
+                    ],
+                    # Log-normal prices around a few dollars, a few cards are worth a lot more
+                    '_price': round(math.exp(rng.gauss(math.log(2), 1.3)), 2),
+                }
+
+                set_products.append(product)
+                self.products_by_id[product_id] = product
+
+            self.products_by_set[group_id] = set_products
+            self.products.extend(set_products)
+
+        self.listings = lru_cache(maxsize=LISTINGS_CACHE_PRODUCTS)(self._generate_listings)
+        self.sales = lru_cache(maxsize=LISTINGS_CACHE_PRODUCTS)(self._generate_sales)
+
+    @staticmethod
+    def _matches(values: List, id_and_name: tuple) -> bool:
+        # The jobs send names or ids depending on the endpoint, an empty filter matches everything
+        return not values or any(str(value) in (str(id_and_name[0]), id_and_name[1]) for value in values)
+
+    def _generate_listings(self, product_id: int) -> List[dict]:
+        product = self.products_by_id[product_id]
+        listings = []
+
+        for sku in product['skus']:
+            rng = random.Random(self.seed * 1_000_003 + sku['skuId'])
+            sku_price = product['_price'] * CONDITION_PRICE_FACTORS[sku['conditionId']]
+            # Power-law book depth, most SKUs have a handful of listings and a few have hundreds
+            num_listings = min(MAX_LISTINGS_PER_SKU, int(rng.paretovariate(self.listing_depth_alpha)))
+
+            for listing_index in range(num_listings):
+                listings.append({
+                    'listingId': sku['skuId'] * 10_000 + listing_index,
+                    'productConditionId': sku['skuId'],
+                    'printing': dict(PRINTINGS)[sku['printingId']],
+                    'condition': CONDITIONS[sku['conditionId'] - 1][1],
+                    'verifiedSeller': rng.random() < 0.5,
+                    'goldSeller': rng.random() < 0.2,
+                    'quantity': float(rng.choice([1, 1, 1, 2, 3, 4])),
+                    'sellerName': f'seller{rng.randrange(5000)}',
+                    'sellerShippingPrice': 0.0,
+                    'price': round(max(0.01, sku_price * rng.uniform(0.8, 1.6)), 2),
+                    'shippingPrice': rng.choice(SHIPPING_PRICES),
+                    'listingType': 'standard',
+                    'language': 'English',
+                })
+
+        return sorted(listings, key=lambda listing: (listing['price'] + listing['shippingPrice'], listing['listingId']))
+
+    def _generate_sales(self, product_id: int) -> List[dict]:
+        product = self.products_by_id[product_id]
+        sales = []
+
+        for sku in product['skus']:
+            rng = random.Random(self.seed * 2_000_003 + sku['skuId'])
+            rate_per_sec = self.sales_per_day * rng.lognormvariate(0, 1) / 86400
+            sku_price = product['_price'] * CONDITION_PRICE_FACTORS[sku['conditionId']]
+            order_date = self.sales_start
+
+            # A Poisson process of sales over the whole window
+            while True:
+                order_date += timedelta(seconds=rng.expovariate(rate_per_sec))
+                if order_date >= self.sales_end:
+                    break
+
+                sales.append({
+                    'condition': CONDITIONS[sku['conditionId'] - 1][1],
+                    'variant': dict(PRINTINGS)[sku['printingId']],
+                    'language': 'English',
+                    'quantity': rng.choice([1, 1, 1, 2, 3]),
+                    'title': product['name'],
+                    'listingType': 'ListingWithoutPhotos',
+                    'customListingId': '',
+                    'purchasePrice': round(max(0.01, sku_price * rng.uniform(0.8, 1.3)), 2),
+                    'shippingPrice': rng.choice(SHIPPING_PRICES),
+                    'orderDate': format_order_date(order_date),
+                    '_order_date': order_date,
+                })
+
+        return sorted(sales, key=lambda sale: sale['_order_date'], reverse=True)
+
+    def _matches_variant(self, printings: List, conditions: List, printing_name: str, condition_name: str) -> bool:
+        printing = next(printing for printing in PRINTINGS if printing[1] == printing_name)
+        condition = next(condition[:2] for condition in CONDITIONS if condition[1] == condition_name)
+
+        return self._matches(printings, printing) and self._matches(conditions, condition)
+
+    def get_listings(self, product_id: int, printings: List, conditions: List) -> List[dict]:
+        return [
+            listing for listing in self.listings(product_id)
+            if self._matches_variant(printings, conditions, listing['printing'], listing['condition'])
+        ]
+
+    def get_sales(self, product_id: int, printings: List, conditions: List) -> List[dict]:
+        now = datetime.now(tz=timezone.utc)
+
+        return [
+            sale for sale in self.sales(product_id)
+            if sale['_order_date'] <= now
+            and self._matches_variant(printings, conditions, sale['variant'], sale['condition'])
+        ]
+
+
+def catalog_response(results: List[dict], total_items: Optional[int] = None) -> web.Response:
+    body = {'success': True, 'errors': [], 'results': results}
+    if total_items is not None:
+        body['totalItems'] = total_items
+
+    return web.json_response(body)
+
+
+def public(record: dict) -> dict:
+    return {key: value for key, value in record.items() if not key.startswith('_')}
+
+
+def format_stats(request_stats: Counter) -> Dict[str, int]:
+    return {f'{group} {status}': count for (group, status), count in sorted(request_stats.items())}
+
+
+def create_app(market: FakeMarket, fault_injectors: Dict[str, FaultInjector]) -> web.Application:
+    request_stats: Counter = Counter()
+    routes = web.RouteTableDef()
+
+    def route_group(path: str) -> str:
+        if path.endswith('/listings'):
+            return 'listings'
+        if path.endswith('/latestsales'):
+            return 'sales'
+        return 'catalog'
+
+    @web.middleware
+    async def inject_faults(request: web.Request, handler):
+        group = route_group(request.path)
+        response = await fault_injectors[group].apply() or await handler(request)
+        request_stats[(group, response.status)] += 1
+
+        return response
+
+    @routes.post('/token')
+    async def token(_: web.Request):
+        expires = datetime.now(tz=timezone.utc) + timedelta(days=14)
+
+        return web.json_response({
+            'access_token': 'fake-access-token',
+            'token_type': 'bearer',
+            'expires_in': 14 * 86400 - 1,
+            '.issued': format_datetime(datetime.now(tz=timezone.utc), usegmt=True),
+            '.expires': format_datetime(expires, usegmt=True),
+        })
+
+    @routes.get('/catalog/categories/{category_id}/printings')
+    async def printings(_: web.Request):
+        return catalog_response([
+            {'printingId': printing_id, 'name': name, 'displayOrder': printing_id, 'modifiedOn': '2020-01-01T00:00:00'}
+            for printing_id, name in PRINTINGS
+        ])
+
+    @routes.get('/catalog/categories/{category_id}/conditions')
+    async def conditions(_: web.Request):
+        return catalog_response([
+            {'conditionId': condition_id, 'name': name, 'abbreviation': abbreviation, 'displayOrder': condition_id}
+            for condition_id, name, abbreviation in CONDITIONS
+        ])
+
+    @routes.get('/catalog/categories/{category_id}/rarities')
+    async def rarities(_: web.Request):
+        return catalog_response([
+            {'rarityId': index + 1, 'displayText': rarity, 'dbValue': rarity} for index, rarity in enumerate(RARITIES)
+        ])
+
+    @routes.get('/catalog/categories/{category_id}/groups')
+    async def groups(request: web.Request):
+        offset, limit = int(request.query.get('offset', 0)), int(request.query.get('limit', 10))
+
+        return catalog_response(market.sets[offset:offset + limit], len(market.sets))
+
+    @routes.get('/catalog/products')
+    async def products(request: web.Request):
+        offset, limit = int(request.query.get('offset', 0)), int(request.query.get('limit', 10))
+        group_id = request.query.get('groupId')
+        set_products = market.products_by_set.get(int(group_id), []) if group_id else market.products
+
+        return catalog_response([public(product) for product in set_products[offset:offset + limit]], len(set_products))
+
+    @routes.post('/v1/product/{product_id}/listings')
+    async def listings(request: web.Request):
+        product_id = int(request.match_info['product_id'])
+        if product_id not in market.products_by_id:
+            return web.json_response({'errors': ['Not Found']}, status=404)
+
+        payload = await request.json()
+        term = payload.get('filters', {}).get('term', {})
+        offset, size = payload.get('from', 0), payload.get('size', 10)
+        product_listings = market.get_listings(product_id, term.get('printing', []), term.get('condition', []))
+
+        return web.json_response({
+            'errors': [],
+            'results': [{
+                'totalResults': len(product_listings),
+                'resultId': '',
+                'aggregations': {},
+                'results': product_listings[offset:offset + size],
+            }],
+        })
+
+    @routes.post('/v2/product/{product_id}/latestsales')
+    async def latest_sales(request: web.Request):
+        product_id = int(request.match_info['product_id'])
+        if product_id not in market.products_by_id:
+            return web.json_response({'errors': ['Not Found']}, status=404)
+
+        payload = await request.json()
+        offset, limit = payload.get('offset', 0), min(payload.get('limit', 25), 25)
+        product_sales = market.get_sales(product_id, payload.get('variants', []), payload.get('conditions', []))
+        page = product_sales[offset:offset + limit]
+
+        return web.json_response({
+            'previousPage': 'Yes' if offset > 0 else '',
+            'nextPage': 'Yes' if offset + limit < len(product_sales) else '',
+            'resultCount': len(page),
+            'totalResults': len(product_sales),
+            'data': [public(sale) for sale in page],
+        })
+
+    @routes.get('/stats')
+    async def stats(_: web.Request):
+        return web.json_response(format_stats(request_stats))
+
+    async def log_stats(_: web.Application):
+        async def log_periodically():
+            previous_total = 0
+            while True:
+                await asyncio.sleep(STATS_LOG_INTERVAL_SEC)
+
+                total = sum(request_stats.values())
+                logger.info(
+                    f'{(total - previous_total) / STATS_LOG_INTERVAL_SEC:.0f} requests/s, '
+                    f'{format_stats(request_stats)}'
+                )
+                previous_total = total
+
+        task = asyncio.create_task(log_periodically())
+        yield
+        task.cancel()
+
+    app = web.Application(middlewares=[inject_faults])
+    app.add_routes(routes)
+    app.cleanup_ctx.append(log_stats)
+
+    return app
+
+
+def get_route_behaviour(args, group: str) -> RouteBehaviour:
+    def arg(name: str):
+        group_value = getattr(args, f'{group}_{name}')
+        return group_value if group_value is not None else getattr(args, name)
+
+    return RouteBehaviour(
+        latency_median_ms=arg('latency_median_ms'),
+        latency_sigma=arg('latency_sigma'),
+        error_rate=arg('error_rate'),
+        throttle_every_sec=arg('throttle_every_sec'),
+        throttle_burst_sec=arg('throttle_burst_sec'),
+        retry_after_sec=arg('retry_after_sec'),
+        max_requests_per_sec=arg('max_requests_per_sec'),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sets', type=int, default=20)
+    parser.add_argument('--cards-per-set', type=int, default=100)
+    parser.add_argument('--listing-depth-alpha', type=float, default=0.9,
+                        help='Pareto shape of the number of listings per SKU, lower is deeper')
+    parser.add_argument('--sales-per-day', type=float, default=0.5, help='Median sales per SKU per day')
+    parser.add_argument('--sales-days', type=int, default=14)
+
+    behaviours = [
+        ('latency-median-ms', float, 50.0),
+        ('latency-sigma', float, 0.5),
+        ('error-rate', float, 0.0),
+        ('throttle-every-sec', float, 0.0),
+        ('throttle-burst-sec', float, 0.0),
+        ('retry-after-sec', float, 1.0),
+        ('max-requests-per-sec', float, None),
+    ]
+    # Every behaviour applies to all the route groups, unless overridden for one with --<group>-<behaviour>
+    for name, type_, default in behaviours:
+        parser.add_argument(f'--{name}', type=type_, default=default)
+        for group in ('catalog', 'listings', 'sales'):
+            parser.add_argument(f'--{group}-{name}', type=type_, default=None)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    market = FakeMarket(
+        args.seed, args.sets, args.cards_per_set, args.listing_depth_alpha, args.sales_per_day, args.sales_days
+    )
+    logger.info(f'Serving {len(market.sets)} sets, {len(market.products)} cards on {args.host}:{args.port}')
+
+    rng = random.Random(args.seed)
+    fault_injectors = {
+        group: FaultInjector(get_route_behaviour(args, group), rng) for group in ('catalog', 'listings', 'sales')
+    }
+
+    web.run_app(create_app(market, fault_injectors), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+    Fills the database in DATABASE_URI with a synthetic market to run the analysis jobs against: cards with SKUs, a
+    complete listing snapshot with power-law book depth, and weeks of 4-hourly sku_listings_batch_aggregate_data and
+    card_sales history. The copies counts of the history go down by what the sales sold, so the copies deltas, sales and
+    order books of a SKU agree with each other.
+
+    Everything is written in the SYNTHETIC_*_ID_BASE id ranges with COPY, generating a market replaces the previous
+    synthetic one and --clear only deletes it. Point it at a local TimescaleDB set up with models/migrate.py, the
+    synthetic snapshot becomes the latest complete one the jobs read.
+
+    python scripts/generate_synthetic_market.py --cards 10000 --skus-per-card 5 --weeks 2
+"""
+import argparse
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from constants import SYNC_FREQUENCY_INTERVAL_HOURS
+from data.copy_ingest import CopyBuffer
+from models import db_sessionmaker, get_engine, Card, CardSale, CardSyncData, Condition, Printing, Set, SKU, \
+    SKUListing, SKUListingsBatchAggregateData, SKUMaxProfit
+from models.listing_snapshot import ListingSnapshot, ListingSnapshotStatus
+from models.sku_listings_batch_aggregate_rollup import sku_listings_batch_aggregate_hourly, \
+    sku_listings_batch_aggregate_daily
+from scripts.fake_tcgplayer_server import PRINTINGS, CONDITIONS, CONDITION_PRICE_FACTORS, RARITIES
+from tasks.listing_writer import SKU_LISTING_COPY_COLUMNS, BATCH_AGGREGATE_DATA_COPY_COLUMNS
+
+SYNTHETIC_SET_ID_BASE = 900_000
+SYNTHETIC_CARD_ID_BASE = 900_000_000
+SYNTHETIC_SKU_ID_BASE = 1_000_000_000
+SYNTHETIC_LISTING_ID_BASE = 1_000_000_000
+SYNTHETIC_SALE_ID_BASE = 1_000_000_000
+"""Ids of everything synthetic start at these, far above TCGplayer's, which is how --clear finds them"""
+CARDS_PER_SET = 1000
+CARDS_PER_CHUNK = 5000
+"""Cards generated and copied per transaction, bounds the SKUs x buckets arrays of the history"""
+MAX_LISTINGS_PER_SKU = 2000
+BUCKET_SEC = SYNC_FREQUENCY_INTERVAL_HOURS * 60 * 60
+SHIPPING_PRICE_CENTS = np.array([0, 99, 131])
+SALE_QUANTITIES = np.array([1, 1, 1, 2, 3])
+VARIANTS = [(printing_name, condition) for condition in CONDITIONS for _, printing_name in PRINTINGS]
+"""(printing_name, (condition_id, condition_name, abbreviation)) of every SKU a card can have"""
+
+CARD_SALE_COPY_COLUMNS = (
+    'id', 'order_date', 'printing_name', 'condition_name', 'card_id', 'quantity', 'listing_type', 'purchase_price',
+    'shipping_price',
+)
+
+
+@dataclass
+class MarketConfig:
+    cards: int
+    skus_per_card: int = 5
+    listing_depth_alpha: float = 1.2
+    """Pareto shape of the listings per SKU, lower is deeper. Below 1 the mean depth is bounded by the cap only."""
+    weeks: int = 2
+    sales_per_day: float = 0.3
+    """Median sales per SKU per day, the rates of the SKUs are log-normal around it"""
+    seed: int = 0
+
+
+@dataclass
+class MarketStats:
+    cards: int = 0
+    skus: int = 0
+    listings: int = 0
+    aggregate_rows: int = 0
+    sales: int = 0
+    snapshot_timestamp: str = ''
+    generate_sec: float = 0.0
+
+
+def format_cents(cents: np.ndarray) -> List[str]:
+    # Exact Numeric text, floats could come out as 0.30000000000000004
+    return [f'{value // 100}.{value % 100:02d}' for value in cents.tolist()]
+
+
+def clear_market(session: Session) -> None:
+    """Deletes everything synthetic, in foreign key order"""
+    snapshot_timestamps = session.scalars(
+        select(SKUListing.timestamp).filter(SKUListing.sku_id >= SYNTHETIC_SKU_ID_BASE).distinct()
+    ).all()
+
+    session.execute(delete(CardSale).where(CardSale.card_id >= SYNTHETIC_CARD_ID_BASE))
+    session.execute(delete(SKUMaxProfit).where(SKUMaxProfit.sku_id >= SYNTHETIC_SKU_ID_BASE))
+    session.execute(delete(SKUListing).where(SKUListing.sku_id >= SYNTHETIC_SKU_ID_BASE))
+    session.execute(
+        delete(SKUListingsBatchAggregateData).where(SKUListingsBatchAggregateData.sku_id >= SYNTHETIC_SKU_ID_BASE)
+    )
+    session.execute(delete(ListingSnapshot).where(ListingSnapshot.timestamp.in_(snapshot_timestamps)))
+    session.execute(delete(CardSyncData).where(CardSyncData.card_id >= SYNTHETIC_CARD_ID_BASE))
+    session.execute(delete(SKU).where(SKU.id >= SYNTHETIC_SKU_ID_BASE))
+    session.execute(delete(Card).where(Card.id >= SYNTHETIC_CARD_ID_BASE))
+    session.execute(delete(Set).where(Set.id >= SYNTHETIC_SET_ID_BASE))
+
+    session.commit()
+
+
+def refresh_rollups() -> None:
+    # Continuous aggregates can't be refreshed in a transaction
+    with get_engine().connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for rollup in (sku_listings_batch_aggregate_hourly, sku_listings_batch_aggregate_daily):
+            connection.execute(text(f"CALL refresh_continuous_aggregate('{rollup.name}', NULL, NULL);"))
+
+
+def _insert_variants(session: Session) -> Dict[str, int]:
+    """Adds the printings and conditions the synthetic SKUs use, returns the ids of both by name"""
+    session.execute(insert(Printing).values([
+        dict(id=printing_id, name=name, order=printing_id) for printing_id, name in PRINTINGS
+    ]).on_conflict_do_nothing())
+    session.execute(insert(Condition).values([
+        dict(id=condition_id, name=name, abbreviation=abbreviation, order=condition_id)
+        for condition_id, name, abbreviation in CONDITIONS
+    ]).on_conflict_do_nothing())
+
+    names = [name for _, name in PRINTINGS] + [name for _, name, _ in CONDITIONS]
+    name_to_id = dict(session.execute(select(Printing.name, Printing.id).filter(Printing.name.in_(names))).all())
+    name_to_id.update(session.execute(select(Condition.name, Condition.id).filter(Condition.name.in_(names))).all())
+
+    missing = set(names) - set(name_to_id)
+    if missing:
+        raise SystemExit(f'Printings or conditions {missing} clash with the ids of existing ones')
+
+    return name_to_id
+
+
+def _insert_sets(session: Session, num_cards: int, published_on: datetime) -> None:
+    session.execute(insert(Set), [
+        dict(
+            id=SYNTHETIC_SET_ID_BASE + index,
+            name=f'Synthetic Set {index}',
+            code=f'SYN{index}',
+            release_date=published_on,
+            modified_date=published_on,
+        )
+        for index in range((num_cards + CARDS_PER_SET - 1) // CARDS_PER_SET)
+    ])
+
+
+def _generate_chunk(
+        session: Session,
+        config: MarketConfig,
+        rng: np.random.Generator,
+        card_indexes: np.ndarray,
+        name_to_id: Dict[str, int],
+        snapshot_timestamp: datetime,
+        stats: MarketStats,
+) -> None:
+    num_cards = len(card_indexes)
+    card_ids = SYNTHETIC_CARD_ID_BASE + card_indexes
+    num_buckets = config.weeks * 7 * 24 // SYNC_FREQUENCY_INTERVAL_HOURS
+
+    # Every card gets skus_per_card distinct variants
+    variant_indexes = np.argsort(rng.random((num_cards, len(VARIANTS))), axis=1)[:, :config.skus_per_card].ravel()
+    num_skus = len(variant_indexes)
+    sku_card_ids = np.repeat(card_ids, config.skus_per_card)
+    sku_ids = SYNTHETIC_SKU_ID_BASE + stats.skus + np.arange(num_skus)
+    printing_names = [VARIANTS[index][0] for index in variant_indexes.tolist()]
+    conditions = [VARIANTS[index][1] for index in variant_indexes.tolist()]
+
+    # Log-normal card prices around a few dollars, a few cards are worth a lot more
+    card_price_cents = np.exp(rng.normal(np.log(300), 1.2, size=num_cards))
+    condition_factors = np.array([CONDITION_PRICE_FACTORS[condition[0]] for condition in conditions])
+    sku_price_cents = np.repeat(card_price_cents, config.skus_per_card) * condition_factors
+
+    session.execute(insert(Card), [
+        dict(
+            id=card_id,
+            name=f'Synthetic Card {card_id - SYNTHETIC_CARD_ID_BASE}',
+            clean_name=f'Synthetic Card {card_id - SYNTHETIC_CARD_ID_BASE}',
+            set_id=SYNTHETIC_SET_ID_BASE + (card_id - SYNTHETIC_CARD_ID_BASE) // CARDS_PER_SET,
+            number=f'SYN-EN{card_id - SYNTHETIC_CARD_ID_BASE:06d}',
+            rarity_name=RARITIES[card_id % len(RARITIES)],
+            modified_date=snapshot_timestamp,
+        )
+        for card_id in card_ids.tolist()
+    ])
+    session.execute(insert(SKU), [
+        dict(id=sku_id, card_id=card_id, printing_id=name_to_id[printing_name], condition_id=name_to_id[condition[1]])
+        for sku_id, card_id, printing_name, condition in zip(
+            sku_ids.tolist(), sku_card_ids.tolist(), printing_names, conditions
+        )
+    ])
+
+    # The latest snapshot's order books, most SKUs have a handful of listings and a few have hundreds
+    listing_counts = np.minimum(MAX_LISTINGS_PER_SKU, np.floor(rng.pareto(config.listing_depth_alpha, num_skus) + 1))
+    listing_counts = listing_counts.astype(np.int64)
+    listing_skus = np.repeat(np.arange(num_skus), listing_counts)
+    num_listings = len(listing_skus)
+    listing_price_cents = np.maximum(1, np.rint(sku_price_cents[listing_skus] * rng.uniform(0.7, 1.3, num_listings)))
+    listing_price_cents = listing_price_cents.astype(np.int64)
+    listing_shipping_cents = rng.choice(SHIPPING_PRICE_CENTS, size=num_listings)
+    listing_quantity = rng.integers(1, 5, size=num_listings)
+
+    listing_buffer = CopyBuffer(SKUListing.__tablename__, SKU_LISTING_COPY_COLUMNS)
+    listing_buffer.add_rows(zip(
+        (SYNTHETIC_LISTING_ID_BASE + stats.listings + np.arange(num_listings)).tolist(),
+        [snapshot_timestamp] * num_listings,
+        sku_ids[listing_skus].tolist(),
+        (rng.random(num_listings) < 0.5).tolist(),
+        (rng.random(num_listings) < 0.2).tolist(),
+        listing_quantity.tolist(),
+        [f'seller{seller}' for seller in rng.integers(0, 5000, size=num_listings).tolist()],
+        format_cents(listing_price_cents),
+        format_cents(listing_shipping_cents),
+    ))
+
+    # Sales are Poisson per SKU and bucket, bucket b covers the SYNC_FREQUENCY_INTERVAL_HOURS up to bucket_timestamps[b]
+    bucket_timestamps = [
+        snapshot_timestamp - timedelta(seconds=BUCKET_SEC * (num_buckets - 1 - bucket)) for bucket in range(num_buckets)
+    ]
+    sales_per_bucket = config.sales_per_day * np.exp(rng.normal(0, 1, size=num_skus)) * BUCKET_SEC / 86400
+    sale_counts = rng.poisson(sales_per_bucket[:, np.newaxis], size=(num_skus, num_buckets))
+    sale_cells = np.repeat(np.arange(num_skus * num_buckets), sale_counts.ravel())
+    sale_skus, sale_buckets = np.divmod(sale_cells, num_buckets)
+    num_sales = len(sale_cells)
+    sale_quantity = rng.choice(SALE_QUANTITIES, size=num_sales)
+    sale_seconds_before_bucket_end = rng.uniform(0, BUCKET_SEC, size=num_sales)
+    sale_price_cents = np.maximum(1, np.rint(sku_price_cents[sale_skus] * rng.uniform(0.8, 1.3, num_sales)))
+
+    sale_buffer = CopyBuffer(CardSale.__tablename__, CARD_SALE_COPY_COLUMNS)
+    sale_buffer.add_rows(zip(
+        (SYNTHETIC_SALE_ID_BASE + stats.sales + np.arange(num_sales)).tolist(),
+        [
+            bucket_timestamps[bucket] - timedelta(seconds=seconds)
+            for bucket, seconds in zip(sale_buckets.tolist(), sale_seconds_before_bucket_end.tolist())
+        ],
+        [printing_names[sku] for sku in sale_skus.tolist()],
+        [conditions[sku][1] for sku in sale_skus.tolist()],
+        sku_card_ids[sale_skus].tolist(),
+        sale_quantity.tolist(),
+        ['ListingWithoutPhotos'] * num_sales,
+        format_cents(sale_price_cents.astype(np.int64)),
+        format_cents(rng.choice(SHIPPING_PRICE_CENTS, size=num_sales)),
+    ))
+
+    # Going back in time, every bucket had the copies the later buckets went on to sell
+    sold_copies = np.bincount(sale_cells, weights=sale_quantity, minlength=num_skus * num_buckets)
+    sold_copies = sold_copies.reshape(num_skus, num_buckets).astype(np.int64)
+    sold_after = np.cumsum(sold_copies[:, ::-1], axis=1)[:, ::-1] - sold_copies
+    copies = np.bincount(listing_skus, weights=listing_quantity, minlength=num_skus).astype(np.int64)[:, np.newaxis]
+    copies = copies + sold_after
+    listings = listing_counts[:, np.newaxis] + sold_after // 2
+
+    lowest_total_cents = np.full(num_skus, np.iinfo(np.int64).max)
+    np.minimum.at(lowest_total_cents, listing_skus, listing_price_cents + listing_shipping_cents)
+    # The lowest price drifts back from the current one in a small random walk
+    price_drift = np.exp(np.cumsum(rng.normal(0, 0.02, size=(num_skus, num_buckets))[:, ::-1], axis=1)[:, ::-1])
+    lowest_price_cents = np.maximum(1, np.rint(lowest_total_cents[:, np.newaxis] * price_drift / price_drift[:, -1:]))
+
+    aggregate_buffer = CopyBuffer(SKUListingsBatchAggregateData.__tablename__, BATCH_AGGREGATE_DATA_COPY_COLUMNS)
+    num_aggregate_rows = num_skus * num_buckets
+    aggregate_buffer.add_rows(zip(
+        np.repeat(sku_ids, num_buckets).tolist(),
+        bucket_timestamps * num_skus,
+        format_cents(lowest_price_cents.astype(np.int64).ravel()),
+        listings.ravel().tolist(),
+        copies.ravel().tolist(),
+        [None] * num_aggregate_rows,
+    ))
+
+    listing_buffer.flush(session)
+    sale_buffer.flush(session)
+    aggregate_buffer.flush(session)
+    session.commit()
+
+    stats.cards += num_cards
+    stats.skus += num_skus
+    stats.listings += num_listings
+    stats.sales += num_sales
+    stats.aggregate_rows += num_aggregate_rows
+
+
+def generate_market(config: MarketConfig) -> MarketStats:
+    """Replaces the synthetic market with a new one of config, returns what was written"""
+    start_time = time.perf_counter()
+    rng = np.random.default_rng(config.seed)
+
+    # On the grid the sweeps write at, like a sweep that just finished
+    snapshot_timestamp = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    stats = MarketStats(snapshot_timestamp=snapshot_timestamp.isoformat())
+
+    with db_sessionmaker() as session:
+        clear_market(session)
+
+        name_to_id = _insert_variants(session)
+        _insert_sets(session, config.cards, snapshot_timestamp - timedelta(weeks=config.weeks))
+        session.commit()
+
+        for offset in range(0, config.cards, CARDS_PER_CHUNK):
+            card_indexes = np.arange(offset, min(offset + CARDS_PER_CHUNK, config.cards))
+            _generate_chunk(session, config, rng, card_indexes, name_to_id, snapshot_timestamp, stats)
+
+            print(f'{stats.cards}/{config.cards} cards, {stats.listings} listings, {stats.sales} sales')
+
+        session.add(ListingSnapshot(
+            timestamp=snapshot_timestamp,
+            status=ListingSnapshotStatus.COMPLETE,
+            product_count=stats.cards,
+            row_count=stats.listings,
+            completed_at=datetime.utcnow(),
+        ))
+        session.commit()
+
+    refresh_rollups()
+
+    stats.generate_sec = time.perf_counter() - start_time
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cards', type=int, default=10_000)
+    parser.add_argument('--skus-per-card', type=int, default=5, choices=range(1, len(VARIANTS) + 1))
+    parser.add_argument('--listing-depth-alpha', type=float, default=1.2)
+    parser.add_argument('--weeks', type=int, default=2)
+    parser.add_argument('--sales-per-day', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clear', action='store_true', help='Only delete the synthetic market')
+    args = parser.parse_args()
+
+    if args.clear:
+        with db_sessionmaker() as session:
+            clear_market(session)
+
+        refresh_rollups()
+        return
+
+    stats = generate_market(MarketConfig(
+        cards=args.cards,
+        skus_per_card=args.skus_per_card,
+        listing_depth_alpha=args.listing_depth_alpha,
+        weeks=args.weeks,
+        sales_per_day=args.sales_per_day,
+        seed=args.seed,
+    ))
+
+    print(asdict(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+    Measures what starting the app costs: for each module, a fresh interpreter imports it --repeat times, and the
+    fastest wall time is reported with the packages that took the longest to import, from python -X importtime. The
+    imports run without DATABASE_URI, so one that needs the database fails here.
+
+    python scripts/measure_import_time.py scheduler models services.find_profitable_skus --top 15 --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+DEFAULT_MODULES = (
+    'models',
+    'services.profit_engine',
+    'services.find_profitable_skus',
+    'tasks.tiered_listing_sweep',
+    'tasks.update_card_database',
+    'scheduler',
+)
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """(package, self µs, cumulative µs) of every import -X importtime logged"""
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, package = line[len('import time:'):].split('|')
+        imports.append((package.rstrip(), int(self_us), int(cumulative_us)))
+
+    return imports
+
+
+def measure_import(module: str) -> Tuple[float, List[Tuple[str, int, int]]]:
+    env = {key: value for key, value in os.environ.items() if key != 'DATABASE_URI'}
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+
+    start_time = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    wall_sec = time.perf_counter() - start_time
+
+    if process.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{process.stderr.splitlines()[-1]}')
+
+    return wall_sec, parse_importtime(process.stderr)
+
+
+def get_top_packages(imports: List[Tuple[str, int, int]], top: int) -> Dict[str, float]:
+    # Top level packages only, their cumulative time already includes what they import
+    top_level = [
+        (package.strip(), cumulative_us) for package, _, cumulative_us in imports
+        if '.' not in package.strip()
+    ]
+    top_level.sort(key=lambda item: item[1], reverse=True)
+
+    return {package: cumulative_us / 1e6 for package, cumulative_us in top_level[:top]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+
+    for module in args.modules:
+        runs = [measure_import(module) for _ in range(args.repeat)]
+        wall_sec, imports = min(runs, key=lambda run: run[0])
+        top_packages = get_top_packages(imports, args.top)
+
+        results[module] = dict(wall_sec=wall_sec, modules_imported=len(imports), top_packages=top_packages)
+
+        print(f'{module}: {wall_sec:.3f}s, {len(imports)} modules')
+        for package, cumulative_sec in top_packages.items():
+            print(f'  {package:<40} {cumulative_sec:8.3f}s')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+        print(f'Wrote {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,47 @@
+import contextvars
 import logging
+import math
+import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from datetime import timedelta
-from decimal import Decimal
-from typing import List, Dict
+from datetime import timedelta, datetime, timezone
+from typing import List, Dict, Optional, Tuple
 
-import numpy as np
-import pandas as pd
 from sqlalchemy.dialects.postgresql import insert
-from statsmodels.tsa.holtwinters import Holt
-
-from constants import COPIES_TIME_DELTA_DAYS, BATCH_SIZE, MAX_PROFIT_CUTOFF_DOLLARS, NUM_WORKERS, SALES_TIME_DELTA_DAYS, \
-    SELLER_COST, TAX, SYNC_FREQUENCY_INTERVAL_HOURS
-from data.dao import get_latest_listings_for_skus, get_listing_sku_ids, get_copies_delta_for_skus
-from models import db_sessionmaker, SKU, CardSale
+from sqlalchemy.orm import Session
+
+from constants import COPIES_TIME_DELTA_DAYS, BATCH_SIZE, MAX_PROFIT_CUTOFF_CENTS, NUM_WORKERS, SALES_TIME_DELTA_DAYS, \
+    SELLER_COST_RATE_BASIS_POINTS, TAX_RATE_BASIS_POINTS, SYNC_FREQUENCY_INTERVAL_HOURS, SELL_SHIPPING_CUTOFF_CENTS, \
+    SELL_SHIPPING_COST_CENTS, PROFIT_WORKERS
+from data.dao import get_latest_listings_for_skus, get_listing_sku_ids, get_copies_delta_for_skus, get_sales_for_skus, \
+    get_latest_complete_snapshot_timestamp
+from data.order_book_store import OrderBookSnapshot, BookListing, order_book_store
+from models import db_sessionmaker
 from models.sku_listing import SKUListing
 from models.sku_max_profit import SKUMaxProfit
-from services.tcgplayer_listing_service import get_sales
-from tasks.custom_types import CardRequestData
+from services.profit_engine import pack_listings, pack_order_books, compute_profitable_skus, PackedListings, \
+    ProfitRecord
+from services.sales_forecaster import bucket_sales, forecast_sales, SALES_BUCKET_SEC
+from tasks.fetch_card_sales import fetch_sales_for_skus
 from tasks.log_runtime_decorator import log_runtime
-from tasks.utils import split_into_segments
+from tasks.utils import ExecutionMode, create_cpu_executor
+from utils.metrics import metrics, time_stage, track_job, STAGE_DURATION_METRIC, DB_ROWS_WRITTEN_METRIC
+from utils.money import apply_rate, from_cents
 
 logger = logging.getLogger(__name__)
 
 session = db_sessionmaker()
 
+MAX_SALES_QUERY_SKU_IDS = 10_000
+"""Above this many SKUs the forecasts read the sales of every SKU and drop the others, instead of sending the ids"""
+
 
 @dataclass
 class ProfitData:
-    max_profit: Decimal
+    max_profit_cents: int
     num_cards: int
-    cost: Decimal
+    cost_cents: int
 
 
 @dataclass
@@ -41,8 +51,8 @@ class SkuProfitData:
 
 
 def compute_profit_from_listings(listings: List[SKUListing], quantity_limit: int) -> ProfitData:
-    max_profit_for_cards = ProfitData(Decimal(0.0), 0, Decimal(0.0))
-    running_cost = Decimal(0.0)
+    max_profit_for_cards = ProfitData(0, 0, 0)
+    running_cost_cents = 0
     running_quantity = 0
 
     if quantity_limit <= 0:
@@ -53,20 +63,23 @@ def compute_profit_from_listings(listings: List[SKUListing], quantity_limit: int
 
         num_cards_to_buy_from_listing = min(quantity_limit - running_quantity, listing.quantity)
 
-        running_cost += listing.price * num_cards_to_buy_from_listing + listing.shipping_price
+        running_cost_cents += listing.price_cents * num_cards_to_buy_from_listing + listing.shipping_price_cents
         running_quantity += num_cards_to_buy_from_listing
 
         next_listing = listings[i + 1]
-        shipping_cost = 4 if next_listing.price >= 40 else 0
+        shipping_cost_cents = SELL_SHIPPING_COST_CENTS if next_listing.price_cents >= SELL_SHIPPING_CUTOFF_CENTS else 0
 
         # We assume we can sell all the cards we've bought at the next listing price
-        revenue = (Decimal(next_listing.price) - shipping_cost) * running_quantity * SELLER_COST
+        revenue_cents = apply_rate(
+            (next_listing.price_cents - shipping_cost_cents) * running_quantity,
+            SELLER_COST_RATE_BASIS_POINTS,
+        )
 
-        total_cost = running_cost * (1 + TAX)
+        total_cost_cents = running_cost_cents + apply_rate(running_cost_cents, TAX_RATE_BASIS_POINTS)
 
-        profit = (revenue - total_cost)
-        if profit > max_profit_for_cards.max_profit:
-            max_profit_for_cards = ProfitData(profit, running_quantity, running_cost)
+        profit_cents = revenue_cents - total_cost_cents
+        if profit_cents > max_profit_for_cards.max_profit_cents:
+            max_profit_for_cards = ProfitData(profit_cents, running_quantity, running_cost_cents)
 
         if running_quantity == quantity_limit:
             # cannot buy anymore card
@@ -76,7 +89,7 @@ def compute_profit_from_listings(listings: List[SKUListing], quantity_limit: int
 
 
 def compute_max_profit_for_listings(listings: List[SKUListing], purchase_copies_limit: int | None = None) -> ProfitData:
-    sorted_listings_by_cost = sorted(listings, key=lambda x: x.price + x.shipping_price)
+    sorted_listings_by_cost = sorted(listings, key=lambda x: x.price_cents + x.shipping_price_cents)
 
     num_cards = sum(
         listing.quantity for listing in listings
@@ -85,158 +98,243 @@ def compute_max_profit_for_listings(listings: List[SKUListing], purchase_copies_
     return compute_profit_from_listings(sorted_listings_by_cost, num_cards)
 
 
-def get_listings_dict(sku_ids: List[int]) -> Dict[int, List[SKUListing]]:
-    sku_id_to_listings_dict: Dict[int, List[SKUListing]] = defaultdict(list)
+def get_listings_dict(
+        sku_ids: List[int],
+        order_books: Optional[OrderBookSnapshot] = None,
+        db_session: Session = session,
+        listing_timestamp: Optional[datetime] = None,
+) -> Dict[int, List[SKUListing | BookListing]]:
+    sku_id_to_listings_dict: Dict[int, List[SKUListing | BookListing]] = defaultdict(list)
+
+    if order_books is not None:
+        for sku_id in sku_ids:
+            book = order_books.get_book(sku_id)
+            if book:
+                sku_id_to_listings_dict[sku_id] = book
 
-    for listing in get_latest_listings_for_skus(session, sku_ids):
+        return sku_id_to_listings_dict
+
+    for listing in get_latest_listings_for_skus(db_session, sku_ids, listing_timestamp):
         sku_id_to_listings_dict[listing.sku_id].append(listing)
 
     return sku_id_to_listings_dict
 
 
-def get_purchase_copies_limit_dict(sku_ids: List[int]) -> Dict[int, int]:
+def get_purchase_copies_limit_dict(sku_ids: List[int], db_session: Session = session) -> Dict[int, int]:
     sku_id_to_copies_dict: Dict[int, int] = {}
 
-    for sku_id, copies in get_copies_delta_for_skus(session, sku_ids, timedelta(days=COPIES_TIME_DELTA_DAYS)):
+    for sku_id, copies in get_copies_delta_for_skus(db_session, sku_ids, timedelta(days=COPIES_TIME_DELTA_DAYS)):
         sku_id_to_copies_dict[sku_id] = -copies
 
     return sku_id_to_copies_dict
 
 
-@log_runtime
-def compute_max_potential_profit_for_skus(sku_ids: List[int]) -> List[SkuProfitData]:
-    profitable_skus: List[SkuProfitData] = []
-
-    for offset in range(0, len(sku_ids), BATCH_SIZE):
-        listings_dict = get_listings_dict(sku_ids[offset:offset + BATCH_SIZE])
-        purchase_copies_limit_dict = get_purchase_copies_limit_dict(sku_ids[offset:offset + BATCH_SIZE])
-
-        for sku_id, listings_for_sku in listings_dict.items():
-            card_profit_data = compute_max_profit_for_listings(
-                listings_for_sku,
-                purchase_copies_limit=purchase_copies_limit_dict[sku_id]
-            )
-
-            if card_profit_data.max_profit >= MAX_PROFIT_CUTOFF_DOLLARS:
-                profitable_skus.append(SkuProfitData(sku_id, card_profit_data))
+def pack_sku_batch(
+        sku_ids: List[int],
+        order_books: Optional[OrderBookSnapshot] = None,
+        listing_timestamp: Optional[datetime] = None,
+) -> PackedListings:
+    """
+        Reads what the profits of a batch of SKUs need and packs it. Runs on the DB threads of the parent process, each
+        batch with its own session since sessions can't be shared between threads. Without order books the listings are
+        read from the snapshot at listing_timestamp, which every batch of a run gets, so a snapshot completing mid-run
+        can't leave batches reading different ones.
+    """
+    with db_sessionmaker() as batch_session, time_stage('pack_sku_batch'):
+        purchase_copies_limit_dict = get_purchase_copies_limit_dict(sku_ids, batch_session)
+
+        if order_books is not None:
+            return pack_order_books(order_books, sku_ids, purchase_copies_limit_dict)
+
+        return pack_listings(
+            get_listings_dict(sku_ids, db_session=batch_session, listing_timestamp=listing_timestamp),
+            purchase_copies_limit_dict,
+        )
 
-    return profitable_skus
 
+def _compute_profitable_skus_timed(packed: PackedListings, min_profit_cents: int) -> Tuple[List[ProfitRecord], float]:
+    # The profit workers may be other processes with registries of their own, so the parent records the time
+    start_time = time.perf_counter()
+    records = compute_profitable_skus(packed, min_profit_cents)
 
-@log_runtime
-def get_potentially_profitable_skus() -> List[SkuProfitData]:
-    listing_sku_ids = get_listing_sku_ids(session)
-    # listing_sku_ids = [3040466]
+    return records, time.perf_counter() - start_time
 
-    sku_id_segments = split_into_segments(list(listing_sku_ids), NUM_WORKERS)
 
-    profitable_skus_with_profit: List[SkuProfitData] = []
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        futures = [executor.submit(compute_max_potential_profit_for_skus, segment) for segment in sku_id_segments]
+def get_listing_timestamp(order_books: Optional[OrderBookSnapshot] = None) -> Optional[datetime]:
+    """The snapshot a run reads its listings from when there are no order books, looked up once per run"""
+    return get_latest_complete_snapshot_timestamp(session) if order_books is None else None
 
-        for future in as_completed(futures):
-            profitable_skus_with_profit += future.result()
 
-    return profitable_skus_with_profit
+def get_listed_sku_ids(
+        order_books: Optional[OrderBookSnapshot] = None,
+        listing_timestamp: Optional[datetime] = None,
+) -> List[int]:
+    return order_books.sku_ids.tolist() if order_books is not None else \
+        get_listing_sku_ids(session, listing_timestamp)
 
 
-def determine_num_copies_sold_per_day(sku_id: int) -> Decimal:
-    sku: SKU | None = session.get(SKU, sku_id)
-    if not sku:
-        raise ValueError("No sku")
+@log_runtime
+def get_potentially_profitable_skus(
+        order_books: Optional[OrderBookSnapshot] = None,
+        execution_mode: ExecutionMode = ExecutionMode.PROCESSES,
+        listing_sku_ids: Optional[List[int]] = None,
+        listing_timestamp: Optional[datetime] = None,
+) -> List[SkuProfitData]:
+    listing_timestamp = listing_timestamp or get_listing_timestamp(order_books)
+    listing_sku_ids = listing_sku_ids if listing_sku_ids is not None else \
+        get_listed_sku_ids(order_books, listing_timestamp)
+    # listing_sku_ids = [3040466]
 
-    card_request = CardRequestData(
-        product_id=sku.card.id,
-        printings=[sku.printing_id],
-        conditions=[sku.condition_id],
-    )
+    sku_id_batches = [
+        listing_sku_ids[offset:offset + BATCH_SIZE] for offset in range(0, len(listing_sku_ids), BATCH_SIZE)
+    ]
 
-    sales = get_sales(request=card_request, time_delta=timedelta(days=SALES_TIME_DELTA_DAYS))
+    profitable_skus_with_profit: List[SkuProfitData] = []
 
-    if not sales:
-        return Decimal(0)
+    # The database is only read on this process' threads. The profit workers get packed arrays and send back the
+    # profitable SKUs, so nothing ORM-bound crosses the process boundary.
+    with create_cpu_executor(execution_mode, PROFIT_WORKERS) as profit_executor, \
+            ThreadPoolExecutor(max_workers=NUM_WORKERS) as db_executor:
+        pack_futures = [
+            db_executor.submit(contextvars.copy_context().run, pack_sku_batch, batch, order_books, listing_timestamp)
+            for batch in sku_id_batches
+        ]
 
-    sales_to_quantity_list = [
-        (CardSale.parse_response_order_date(sale['orderDate']), sale['quantity']) for sale in sales
-    ]
+        profit_futures = [
+            profit_executor.submit(_compute_profitable_skus_timed, pack_future.result(), MAX_PROFIT_CUTOFF_CENTS)
+            for pack_future in as_completed(pack_futures)
+        ]
 
-    sales_to_quantity_df = pd.DataFrame(sales_to_quantity_list, columns=['datetime', 'quantity'])
+        for future in as_completed(profit_futures):
+            records, compute_sec = future.result()
+            metrics.observe(STAGE_DURATION_METRIC, compute_sec, stage='compute_profitable_skus')
 
-    sales_to_quantity_df.set_index('datetime', inplace=True)
+            profitable_skus_with_profit += [
+                SkuProfitData(record.sku_id, ProfitData(record.max_profit_cents, record.num_cards, record.cost_cents))
+                for record in records
+            ]
 
-    sales_to_quantity_df_time_bucket_sync_frequency = \
-        sales_to_quantity_df.resample(f'4h').sum()
+    metrics.set('skus', len(listing_sku_ids), state='listed')
 
-    now = pd.Timestamp.now()
-    one_week_ago = now - pd.Timedelta(days=7)
+    return profitable_skus_with_profit
 
-    full_range = pd.date_range(start=one_week_ago.floor('4h'), end=now.ceil('4h'), freq='4h', tz='UTC')
 
-    sales_to_quantity_df_time_bucket_sync_frequency = \
-        sales_to_quantity_df_time_bucket_sync_frequency.resample(f'4h').sum()
+def get_copies_sold_per_day_forecasts(sku_ids: List[int]) -> Dict[int, float]:
+    """
+        Copies each SKU is forecast to sell over the next day, from its sales of the past SALES_TIME_DELTA_DAYS days in
+        card_sales, in SYNC_FREQUENCY_INTERVAL_HOURS buckets. The series of all the SKUs are fitted in one batch.
+    """
+    # The buckets are on the same grid as the sync frequencies, the last one is the current, still partial, one
+    num_buckets = SALES_TIME_DELTA_DAYS * 24 // SYNC_FREQUENCY_INTERVAL_HOURS
+    end_timestamp = math.ceil(time.time() / SALES_BUCKET_SEC) * SALES_BUCKET_SEC
+    start_date = datetime.fromtimestamp(end_timestamp - num_buckets * SALES_BUCKET_SEC, tz=timezone.utc)
 
-    sales_to_quantity_df_time_bucket_sync_frequency = sales_to_quantity_df_time_bucket_sync_frequency.reindex(
-        full_range, fill_value=0)
+    sku_id_to_row = {sku_id: row for row, sku_id in enumerate(sku_ids)}
+    row_indexes, order_timestamps, quantities = [], [], []
+    sales_sku_ids = sku_ids if len(sku_ids) <= MAX_SALES_QUERY_SKU_IDS else None
 
-    model = Holt(np.asarray(sales_to_quantity_df_time_bucket_sync_frequency['quantity']), damped_trend=True).fit()
+    # card_sales stores the UTC order dates without their time zone
+    with time_stage('query_sales'):
+        for sku_id, order_date, quantity in get_sales_for_skus(session, sales_sku_ids, start_date.replace(tzinfo=None)):
+            if sku_id not in sku_id_to_row:
+                continue
 
-    forecast = sum(model.forecast(steps=int(24 / SYNC_FREQUENCY_INTERVAL_HOURS)))
+            row_indexes.append(sku_id_to_row[sku_id])
+            order_timestamps.append(order_date.replace(tzinfo=timezone.utc).timestamp())
+            quantities.append(quantity)
 
-    print(forecast)
+    with time_stage('forecast_sales'):
+        sales = bucket_sales(row_indexes, order_timestamps, quantities, len(sku_ids), end_timestamp, num_buckets)
+        forecasts = forecast_sales(sales, horizon=24 // SYNC_FREQUENCY_INTERVAL_HOURS)
 
-    return forecast
+    return dict(zip(sku_ids, forecasts.tolist()))
 
 
 @log_runtime
-def get_good_looking_skus(profitable_skus: List[SkuProfitData]) -> List[SkuProfitData]:
+def get_good_looking_skus(
+        profitable_skus: List[SkuProfitData],
+        order_books: Optional[OrderBookSnapshot] = None,
+        listing_timestamp: Optional[datetime] = None,
+) -> List[SkuProfitData]:
+    """
+        The candidates that are still profitable when buying only the copies they're forecast to sell. Their sales are
+        brought up to date first, then the forecasts of all of them are fitted in one batch.
+    """
     good_looking_profits = []
-    listings_dict = get_listings_dict([sku_data.sku_id for sku_data in profitable_skus])
+    sku_ids = [sku_data.sku_id for sku_data in profitable_skus]
+    listings_dict = get_listings_dict(sku_ids, order_books, listing_timestamp=listing_timestamp)
+
+    # Only the candidates' sales since the previous run are fetched, the forecasts read the rest from card_sales
+    fetch_sales_for_skus(sku_ids)
+    copies_sold_per_day_forecasts = get_copies_sold_per_day_forecasts(sku_ids)
+    metrics.set('skus', len(copies_sold_per_day_forecasts), state='forecast')
+
     for sku_data in profitable_skus:
         sku_id = sku_data.sku_id
-        num_copies_sold_per_day = determine_num_copies_sold_per_day(sku_id=sku_id)
+        num_copies_sold_per_day = copies_sold_per_day_forecasts[sku_id]
 
         # TODO: room for optimization. We currently just use the 3-day sales count as the number of copies we can buy
         sku_profit_data = compute_max_profit_for_listings(listings_dict[sku_id], int(num_copies_sold_per_day * 3))
 
-        if sku_profit_data.max_profit >= 1:
+        if sku_profit_data.max_profit_cents >= MAX_PROFIT_CUTOFF_CENTS:
             good_looking_profits.append(SkuProfitData(sku_id, sku_profit_data))
 
-    good_looking_profits = list(sorted(good_looking_profits, key=lambda x: x.profit_data.max_profit, reverse=True))
+    good_looking_profits = list(
+        sorted(good_looking_profits, key=lambda x: x.profit_data.max_profit_cents, reverse=True)
+    )
 
     return good_looking_profits
 
 
+@track_job
 @log_runtime
 def find_profitable_skus() -> None:
     session.query(SKUMaxProfit).delete()
 
-    profitable_skus = get_potentially_profitable_skus()
+    # The listing sweep leaves its order books in memory, the database is only read when there's none yet (cold start)
+    order_books = order_book_store.latest()
+    if order_books is None:
+        logger.info('No order books in memory, reading the latest listings from the database')
+
+    # Every read of the run is from the same snapshot, even if the sweep completes another one in the meantime
+    listing_timestamp = get_listing_timestamp(order_books)
+    listing_sku_ids = get_listed_sku_ids(order_books, listing_timestamp)
+    profitable_skus = get_potentially_profitable_skus(
+        order_books,
+        listing_sku_ids=listing_sku_ids,
+        listing_timestamp=listing_timestamp,
+    )
 
     logger.info(f'found {len(profitable_skus)} potentially profitable skus')
+    metrics.set('skus', len(profitable_skus), state='potentially_profitable')
 
-    profitable_skus = get_good_looking_skus(profitable_skus)
+    profitable_skus = get_good_looking_skus(profitable_skus, order_books, listing_timestamp=listing_timestamp)
 
     logger.info(f'found {len(profitable_skus)} profitable skus')
+    metrics.set('skus', len(profitable_skus), state='profitable')
 
     profitable_skus = list(
-        sorted(profitable_skus, key=lambda x: float(x.profit_data.max_profit / x.profit_data.cost), reverse=True)
+        sorted(profitable_skus, key=lambda x: x.profit_data.max_profit_cents / x.profit_data.cost_cents, reverse=True)
     )
 
     values = [
         dict(
             sku_id=sku_profit_data.sku_id,
-            max_profit=sku_profit_data.profit_data.max_profit,
+            max_profit=from_cents(sku_profit_data.profit_data.max_profit_cents),
             num_cards=sku_profit_data.profit_data.num_cards,
-            cost=sku_profit_data.profit_data.cost,
+            cost=from_cents(sku_profit_data.profit_data.cost_cents),
         )
         for sku_profit_data in profitable_skus
     ]
     if not values:
         return
 
-    stmt = insert(SKUMaxProfit).values(values)
-    session.execute(stmt)
-    session.commit()
+    with time_stage('write_sku_max_profit'):
+        stmt = insert(SKUMaxProfit).values(values)
+        session.execute(stmt)
+        session.commit()
+
+    metrics.inc(DB_ROWS_WRITTEN_METRIC, len(values), table=SKUMaxProfit.__tablename__)
 
 
 if __name__ == "__main__":
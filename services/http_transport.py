@@ -0,0 +1,273 @@
+import logging
+import re
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.rate_controller import AIMDRateController
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS_PER_HOST = 64
+"""Sized to cover paginateWithBackoff's parallel requests so threads never wait on the pool"""
+KEEP_ALIVE_TIMEOUT_SEC = 60
+ID_PATH_SEGMENT_PATTERN = re.compile(r'/\d[\d,]*(?=/|$)')
+"""Product and SKU ids in paths, one or comma separated, so every product's requests count towards one endpoint"""
+
+HTTP_REQUESTS_METRIC = 'http_requests_total'
+HTTP_REQUEST_DURATION_METRIC = 'http_request_duration_seconds'
+HTTP_SENT_BYTES_METRIC = 'http_sent_bytes_total'
+HTTP_RECEIVED_BYTES_METRIC = 'http_received_bytes_total'
+
+try:
+    import brotli  # noqa: F401 - urllib3 and aiohttp only decode br when it's installed
+
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+
+@dataclass
+class HostStats:
+    requests: int = 0
+    connections_opened: int = 0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Fraction of requests that went out on an already open connection"""
+        if self.requests == 0:
+            return 0.0
+
+        return max(0.0, 1 - self.connections_opened / self.requests)
+
+
+_lock = Lock()
+_sessions: Dict[str, requests.Session] = {}
+_host_stats: Dict[str, HostStats] = {}
+
+
+def _get_host_stats(host: str) -> HostStats:
+    # Called with _lock held
+    stats = _host_stats.get(host)
+    if stats is None:
+        stats = _host_stats[host] = HostStats()
+
+    return stats
+
+
+def _record(host: str, requests_count=0, connections_opened=0, bytes_sent=0, bytes_received=0):
+    with _lock:
+        stats = _get_host_stats(host)
+        stats.requests += requests_count
+        stats.connections_opened += connections_opened
+        stats.bytes_sent += bytes_sent
+        stats.bytes_received += bytes_received
+
+
+def get_endpoint(url: str) -> str:
+    """Host and path of the url with the ids taken out, e.g. mpapi.tcgplayer.com/v2/product/{id}/latestsales"""
+    parts = urlsplit(url)
+
+    return parts.netloc + ID_PATH_SEGMENT_PATTERN.sub('/{id}', parts.path)
+
+
+def _record_request_metrics(endpoint: str, method: str, status, duration_sec: Optional[float] = None):
+    metrics.inc(HTTP_REQUESTS_METRIC, endpoint=endpoint, method=method, status=status)
+
+    if duration_sec is not None:
+        metrics.observe(HTTP_REQUEST_DURATION_METRIC, duration_sec, endpoint=endpoint, method=method)
+
+
+def _count_pool_connections(session: requests.Session) -> int:
+    # urllib3 counts every connection it opens on a pool, so the sync sessions don't need to track this themselves.
+    # The same adapter is mounted for https:// and http://, each adapter is counted once.
+    count = 0
+    for adapter in {id(adapter): adapter for adapter in session.adapters.values()}.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                count += pool.num_connections
+
+    return count
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_CONNECTIONS_PER_HOST,
+        # Threads wait for a free connection instead of opening throwaway ones past the pool size
+        pool_block=True,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    session.headers['Connection'] = 'keep-alive'
+
+    return session
+
+
+def get_session(url: str) -> requests.Session:
+    """Returns the keep-alive session for the host of the url. Sessions are created once per host and shared."""
+    host = urlsplit(url).netloc
+
+    session = _sessions.get(host)
+    if session is not None:
+        return session
+
+    with _lock:
+        if host not in _sessions:
+            _sessions[host] = _create_session()
+            _get_host_stats(host)
+
+        return _sessions[host]
+
+
+def request(
+        method: str,
+        url: str,
+        rate_controller: Optional[AIMDRateController] = None,
+        **kwargs
+) -> requests.Response:
+    host = urlsplit(url).netloc
+    endpoint = get_endpoint(url)
+
+    try:
+        if rate_controller is None:
+            response = get_session(url).request(method, url, **kwargs)
+        else:
+            rate_controller.acquire()
+
+            status_code = None
+            retry_after = None
+            # Only a response or a transport error says something about the endpoint's load
+            has_feedback = False
+            try:
+                response = get_session(url).request(method, url, **kwargs)
+
+                status_code = response.status_code
+                retry_after = response.headers.get('Retry-After')
+                has_feedback = True
+            except requests.RequestException:
+                has_feedback = True
+                raise
+            finally:
+                if has_feedback:
+                    rate_controller.release(status_code, retry_after)
+                else:
+                    rate_controller.release_without_feedback()
+    except requests.RequestException:
+        _record_request_metrics(endpoint, method, 'error')
+        raise
+
+    # Reading the content here means the connection goes back to the pool right away
+    content_length = len(response.content)
+    # tell() is the number of bytes read off the wire, i.e. before gzip/br decoding
+    wire_length = response.raw.tell() if response.raw is not None else 0
+
+    bytes_sent = len(response.request.body or b'')
+    bytes_received = wire_length or content_length
+
+    _record(host, requests_count=1, bytes_sent=bytes_sent, bytes_received=bytes_received)
+
+    # elapsed is the time until the response headers came back, the rate controller's wait isn't part of it
+    _record_request_metrics(endpoint, method, response.status_code, response.elapsed.total_seconds())
+    metrics.inc(HTTP_SENT_BYTES_METRIC, bytes_sent, endpoint=endpoint)
+    metrics.inc(HTTP_RECEIVED_BYTES_METRIC, bytes_received, endpoint=endpoint)
+
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+async def _on_async_request_start(session, context, params: aiohttp.TraceRequestStartParams):
+    # Connection events don't carry the url, so remember the host on the per-request trace context
+    context.host = urlsplit(str(params.url)).netloc
+    context.endpoint = get_endpoint(str(params.url))
+    context.start_time = time.perf_counter()
+
+
+async def _on_async_request_chunk_sent(session, context, params: aiohttp.TraceRequestChunkSentParams):
+    _record(context.host, bytes_sent=len(params.chunk))
+    metrics.inc(HTTP_SENT_BYTES_METRIC, len(params.chunk), endpoint=context.endpoint)
+
+
+async def _on_async_connection_create_end(session, context, params: aiohttp.TraceConnectionCreateEndParams):
+    _record(context.host, connections_opened=1)
+
+
+async def _on_async_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+    # Content-Length is the encoded size, which is what went over the wire
+    bytes_received = params.response.content_length or 0
+
+    _record(context.host, requests_count=1, bytes_received=bytes_received)
+
+    _record_request_metrics(
+        context.endpoint, params.method, params.response.status, time.perf_counter() - context.start_time
+    )
+    metrics.inc(HTTP_RECEIVED_BYTES_METRIC, bytes_received, endpoint=context.endpoint)
+
+
+async def _on_async_request_exception(session, context, params: aiohttp.TraceRequestExceptionParams):
+    _record_request_metrics(context.endpoint, params.method, 'error')
+
+
+def create_async_session(max_connections: int, **kwargs) -> aiohttp.ClientSession:
+    """
+        aiohttp counterpart of get_session for the async fetchers. Connections are kept alive and reported in the same
+        per-host stats as the sync sessions.
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_async_request_start)
+    trace_config.on_request_chunk_sent.append(_on_async_request_chunk_sent)
+    trace_config.on_request_end.append(_on_async_request_end)
+    trace_config.on_request_exception.append(_on_async_request_exception)
+    trace_config.on_connection_create_end.append(_on_async_connection_create_end)
+
+    connector = aiohttp.TCPConnector(
+        limit=max_connections,
+        limit_per_host=max_connections,
+        keepalive_timeout=KEEP_ALIVE_TIMEOUT_SEC,
+        ttl_dns_cache=300,
+    )
+
+    headers = dict(kwargs.pop('headers', {}))
+    headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    return aiohttp.ClientSession(connector=connector, headers=headers, trace_configs=[trace_config], **kwargs)
+
+
+def get_host_stats() -> Dict[str, HostStats]:
+    with _lock:
+        host_stats = {host: HostStats(**vars(stats)) for host, stats in _host_stats.items()}
+        sessions = dict(_sessions)
+
+    for host, session in sessions.items():
+        host_stats[host].connections_opened += _count_pool_connections(session)
+
+    return host_stats
+
+
+def log_host_stats():
+    for host, stats in get_host_stats().items():
+        logger.info(
+            f'{host}: {stats.requests} requests, {stats.connections_opened} connections opened, '
+            f'{stats.reuse_ratio:.1%} reused, {stats.bytes_sent} bytes sent, {stats.bytes_received} bytes received'
+        )
@@ -0,0 +1,225 @@
+from dataclasses import dataclass
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from constants import SELLER_COST_RATE_BASIS_POINTS, TAX_RATE_BASIS_POINTS, SELL_SHIPPING_CUTOFF_CENTS, \
+    SELL_SHIPPING_COST_CENTS
+from data.order_book_store import OrderBookSnapshot
+from utils.money import apply_rate_array
+
+
+@dataclass
+class PackedListings:
+    """
+        Listings of many SKUs in flat arrays. The listings of sku_ids[k] are at offsets[k]:offsets[k + 1], sorted by
+        price + shipping like compute_max_profit_for_listings sorts them. Prices are in cents.
+    """
+    sku_ids: np.ndarray
+    offsets: np.ndarray
+    price_cents: np.ndarray
+    shipping_cents: np.ndarray
+    quantity: np.ndarray
+    quantity_limits: np.ndarray
+
+    def __len__(self):
+        return len(self.sku_ids)
+
+
+@dataclass
+class PackedProfits:
+    """
+        Best iteration of every SKU of a PackedListings. best_index is the position of the last listing bought in the
+        packed arrays, -1 when no purchase is profitable.
+    """
+    best_index: np.ndarray
+    max_profit_cents: np.ndarray
+    num_cards: np.ndarray
+    cost_cents: np.ndarray
+
+
+class ProfitRecord(NamedTuple):
+    """Profit of one SKU, what a profit worker sends back instead of the whole PackedProfits"""
+    sku_id: int
+    max_profit_cents: int
+    num_cards: int
+    cost_cents: int
+
+
+def _sum_segments(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # Unlike np.add.reduceat, empty segments sum to 0, including the ones at the end
+    cumsum = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(values, out=cumsum[1:])
+
+    return cumsum[offsets[1:]] - cumsum[offsets[:-1]]
+
+
+def pack_listings(
+        sku_id_to_listings: Dict[int, Sequence],
+        sku_id_to_quantity_limit: Optional[Dict[int, int]] = None,
+) -> PackedListings:
+    """
+        Packs listings (anything with price_cents, shipping_price_cents and quantity) by SKU. A SKU without a quantity
+        limit can buy every copy listed, as in compute_max_profit_for_listings.
+    """
+    sku_ids = np.fromiter(sku_id_to_listings.keys(), dtype=np.int64, count=len(sku_id_to_listings))
+    counts = np.fromiter(
+        (len(listings) for listings in sku_id_to_listings.values()), dtype=np.int64, count=len(sku_ids)
+    )
+
+    offsets = np.zeros(len(sku_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    listings = [listing for sku_listings in sku_id_to_listings.values() for listing in sku_listings]
+    price_cents = np.fromiter((listing.price_cents for listing in listings), dtype=np.int64, count=len(listings))
+    shipping_cents = np.fromiter(
+        (listing.shipping_price_cents for listing in listings), dtype=np.int64, count=len(listings)
+    )
+    quantity = np.fromiter((listing.quantity for listing in listings), dtype=np.int64, count=len(listings))
+
+    segment_ids = np.repeat(np.arange(len(sku_ids)), counts)
+
+    # lexsort is stable, so listings with the same cost keep their order like they do in sorted()
+    order = np.lexsort((price_cents + shipping_cents, segment_ids))
+
+    if sku_id_to_quantity_limit is None:
+        quantity_limits = _sum_segments(quantity, offsets)
+    else:
+        quantity_limits = np.fromiter(
+            (sku_id_to_quantity_limit[sku_id] for sku_id in sku_id_to_listings.keys()), dtype=np.int64,
+            count=len(sku_ids)
+        )
+
+    return PackedListings(
+        sku_ids=sku_ids,
+        offsets=offsets,
+        price_cents=price_cents[order],
+        shipping_cents=shipping_cents[order],
+        quantity=quantity[order],
+        quantity_limits=quantity_limits,
+    )
+
+
+def pack_order_books(
+        snapshot: OrderBookSnapshot,
+        sku_ids: Sequence[int],
+        sku_id_to_quantity_limit: Optional[Dict[int, int]] = None,
+) -> PackedListings:
+    """pack_listings straight from the order book store, SKUs without listings in the snapshot are left out"""
+    sku_indexes = snapshot.get_sku_indexes(sku_ids)
+    sku_indexes = sku_indexes[sku_indexes >= 0]
+    listing_indexes = snapshot.get_listing_indexes(sku_indexes)
+
+    packed_sku_ids = snapshot.sku_ids[sku_indexes].astype(np.int64)
+    offsets = np.zeros(len(sku_indexes) + 1, dtype=np.int64)
+    np.cumsum(np.diff(snapshot.offsets)[sku_indexes], out=offsets[1:])
+    quantity = snapshot.quantity[listing_indexes].astype(np.int64)
+
+    if sku_id_to_quantity_limit is None:
+        quantity_limits = _sum_segments(quantity, offsets)
+    else:
+        quantity_limits = np.fromiter(
+            (sku_id_to_quantity_limit[sku_id] for sku_id in packed_sku_ids.tolist()), dtype=np.int64,
+            count=len(packed_sku_ids)
+        )
+
+    # The books are already sorted by price + shipping
+    return PackedListings(
+        sku_ids=packed_sku_ids,
+        offsets=offsets,
+        price_cents=snapshot.price_cents[listing_indexes].astype(np.int64),
+        shipping_cents=snapshot.shipping_price_cents[listing_indexes].astype(np.int64),
+        quantity=quantity,
+        quantity_limits=quantity_limits,
+    )
+
+
+def compute_max_profits(packed: PackedListings) -> PackedProfits:
+    """
+        compute_profit_from_listings for every SKU at once. Iteration i of the loop buys listing i and sells at listing
+        i + 1, so the running quantity and cost at every listing come from cumulative sums restarted at every SKU, and
+        an iteration counts when it isn't the SKU's last listing and the quantity limit wasn't reached before it. The
+        arithmetic is the same integer cents arithmetic, so the results are exactly the same.
+    """
+    num_skus = len(packed)
+    num_listings = len(packed.quantity)
+
+    best_index = np.full(num_skus, -1, dtype=np.int64)
+    max_profit_cents = np.zeros(num_skus, dtype=np.int64)
+    num_cards = np.zeros(num_skus, dtype=np.int64)
+    cost_cents = np.zeros(num_skus, dtype=np.int64)
+
+    if num_listings == 0:
+        return PackedProfits(best_index, max_profit_cents, num_cards, cost_cents)
+
+    counts = np.diff(packed.offsets)
+    starts = packed.offsets[:-1]
+    segment_ids = np.repeat(np.arange(num_skus), counts)
+    limits = packed.quantity_limits[segment_ids]
+
+    def segmented_cumsum(values: np.ndarray) -> np.ndarray:
+        cumsum = np.cumsum(values)
+        segment_base = np.concatenate(([0], cumsum))[starts]
+        return cumsum - segment_base[segment_ids]
+
+    # Running quantity is the listed quantity capped at the limit, what each listing contributes follows from that
+    running_quantity = np.minimum(segmented_cumsum(packed.quantity), limits)
+    previous_running_quantity = np.empty_like(running_quantity)
+    previous_running_quantity[1:] = running_quantity[:-1]
+    previous_running_quantity[starts[counts > 0]] = 0
+    bought = running_quantity - previous_running_quantity
+
+    running_cost_cents = segmented_cumsum(packed.price_cents * bought + packed.shipping_cents)
+
+    is_last = np.zeros(num_listings, dtype=bool)
+    is_last[packed.offsets[1:][counts > 0] - 1] = True
+    valid = ~is_last & (previous_running_quantity < limits) & (limits > 0)
+
+    next_price_cents = np.empty_like(packed.price_cents)
+    next_price_cents[:-1] = packed.price_cents[1:]
+    next_price_cents[-1] = 0
+
+    shipping_cost_cents = np.where(next_price_cents >= SELL_SHIPPING_CUTOFF_CENTS, SELL_SHIPPING_COST_CENTS, 0)
+    revenue_cents = apply_rate_array((next_price_cents - shipping_cost_cents) * running_quantity,
+                                     SELLER_COST_RATE_BASIS_POINTS)
+    total_cost_cents = running_cost_cents + apply_rate_array(running_cost_cents, TAX_RATE_BASIS_POINTS)
+
+    profit_cents = np.where(valid, revenue_cents - total_cost_cents, np.iinfo(np.int64).min)
+
+    segment_max = np.zeros(num_skus, dtype=np.int64)
+    non_empty = counts > 0
+    segment_max[non_empty] = np.maximum.reduceat(profit_cents, starts[non_empty])
+
+    # The strict > of the loop keeps the first iteration reaching the max, and only a positive one
+    reaches_max = np.flatnonzero((profit_cents == segment_max[segment_ids]) & (profit_cents > 0))
+    segments, first = np.unique(segment_ids[reaches_max], return_index=True)
+    indexes = reaches_max[first]
+
+    best_index[segments] = indexes
+    max_profit_cents[segments] = profit_cents[indexes]
+    num_cards[segments] = running_quantity[indexes]
+    cost_cents[segments] = running_cost_cents[indexes]
+
+    return PackedProfits(best_index, max_profit_cents, num_cards, cost_cents)
+
+
+def get_profitable_sku_indexes(profits: PackedProfits, min_profit_cents: int) -> List[int]:
+    return np.flatnonzero(profits.max_profit_cents >= min_profit_cents).tolist()
+
+
+def compute_profitable_skus(packed: PackedListings, min_profit_cents: int) -> List[ProfitRecord]:
+    """
+        compute_max_profits on a packed batch, keeping only the SKUs making at least min_profit_cents. It only takes
+        and returns plain arrays and tuples, so it can run in a process pool.
+    """
+    profits = compute_max_profits(packed)
+
+    return [
+        ProfitRecord(
+            int(packed.sku_ids[index]),
+            int(profits.max_profit_cents[index]),
+            int(profits.num_cards[index]),
+            int(profits.cost_cents[index]),
+        )
+        for index in get_profitable_sku_indexes(profits, min_profit_cents)
+    ]
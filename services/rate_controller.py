@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock
+from typing import Optional, Dict
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DECREASE_FACTOR = 0.5
+DECREASE_COOLDOWN_SEC = 1
+"""A burst of errors from the same congestion event only halves the concurrency once"""
+DEFAULT_THROTTLE_PAUSE_SEC = 1
+"""How long to hold off new requests after a 429/5xx that didn't come with a Retry-After"""
+LOG_INTERVAL_SEC = 10
+
+
+def parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+    """Retry-After is either a number of seconds or an HTTP date"""
+    if not retry_after:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(tz=timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(status_code: Optional[int]) -> bool:
+    # No status code means the request never got a response (timeout, reset connection...)
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+class AIMDRateController:
+    """
+        Adaptive limit on the number of requests in flight against one endpoint. Every successful response adds
+        1/limit to the limit, so it grows by about one per round trip, and a 429/5xx halves it and pauses new requests
+        for the Retry-After the endpoint asked for. An optional requests-per-second ceiling spaces requests out on top
+        of that.
+
+        Usable from threads (acquire) and from an event loop (acquire_async), release works from either.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            initial_concurrency: int = 8,
+            min_concurrency: int = 1,
+            max_concurrency: int = 48,
+            max_requests_per_sec: Optional[float] = None,
+    ):
+        self.name = name
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_requests_per_sec = max_requests_per_sec
+        self.limit = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.in_flight = 0
+        self._condition = Condition(Lock())
+        self._paused_until = 0.0
+        self._next_request_time = 0.0
+        self._last_decrease_time = 0.0
+        self._last_log_time = 0.0
+        self._async_waiters: deque = deque()
+
+    @property
+    def concurrency(self) -> int:
+        return int(self.limit)
+
+    def _try_acquire_locked(self) -> Optional[float]:
+        """Takes a slot and returns 0, or returns how long to wait, or None if we have to wait for a release"""
+        now = time.monotonic()
+
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.in_flight >= self.concurrency:
+            return None
+        if self.max_requests_per_sec and now < self._next_request_time:
+            return self._next_request_time - now
+
+        self.in_flight += 1
+        if self.max_requests_per_sec:
+            self._next_request_time = max(now, self._next_request_time) + 1 / self.max_requests_per_sec
+
+        return 0
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait_sec = self._try_acquire_locked()
+                if wait_sec == 0:
+                    return
+
+                self._condition.wait(timeout=wait_sec)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            with self._condition:
+                wait_sec = self._try_acquire_locked()
+                if wait_sec == 0:
+                    return
+
+                if wait_sec is None:
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+
+            if wait_sec is None:
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    with self._condition:
+                        try:
+                            self._async_waiters.remove((loop, waiter))
+                        except ValueError:
+                            # A release already popped it to hand it a slot, pass the wake-up on instead of losing it
+                            self._wake_async_waiters_locked()
+                    raise
+            else:
+                await asyncio.sleep(wait_sec)
+
+    def release(self, status_code: Optional[int] = None, retry_after: Optional[str] = None):
+        """Gives the slot back and adjusts the limit based on how the request went"""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            previous_concurrency = self.concurrency
+
+            if is_throttled(status_code):
+                metrics.inc('rate_controller_throttled_total', controller=self.name, status=status_code or 'error')
+
+                if now - self._last_decrease_time >= DECREASE_COOLDOWN_SEC:
+                    self.limit = max(float(self.min_concurrency), self.limit * DECREASE_FACTOR)
+                    self._last_decrease_time = now
+
+                pause_sec = parse_retry_after(retry_after)
+                if pause_sec is None and status_code is not None:
+                    pause_sec = DEFAULT_THROTTLE_PAUSE_SEC
+                if pause_sec:
+                    self._paused_until = max(self._paused_until, now + pause_sec)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+            if self.concurrency < previous_concurrency:
+                logger.info(
+                    f'{self.name}: got {status_code or "no response"}, concurrency {previous_concurrency} -> '
+                    f'{self.concurrency}'
+                    f'{f", paused for {retry_after}s" if retry_after else ""}'
+                )
+            elif self.concurrency != previous_concurrency and now - self._last_log_time >= LOG_INTERVAL_SEC:
+                self._last_log_time = now
+                logger.info(f'{self.name}: concurrency {self.concurrency}, {self.in_flight} in flight')
+
+            metrics.set('rate_controller_concurrency', self.concurrency, controller=self.name)
+            metrics.set('rate_controller_in_flight', self.in_flight, controller=self.name)
+
+            self._condition.notify_all()
+            self._wake_async_waiters_locked()
+
+    def release_without_feedback(self):
+        """
+            Gives the slot back without adjusting the limit, for requests that say nothing about the endpoint's load:
+            cancelled ones, or ones that failed on our side after the response came back.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            metrics.set('rate_controller_in_flight', self.in_flight, controller=self.name)
+
+            self._condition.notify_all()
+            self._wake_async_waiters_locked()
+
+    def _wake_async_waiters_locked(self):
+        # Only wake as many as can actually get a slot, the rest stay parked on their futures
+        free_slots = max(1, self.concurrency - self.in_flight)
+
+        while self._async_waiters and free_slots > 0:
+            loop, waiter = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_resolve_waiter, waiter)
+            free_slots -= 1
+
+
+def _resolve_waiter(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_controllers_lock = Lock()
+_controllers: Dict[str, AIMDRateController] = {}
+
+
+def get_rate_controller(name: str, **kwargs) -> AIMDRateController:
+    """
+        Returns the shared controller for an endpoint, creating it with kwargs the first time. The requests per second
+        ceiling can be set with TCGPLAYER_<NAME>_MAX_RPS.
+    """
+    with _controllers_lock:
+        controller = _controllers.get(name)
+
+        if controller is None:
+            max_requests_per_sec = os.environ.get(f'TCGPLAYER_{name.upper()}_MAX_RPS')
+            if max_requests_per_sec:
+                kwargs['max_requests_per_sec'] = float(max_requests_per_sec)
+
+            controller = _controllers[name] = AIMDRateController(name, **kwargs)
+
+        return controller
@@ -0,0 +1,142 @@
+"""
+    Damped-trend exponential smoothing (damped Holt) fitted for many sales series at once. The series are the rows of a
+    SKUs x buckets matrix of copies sold, every fit runs the same recursion on all the rows with NumPy, and each series
+    gets the smoothing parameters of a small grid with the lowest one-step-ahead squared error.
+"""
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+
+from constants import SYNC_FREQUENCY_INTERVAL_HOURS
+
+SALES_BUCKET_SEC = SYNC_FREQUENCY_INTERVAL_HOURS * 60 * 60
+ALPHAS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.7)
+"""Level smoothing of the grid"""
+BETAS = (0.01, 0.05, 0.1, 0.2)
+"""Trend smoothing of the grid"""
+PHIS = (0.8, 0.9, 0.98)
+"""Trend damping of the grid"""
+INITIAL_LEVEL_BUCKETS = 6
+"""The initial level is the mean of the first day of buckets, the initial trend is 0"""
+MIN_SALE_BUCKETS = 4
+"""
+    Series with sales in fewer buckets than this are too sparse to fit, the smoothing would chase single sales or
+    decay to ~0 (what Holt fits returned for them before). They're forecast at their average rate instead.
+"""
+FIT_CHUNK_SIZE = 10_000
+"""Series fitted together, bounds the grid x series arrays of a fit to a few MB"""
+
+
+@dataclass
+class DampedHoltFit:
+    """Final level and trend of every series, with the parameters picked for it"""
+    level: np.ndarray
+    trend: np.ndarray
+    alpha: np.ndarray
+    beta: np.ndarray
+    phi: np.ndarray
+    sse: np.ndarray
+
+
+def bucket_sales(
+        row_indexes: np.ndarray,
+        order_timestamps: np.ndarray,
+        quantities: np.ndarray,
+        num_rows: int,
+        end_timestamp: float,
+        num_buckets: int,
+        bucket_sec: int = SALES_BUCKET_SEC,
+) -> np.ndarray:
+    """
+        Sums the quantities of sales into a num_rows x num_buckets matrix, row_indexes[i] being the row of the i-th
+        sale. The last bucket ends at end_timestamp (epoch seconds), sales outside of the buckets are dropped.
+    """
+    row_indexes = np.asarray(row_indexes, dtype=np.int64)
+    start_timestamp = end_timestamp - num_buckets * bucket_sec
+    bucket_indexes = np.floor((np.asarray(order_timestamps, dtype=np.float64) - start_timestamp) / bucket_sec)
+    bucket_indexes = bucket_indexes.astype(np.int64)
+
+    in_range = (bucket_indexes >= 0) & (bucket_indexes < num_buckets)
+    flat_indexes = row_indexes[in_range] * num_buckets + bucket_indexes[in_range]
+
+    counts = np.bincount(
+        flat_indexes, weights=np.asarray(quantities, dtype=np.float64)[in_range], minlength=num_rows * num_buckets
+    )
+
+    return counts.reshape(num_rows, num_buckets)
+
+
+def fit_damped_holt(
+        series: np.ndarray,
+        alphas: Sequence[float] = ALPHAS,
+        betas: Sequence[float] = BETAS,
+        phis: Sequence[float] = PHIS,
+) -> DampedHoltFit:
+    """
+        Runs the damped Holt recursion on every row of series for every (alpha, beta, phi) of the grid at once and keeps
+        the best parameters of each row:
+
+            forecast_t = level_t-1 + phi * trend_t-1
+            level_t = alpha * y_t + (1 - alpha) * forecast_t
+            trend_t = beta * (level_t - level_t-1) + (1 - beta) * phi * trend_t-1
+    """
+    series = np.asarray(series, dtype=np.float64)
+    num_series, num_buckets = series.shape
+
+    grid = np.array(np.meshgrid(alphas, betas, phis, indexing='ij')).reshape(3, -1, 1)
+    alpha, beta, phi = grid
+
+    level = np.broadcast_to(series[:, :INITIAL_LEVEL_BUCKETS].mean(axis=1), (grid.shape[1], num_series)).copy()
+    trend = np.zeros_like(level)
+    sse = np.zeros_like(level)
+
+    for t in range(num_buckets):
+        forecast = level + phi * trend
+        sse += (series[:, t] - forecast) ** 2
+
+        previous_level = level
+        level = alpha * series[:, t] + (1 - alpha) * forecast
+        trend = beta * (level - previous_level) + (1 - beta) * phi * trend
+
+    best = np.argmin(sse, axis=0)
+    columns = np.arange(num_series)
+
+    return DampedHoltFit(
+        level=level[best, columns],
+        trend=trend[best, columns],
+        alpha=alpha[best, 0],
+        beta=beta[best, 0],
+        phi=phi[best, 0],
+        sse=sse[best, columns],
+    )
+
+
+def forecast_damped_holt(fit: DampedHoltFit, horizon: int) -> np.ndarray:
+    """Sum of the forecasts of the next horizon buckets, level + (phi + ... + phi^h) * trend for h in 1..horizon"""
+    damping = np.cumsum(fit.phi[:, np.newaxis] ** np.arange(1, horizon + 1), axis=1).sum(axis=1)
+
+    return horizon * fit.level + damping * fit.trend
+
+
+def forecast_sales(series: np.ndarray, horizon: int, min_sale_buckets: int = MIN_SALE_BUCKETS) -> np.ndarray:
+    """
+        Copies each row of series is forecast to sell over the next horizon buckets, never negative. Rows with sales in
+        fewer than min_sale_buckets buckets get their average rate over the series instead of a fit.
+    """
+    series = np.asarray(series, dtype=np.float64)
+    num_series, num_buckets = series.shape
+
+    forecasts = np.zeros(num_series)
+    if num_buckets == 0:
+        return forecasts
+
+    sparse = np.count_nonzero(series, axis=1) < min_sale_buckets
+    forecasts[sparse] = series[sparse].sum(axis=1) / num_buckets * horizon
+
+    fitted_rows = np.flatnonzero(~sparse)
+    for start in range(0, len(fitted_rows), FIT_CHUNK_SIZE):
+        rows = fitted_rows[start:start + FIT_CHUNK_SIZE]
+        forecasts[rows] = forecast_damped_holt(fit_damped_holt(series[rows]), horizon)
+
+    return np.maximum(forecasts, 0)
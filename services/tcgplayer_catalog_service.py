@@ -1,35 +1,53 @@
 import os
+import time
 
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Optional, Mapping
 
 import requests
 from threading import Lock
 import logging
 
+from services import http_transport
+from services.rate_controller import get_rate_controller
+from utils.metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 TCGPLAYER_CATEGORY_ID = 2
-TCGPLAYER_BASE_URL = "https://api.tcgplayer.com"
+# Overridable so the jobs can run against scripts/fake_tcgplayer_server.py
+TCGPLAYER_BASE_URL = os.environ.get('TCGPLAYER_BASE_URL', "https://api.tcgplayer.com")
 TCGPLAYER_ACCESS_TOKEN_URL = f'{TCGPLAYER_BASE_URL}/token'
 TCGPLAYER_PRICING_URL = f'{TCGPLAYER_BASE_URL}/pricing/sku'
 TCGPLAYER_CATALOG_URL = f'{TCGPLAYER_BASE_URL}/catalog'
 TCGPLAYER_CATALOG_METADATA_URL = f'{TCGPLAYER_CATALOG_URL}/categories/{TCGPLAYER_CATEGORY_ID}'
+CATALOG_RATE_CONTROLLER = get_rate_controller('catalog', initial_concurrency=8, max_concurrency=48)
+ACCESS_TOKEN_REFRESH_MARGIN_SEC = 60
+"""Refresh the token a little before it actually expires so in-flight requests don't race the expiry"""
+
+
+def parse_access_token_expiry(expiry: str) -> datetime:
+    # Sat, 20 Aug 2022 18:39:21 GMT
+    return datetime.strptime(expiry, "%a, %d %b %Y %H:%M:%S %Z").replace(tzinfo=timezone.utc)
 
 
 def access_token_expired(expiry) -> bool:
     if expiry is None:
         return True
-    # Sat, 20 Aug 2022 18:39:21 GMT
-    expiry_date = datetime.strptime(expiry, "%a, %d %b %Y %H:%M:%S %Z")
 
-    return datetime.now() > expiry_date
+    return datetime.now(tz=timezone.utc) > parse_access_token_expiry(expiry)
 
 
-def _fetch_tcgplayer_resource(url, **kwargs):
+def _fetch_tcgplayer_resource(url, raise_errors: bool = False, **kwargs):
+    """
+        The JSON response of url. A failed request is logged and gives an empty response, unless raise_errors, for
+        callers that would take the empty response for a real one and retry instead.
+    """
     try:
-        response = requests.get(
+        response = http_transport.get(
             url=url,
+            rate_controller=CATALOG_RATE_CONTROLLER,
             **kwargs
         )
 
@@ -42,10 +60,18 @@ def _fetch_tcgplayer_resource(url, **kwargs):
             del data['errors']
         else:
             logger.error(errors, extra=dict(url=url))
+            metrics.inc('tcgplayer_errors_total', endpoint=http_transport.get_endpoint(url), kind='api')
+
+        results = data.get('results', [])
+        metrics.inc('tcgplayer_results_total', len(results), endpoint=http_transport.get_endpoint(url))
 
         return data
     except requests.RequestException as e:
         logger.exception(e, extra=dict(url=url))
+        metrics.inc('tcgplayer_errors_total', endpoint=http_transport.get_endpoint(url), kind='http')
+
+        if raise_errors:
+            raise
 
         return {}
 
@@ -55,15 +81,30 @@ class TCGPlayerCatalogService:
         self.lock = Lock()
         self.access_token = None
         self.access_token_expiry = None
+        self._authorization_headers: Mapping[str, str] = MappingProxyType({})
+        # time.monotonic() deadline after which the cached headers have to be rebuilt
+        self._authorization_headers_deadline = 0.0
+
+    def get_authorization_headers(self) -> Mapping[str, str]:
+        # Fast path: the headers are immutable and swapped in whole, so reading them doesn't need the lock
+        if time.monotonic() < self._authorization_headers_deadline:
+            return self._authorization_headers
 
-    def get_authorization_headers(self) -> dict:
         with self.lock:
-            headers = {}
+            # Another thread may have refreshed the token while we were waiting on the lock
+            if time.monotonic() < self._authorization_headers_deadline:
+                return self._authorization_headers
 
             if self._check_and_refresh_access_token():
-                headers['Authorization'] = f'bearer {self.access_token}'
+                self._authorization_headers = MappingProxyType({'Authorization': f'bearer {self.access_token}'})
 
-            return headers
+                expires_in = (parse_access_token_expiry(self.access_token_expiry) - datetime.now(tz=timezone.utc)) \
+                    .total_seconds()
+                self._authorization_headers_deadline = time.monotonic() + expires_in - ACCESS_TOKEN_REFRESH_MARGIN_SEC
+
+                return self._authorization_headers
+
+            return MappingProxyType({})
 
     def get_card_printings(self) -> dict:
         return _fetch_tcgplayer_resource(
@@ -95,7 +136,14 @@ class TCGPlayerCatalogService:
             params=query_params,
         ).get('results', [])
 
-    def get_cards(self, offset, limit, set_id=None):
+    def get_cards(self, offset, limit, set_id=None, raise_errors: bool = False):
+        return self.get_cards_page(offset, limit, set_id, raise_errors).get('results', [])
+
+    def get_cards_page(self, offset, limit, set_id=None, raise_errors: bool = False) -> dict:
+        """
+            The response of get_cards with its totalItems, so the first page of a set also gives its card count. With
+            raise_errors a failed request raises instead of looking like a set without cards.
+        """
         query_params = {
             'getExtendedFields': "true",
             'includeSkus': "true",
@@ -110,9 +158,10 @@ class TCGPlayerCatalogService:
 
         return _fetch_tcgplayer_resource(
             f'{TCGPLAYER_CATALOG_URL}/products',
+            raise_errors=raise_errors,
             headers=self.get_authorization_headers(),
             params=query_params
-        ).get('results', [])
+        )
 
     def get_sku_prices(self, sku_ids: list):
         return _fetch_tcgplayer_resource(
@@ -133,23 +182,7 @@ class TCGPlayerCatalogService:
         ).get('totalItems', 0)
 
     def fetch_total_card_count(self, set_id=None) -> Optional[int]:
-        query_params = {
-            'getExtendedFields': "true",
-            'includeSkus': "true",
-            'productTypes': ["Cards"],
-            'offset': 0,
-            'limit': 1,
-            'categoryId': TCGPLAYER_CATEGORY_ID,
-        }
-
-        if set_id is not None:
-            query_params['groupId'] = set_id
-
-        return _fetch_tcgplayer_resource(
-            f'{TCGPLAYER_CATALOG_URL}/products',
-            headers=self.get_authorization_headers(),
-            params=query_params
-        ).get('totalItems', 0)
+        return self.get_cards_page(0, 1, set_id).get('totalItems', 0)
 
     def _check_and_refresh_access_token(self) -> bool:
         if access_token_expired(self.access_token_expiry):
@@ -158,7 +191,7 @@ class TCGPlayerCatalogService:
             client_secret = os.environ.get("TCGPLAYER_CLIENT_SECRET")
 
             try:
-                response = requests.post(
+                response = http_transport.post(
                     TCGPLAYER_ACCESS_TOKEN_URL,
                     data={
                         'grant_type': "client_credentials",
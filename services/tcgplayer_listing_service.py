@@ -1,16 +1,42 @@
+import asyncio
+import logging
+import os
 from datetime import datetime, timedelta, timezone
 from types import MappingProxyType
-from typing import List
+from typing import List, AsyncIterator, Callable, Dict, NamedTuple, Optional
 
-import requests
+import aiohttp
 
 from models.card_sale import CardSale
+from services import http_transport
+from services.rate_controller import get_rate_controller
 from tasks.custom_types import CardRequestData, CardSalesResponse, CardSaleResponse, SKUListingResponse
+from utils.metrics import metrics, QUEUE_DEPTH_METRIC
 
-LISTING_PAGINATION_SIZE = 50
+logger = logging.getLogger(__name__)
 
-BASE_LISTINGS_URL = f'https://mp-search-api.tcgplayer.com/v1/product/%d/listings'
-BASE_SALES_URL = f'https://mpapi.tcgplayer.com/v2/product/%d/latestsales'
+LISTING_PAGINATION_SIZE = 50
+MAX_CONCURRENT_LISTING_REQUESTS = 2048
+"""Upper bound on listing page requests in flight on the event loop at once, the controller adapts below it"""
+MAX_CONCURRENT_LISTING_PRODUCTS = 4096
+"""Upper bound on products being fetched at once, so finished results can't pile up faster than they're consumed"""
+LISTING_RETRY_BASE_DELAY_SEC = 1
+LISTING_RETRY_MAX_DELAY_SEC = 300
+MAX_MALFORMED_LISTING_PAGE_ATTEMPTS = 3
+"""A page that keeps coming back with a body we can't read fails its product after this many attempts"""
+
+LISTINGS_RATE_CONTROLLER = get_rate_controller(
+    'listings',
+    initial_concurrency=64,
+    max_concurrency=MAX_CONCURRENT_LISTING_REQUESTS,
+)
+SALES_RATE_CONTROLLER = get_rate_controller('sales', initial_concurrency=4, max_concurrency=48)
+
+# Overridable so the jobs can run against scripts/fake_tcgplayer_server.py
+LISTINGS_API_URL = os.environ.get('TCGPLAYER_LISTINGS_API_URL', 'https://mp-search-api.tcgplayer.com')
+SALES_API_URL = os.environ.get('TCGPLAYER_SALES_API_URL', 'https://mpapi.tcgplayer.com')
+BASE_LISTINGS_URL = f'{LISTINGS_API_URL}/v1/product/%d/listings'
+BASE_SALES_URL = f'{SALES_API_URL}/v2/product/%d/latestsales'
 
 DEFAULT_LISTINGS_CONFIG = {
     'filter_custom': False,
@@ -30,6 +56,14 @@ BASE_HEADERS = MappingProxyType({
 })
 
 
+class ProductListings(NamedTuple):
+    request: CardRequestData
+    total_results: int
+    first_page: list[SKUListingResponse]
+    listings: Optional[list[SKUListingResponse]]
+    """All the product's listings, or None if should_fetch_remaining_pages decided the full fetch wasn't needed"""
+
+
 def get_product_active_listings_request_payload(
         offset: int,
         limit: int,
@@ -98,7 +132,12 @@ def get_product_active_listings(
             conditions=request['conditions'],
         )
 
-        response = requests.post(url=url, json=payload, headers=BASE_HEADERS)
+        response = http_transport.post(
+            url=url,
+            json=payload,
+            headers=BASE_HEADERS,
+            rate_controller=LISTINGS_RATE_CONTROLLER,
+        )
 
         response.raise_for_status()
 
@@ -108,6 +147,9 @@ def get_product_active_listings(
         total_listings = listing_data['totalResults']
         results = listing_data['results']
 
+        metrics.inc('tcgplayer_listing_pages_total')
+        metrics.inc('tcgplayer_listings_received_total', len(results))
+
         # We put the results in a set because due to data updates pagination might give us the same listing on
         # adjacent pages
         listings.update([(result['listingId'], result) for result in results])
@@ -120,11 +162,179 @@ def get_product_active_listings(
     return list(listings.values())
 
 
-def get_sales(request: CardRequestData, time_delta: timedelta) -> list[CardSaleResponse]:
+async def _fetch_product_active_listings_page(
+        http_session: aiohttp.ClientSession,
+        request: CardRequestData,
+        offset: int,
+) -> dict:
+    payload = get_product_active_listings_request_payload(
+        offset=offset,
+        limit=LISTING_PAGINATION_SIZE,
+        printings=request['printings'],
+        conditions=request['conditions'],
+    )
+
+    delay = LISTING_RETRY_BASE_DELAY_SEC
+    malformed_attempts = 0
+
+    # Like paginateWithBackoff, we keep retrying until the page comes back, but only this page waits on the backoff
+    while True:
+        await LISTINGS_RATE_CONTROLLER.acquire_async()
+
+        status_code = None
+        retry_after = None
+        # Only a response or a transport error says something about the endpoint's load
+        has_feedback = False
+        try:
+            async with http_session.post(BASE_LISTINGS_URL % request['product_id'], json=payload) as response:
+                status_code = response.status
+                retry_after = response.headers.get('Retry-After')
+
+                response.raise_for_status()
+
+                data = await response.json()
+
+            page = data['results'][0]
+            # Checked here so a bad body is retried like any other failed page, not raised by whoever reads it
+            if not isinstance(page, dict) or not isinstance(page.get('results'), list) \
+                    or not isinstance(page.get('totalResults'), int):
+                raise ValueError(f'Unexpected listings page: {str(page)[:200]}')
+
+            has_feedback = True
+            metrics.inc('tcgplayer_listing_pages_total')
+            metrics.inc('tcgplayer_listings_received_total', len(page['results']))
+
+            return page
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            has_feedback = True
+            logger.error(f'Error fetching listings for product {request["product_id"]} at offset {offset}: {e}')
+            metrics.inc('tcgplayer_listing_page_retries_total')
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            # A response with a body that isn't the listings we expect, which may not go away on a retry
+            malformed_attempts += 1
+            logger.error(
+                f'Malformed listings response for product {request["product_id"]} at offset {offset} '
+                f'(attempt {malformed_attempts}): {e!r}'
+            )
+            if malformed_attempts >= MAX_MALFORMED_LISTING_PAGE_ATTEMPTS:
+                raise
+
+            metrics.inc('tcgplayer_listing_page_retries_total')
+        finally:
+            if has_feedback:
+                LISTINGS_RATE_CONTROLLER.release(status_code, retry_after)
+            else:
+                LISTINGS_RATE_CONTROLLER.release_without_feedback()
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, LISTING_RETRY_MAX_DELAY_SEC)
+
+
+async def get_product_active_listings_async(
+        http_session: aiohttp.ClientSession,
+        request: CardRequestData,
+        should_fetch_remaining_pages: Optional[Callable[[CardRequestData, int, list], bool]] = None,
+) -> ProductListings:
+    """
+        Async version of get_product_active_listings. The first page tells us totalResults, so instead of walking the
+        pages one round trip at a time we request all the remaining pages at once.
+
+        should_fetch_remaining_pages is called with the request, totalResults and the first page. If it returns False
+        we stop there and the result has no listings.
+    """
+    first_page = await _fetch_product_active_listings_page(http_session, request, 0)
+
+    total_listings = first_page['totalResults']
+    results = first_page['results']
+
+    if should_fetch_remaining_pages is not None and not should_fetch_remaining_pages(request, total_listings, results):
+        return ProductListings(request, total_listings, results, None)
+
+    # We put the results in a dict because due to data updates pagination might give us the same listing on
+    # adjacent pages
+    listings = {result['listingId']: result for result in results}
+
+    if not results:
+        return ProductListings(request, total_listings, results, list(listings.values()))
+
+    remaining_pages = await asyncio.gather(*[
+        _fetch_product_active_listings_page(http_session, request, offset)
+        for offset in range(len(results), total_listings, LISTING_PAGINATION_SIZE)
+    ])
+
+    for page in remaining_pages:
+        listings.update([(result['listingId'], result) for result in page['results']])
+
+    return ProductListings(request, total_listings, results, list(listings.values()))
+
+
+async def stream_product_active_listings(
+        requests: List[CardRequestData],
+        max_concurrent_requests: int = MAX_CONCURRENT_LISTING_REQUESTS,
+        max_concurrent_products: int = MAX_CONCURRENT_LISTING_PRODUCTS,
+        should_fetch_remaining_pages: Optional[Callable[[CardRequestData, int, list], bool]] = None,
+) -> AsyncIterator[ProductListings]:
+    """
+        Fetches the active listings of every request on a single event loop and yields each product's ProductListings
+        as it completes, in completion order.
+
+        A product whose fetch fails is logged and left out, so one bad response doesn't fail the whole sweep.
+    """
+    async with http_transport.create_async_session(max_concurrent_requests, headers=BASE_HEADERS) as http_session:
+        product_tasks: Dict[asyncio.Task, CardRequestData] = {}
+        request_iter = iter(requests)
+
+        def schedule_next_product() -> bool:
+            request = next(request_iter, None)
+            if request is None:
+                return False
+
+            product_tasks[asyncio.create_task(
+                get_product_active_listings_async(http_session, request, should_fetch_remaining_pages)
+            )] = request
+
+            return True
+
+        for _ in range(max_concurrent_products):
+            if not schedule_next_product():
+                break
+
+        while product_tasks:
+            done, _ = await asyncio.wait(product_tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                request = product_tasks.pop(task)
+                schedule_next_product()
+
+                if task.exception() is not None:
+                    logger.error(
+                        f'Skipping the listings of product {request["product_id"]}: {task.exception()!r}',
+                        exc_info=task.exception(),
+                    )
+                    metrics.inc('tcgplayer_listing_products_failed_total')
+                    continue
+
+                yield task.result()
+
+            metrics.set(QUEUE_DEPTH_METRIC, len(product_tasks), queue='listing_products_in_flight')
+
+
+def get_sales(
+        request: CardRequestData,
+        time_delta: timedelta,
+        since: Optional[datetime] = None,
+) -> list[CardSaleResponse]:
+    """
+        Sales of the last time_delta, newest first. With since (timezone aware), only the sales after it, so a caller
+        that already has the sales up to since only pages through the new ones.
+    """
     sales = []
     product_id = request['product_id']
 
     url = BASE_SALES_URL % product_id
+    start_date = datetime.now(tz=timezone.utc) - time_delta
+    if since is not None:
+        start_date = max(start_date, since)
 
     while True:
         # The endpoint only gives back 25 at most...
@@ -135,17 +345,25 @@ def get_sales(request: CardRequestData, time_delta: timedelta) -> list[CardSaleR
             printings=request["printings"]
         )
 
-        response = requests.post(url=url, json=payload, headers=BASE_HEADERS)
+        response = http_transport.post(
+            url=url,
+            json=payload,
+            headers=BASE_HEADERS,
+            rate_controller=SALES_RATE_CONTROLLER,
+        )
 
         response.raise_for_status()
 
         data: CardSalesResponse = response.json()
 
+        metrics.inc('tcgplayer_sales_pages_total')
+
         has_new_sales = True
 
         for sale_response in data['data']:
-            if CardSale.parse_response_order_date(sale_response["orderDate"]) >= datetime.now(
-                    tz=timezone.utc) - time_delta:
+            order_date = CardSale.parse_response_order_date(sale_response["orderDate"])
+            # Strictly after since, the sales at since are the ones the caller already has
+            if order_date >= start_date and (since is None or order_date > since):
                 sales.append(sale_response)
             else:
                 has_new_sales = False
@@ -153,4 +371,6 @@ def get_sales(request: CardRequestData, time_delta: timedelta) -> list[CardSaleR
         if data['nextPage'] == "" or not has_new_sales:
             break
 
+    metrics.inc('tcgplayer_sales_received_total', len(sales))
+
     return sales
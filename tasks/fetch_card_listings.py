@@ -1,84 +1,205 @@
+import asyncio
 import logging
 from collections import defaultdict
 from datetime import datetime
-from typing import List, Dict
+from typing import Optional, List, Dict, Tuple
 
+from sqlalchemy.orm import joinedload
+
+from data.dao import carry_forward_listing_snapshot, get_latest_complete_snapshot_timestamp, \
+    get_listing_order_book_rows, start_listing_snapshot, finish_listing_snapshot
+from data.order_book_store import OrderBookSnapshotBuilder, order_book_store
 from models import db_sessionmaker, SKU, Condition
-# from models.sku_listing import SKUListing
-from models.sku_listing import SKUListing
-from models.sku_listings_batch_aggregate_data import SKUListingsBatchAggregateData
-from services.tcgplayer_listing_service import get_product_active_listings
+from models.listing_snapshot import ListingSnapshotStatus
+from services import http_transport
+from services.tcgplayer_listing_service import stream_product_active_listings
+from tasks.listing_probe import ListingProbe, compute_first_page_fingerprint, PROBE_LOOKBACK
+from tasks.listing_writer import ListingWriter, ListingIngestMode
 from tasks.log_runtime_decorator import log_runtime
-from tasks.custom_types import CardRequestData, SKUListingResponse
-from tasks.utils import paginateWithBackoff
+from tasks.custom_types import CardRequestData
+from utils.metrics import track_job, time_stage
 
 logger = logging.getLogger(__name__)
 
 session = db_sessionmaker()
 
+CARRY_FORWARD_CHUNK_SIZE = 5000
+
 
-def _insert_listing_data(
-        sku_listing_responses: List[SKUListingResponse],
-        timestamp: datetime,
+async def _fetch_and_insert_card_listings(
+    requests: list[CardRequestData],
+    writer: ListingWriter,
+    probe: Optional[ListingProbe],
 ):
-    sku_id_to_listing_response_dict: Dict[int, List[SKUListingResponse]] = defaultdict(list)
+    async for product_listings in stream_product_active_listings(
+            requests,
+            should_fetch_remaining_pages=probe.should_fetch_remaining_pages if probe is not None else None,
+    ):
+        # The probe found the product unchanged, its previous snapshot gets carried forward after the sweep
+        if product_listings.listings is None:
+            continue
+
+        # Only waits when the writer queue is full, which in turn stops new products from being scheduled
+        await writer.put_async(
+            product_listings.listings,
+            compute_first_page_fingerprint(product_listings.first_page),
+        )
+
 
-    for response in sku_listing_responses:
-        sku_id_to_listing_response_dict[int(response['productConditionId'])].append(response)
+def _group_by_source(
+        sku_ids: List[int],
+        sources: Dict[int, datetime],
+        previous_timestamp: datetime,
+) -> Dict[datetime, List[int]]:
+    """The SKUs by the snapshot they're carried forward from, previous_timestamp unless sources has another one"""
+    source_to_sku_ids = defaultdict(list)
 
-    sku_id_to_batch_aggregate_data_dict = {sku_id: SKUListingsBatchAggregateData(
-        sku_id=sku_id,
-        timestamp=timestamp,
-        lowest_listing_price=min(map(lambda response: response['price'] + response['sellerShippingPrice'], responses)),
-        total_listings_count=len(responses),
-        total_copies_count=int(sum(map(lambda response: response['quantity'], responses)))
-    ) for sku_id, responses in sku_id_to_listing_response_dict.items()}
+    for sku_id in sku_ids:
+        source_to_sku_ids[sources.get(sku_id, previous_timestamp)].append(sku_id)
 
-    session.add_all(sku_id_to_batch_aggregate_data_dict.values())
+    return source_to_sku_ids
+
+
+def _carry_forward_listings(source_to_sku_ids: Dict[datetime, List[int]], timestamp: datetime) -> int:
+    row_count = 0
+
+    for source_timestamp, sku_ids in source_to_sku_ids.items():
+        for offset in range(0, len(sku_ids), CARRY_FORWARD_CHUNK_SIZE):
+            row_count += carry_forward_listing_snapshot(
+                session,
+                sku_ids[offset:offset + CARRY_FORWARD_CHUNK_SIZE],
+                source_timestamp,
+                timestamp,
+            )
 
     session.commit()
 
-    sku_listings = map(
-        lambda response: SKUListing.from_tcgplayer_response(
-            response,
-            timestamp,
-        ),
-        sku_listing_responses,
-    )
+    return row_count
 
-    session.add_all(sku_listings)
+
+def _publish_order_books(
+        order_book_builder: OrderBookSnapshotBuilder,
+        source_to_carry_forward_sku_ids: Dict[datetime, List[int]],
+):
+    previous_snapshot = order_book_store.latest()
+    carry_forward_sku_ids = [sku_id for sku_ids in source_to_carry_forward_sku_ids.values() for sku_id in sku_ids]
+
+    # Partial snapshots are published in memory too, so the books can be newer than the snapshots carried forward from
+    if carry_forward_sku_ids and (
+            previous_snapshot is None or previous_snapshot.timestamp < max(source_to_carry_forward_sku_ids)
+    ):
+        # The carried forward books were never in memory (first sweep after a restart), read them back once from the
+        # snapshots they were carried forward from
+        for source_timestamp, sku_ids in source_to_carry_forward_sku_ids.items():
+            for offset in range(0, len(sku_ids), CARRY_FORWARD_CHUNK_SIZE):
+                order_book_builder.add_rows(get_listing_order_book_rows(
+                    session,
+                    sku_ids[offset:offset + CARRY_FORWARD_CHUNK_SIZE],
+                    source_timestamp,
+                ))
+
+        previous_snapshot = None
+
+    order_book_store.publish(order_book_builder.build(carry_forward_sku_ids, previous_snapshot))
 
 
 def fetch_card_listings(
     requests: list[CardRequestData],
-):
+    ingest_mode: ListingIngestMode = ListingIngestMode.COPY,
+    probe: Optional[ListingProbe] = None,
+    carry_forward_sku_ids: List[int] = (),
+    carry_forward_sources: Optional[Dict[int, datetime]] = None,
+    complete: bool = True,
+) -> datetime:
+    """
+        Fetches and stores the listings of every request as one snapshot. With a probe, products whose first page
+        matches the previous snapshot aren't fully fetched and their previous listings are copied into this snapshot.
+        The previous listings of carry_forward_sku_ids are copied in as well, so the snapshot stays complete when only
+        some of the products are fetched, from the previous complete snapshot or the one carry_forward_sources has for
+        the SKU. The snapshot is registered in listing_snapshot and only marked complete once everything is written.
+
+        With complete=False nothing of carry_forward_sku_ids is written, they're only carried forward in the in-memory
+        order books, and the snapshot is marked PARTIAL so readers keep using the last complete one.
+
+        Returns the timestamp of the snapshot.
+    """
     start_time = datetime.utcnow()
     logger.info(f'Fetching listings for {len(requests)} requests')
 
-    # This doesn't seem to have a rate limit...
-    paginateWithBackoff(
-        total=len(requests),
-        paginate_fn=lambda offset: get_product_active_listings(requests[offset]),
-        pagination_size=1,
-        on_paginated=lambda active_listings: _insert_listing_data(
-            active_listings,
-            start_time
-        )
+    previous_timestamp = probe.previous_timestamp if probe is not None else \
+        get_latest_complete_snapshot_timestamp(session, start_time - PROBE_LOOKBACK)
+
+    # Registered before anything is written, readers only pick the snapshot up once it's marked complete
+    start_listing_snapshot(session, start_time)
+
+    try:
+        order_book_builder = OrderBookSnapshotBuilder(start_time)
+        writer = ListingWriter(start_time, ingest_mode, order_book_builder=order_book_builder)
+        writer.start()
+
+        try:
+            # This doesn't seem to have a rate limit...
+            with time_stage('fetch_and_write_listings'):
+                asyncio.run(_fetch_and_insert_card_listings(requests, writer, probe))
+        finally:
+            writer.close()
+
+        row_count = writer.stats().rows_written
+        source_to_carry_forward_sku_ids = {}
+
+        if previous_timestamp is not None:
+            skipped_sku_ids = probe.skipped_sku_ids() if probe is not None else []
+            # The probe compares against the previous complete snapshot, so skipped products are carried from it
+            source_to_carry_forward_sku_ids = _group_by_source(
+                list(carry_forward_sku_ids),
+                carry_forward_sources or {},
+                previous_timestamp,
+            )
+            source_to_carry_forward_sku_ids.setdefault(previous_timestamp, []).extend(skipped_sku_ids)
+
+            with time_stage('carry_forward_listings'):
+                row_count += _carry_forward_listings(
+                    source_to_carry_forward_sku_ids if complete else {previous_timestamp: skipped_sku_ids},
+                    start_time,
+                )
+
+            if probe is not None:
+                logger.info(
+                    f'Probed {probe.probed_count} products, {len(probe.skipped_card_ids)} were unchanged and carried '
+                    f'forward'
+                )
+    except BaseException:
+        session.rollback()
+        finish_listing_snapshot(session, start_time, ListingSnapshotStatus.FAILED)
+        raise
+
+    finish_listing_snapshot(
+        session,
+        start_time,
+        ListingSnapshotStatus.COMPLETE if complete else ListingSnapshotStatus.PARTIAL,
+        len(requests),
+        row_count,
     )
 
-    session.commit()
+    with time_stage('publish_order_books'):
+        _publish_order_books(order_book_builder, source_to_carry_forward_sku_ids)
 
+    http_transport.log_host_stats()
 
-@log_runtime
-def fetch_all_near_mint_card_listing_data():
-    """
-        Fetches all near mint listings for given printings. Currently this isn't job isn't affected by rate limiting.
+    return start_time
 
+
+def get_near_mint_card_requests() -> Tuple[Dict[int, CardRequestData], Dict[int, List[int]]]:
+    """
         For a specific card, we only care its Near Mint variations. However, a card may have many printings that are
         Near Mint, so we need to aggregate all those printings for each card.
+
+        Returns the request for each card id and the card's near mint SKU ids.
     """
     near_mint_condition: Condition = session.query(Condition).filter(Condition.name == "Near Mint").first()
-    near_mint_skus = session.query(SKU).filter(SKU.condition_id == near_mint_condition.id)
+    near_mint_skus = session.query(SKU) \
+        .options(joinedload(SKU.printing)) \
+        .filter(SKU.condition_id == near_mint_condition.id)
     card_id_to_skus_list = [(sku.card_id, sku) for sku in near_mint_skus]
 
     card_id_to_skus_dict = defaultdict(list)
@@ -86,18 +207,32 @@ def fetch_all_near_mint_card_listing_data():
     for key, value in card_id_to_skus_list:
         card_id_to_skus_dict[key].append(value)
 
-    near_mint_skus_requests = list(
-        map(
-            lambda skus: CardRequestData(
-                product_id=skus[0].card_id,
-                conditions=[near_mint_condition.name],
-                printings=[sku.printing.name for sku in skus],
-            ),
-            card_id_to_skus_dict.values(),
+    card_id_to_request = {
+        card_id: CardRequestData(
+            product_id=card_id,
+            conditions=[near_mint_condition.name],
+            printings=[sku.printing.name for sku in skus],
         )
-    )
+        for card_id, skus in card_id_to_skus_dict.items()
+    }
+    card_id_to_sku_ids = {card_id: [sku.id for sku in skus] for card_id, skus in card_id_to_skus_dict.items()}
+
+    return card_id_to_request, card_id_to_sku_ids
+
+
+@track_job
+@log_runtime
+def fetch_all_near_mint_card_listing_data(use_probe: bool = True):
+    """
+        Fetches all near mint listings for given printings. Currently this isn't job isn't affected by rate limiting.
+
+        With use_probe, only products whose first page changed since the last sweep are fully fetched.
+    """
+    card_id_to_request, card_id_to_sku_ids = get_near_mint_card_requests()
+
+    probe = ListingProbe.load(session, card_id_to_sku_ids) if use_probe else None
 
-    fetch_card_listings(near_mint_skus_requests)
+    fetch_card_listings(list(card_id_to_request.values()), probe=probe)
 
 
 if __name__ == "__main__":
@@ -1,37 +1,174 @@
-from data.dao import query_most_recent_sale_timestamp_for_card
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from constants import SALES_TIME_DELTA_DAYS
+from data.dao import get_sku_request_data, set_card_sales_watermarks
+from data.sales_watermark_index import SalesWatermarkIndex
 from models import db_sessionmaker, CardSale
 from models.card_sync_data import SyncFrequency, CardSyncData
-from services.tcgplayer_listing_service import get_sales
+from services.tcgplayer_listing_service import get_sales, SALES_RATE_CONTROLLER
 from tasks import scheduler
+from tasks.log_runtime_decorator import log_runtime
 from tasks.set_card_sync_data import set_card_sync_data
-from tasks.custom_types import CardSaleResponse
+from tasks.custom_types import CardSaleResponse, CardRequestData
 from tasks.utils import paginateWithBackoff
+from utils.metrics import metrics, DB_ROWS_WRITTEN_METRIC
+
+logger = logging.getLogger(__name__)
 
 session = db_sessionmaker()
 
+SALES_INSERT_BATCH_SIZE = 5000
+
+
+class SalesInserter:
+    """
+        Inserts fetched sales into card_sales in batches of SALES_INSERT_BATCH_SIZE, and advances the watermarks past a
+        batch once it's committed. Used from the thread handling the fetch results only.
+    """
+
+    def __init__(self, db_session: Session, watermarks: SalesWatermarkIndex):
+        self.db_session = db_session
+        self.watermarks = watermarks
+        self.inserted = 0
+        self._pending: List[CardSale] = []
+        self._pending_card_watermarks: Dict[int, datetime] = {}
+
+    def add(self, card_id_with_sales: Tuple[int, List[CardSaleResponse]]):
+        card_id, sales = card_id_with_sales
+        self._pending.extend(CardSale.from_tcgplayer_response(response, card_id) for response in sales)
+
+        if len(self._pending) >= SALES_INSERT_BATCH_SIZE:
+            self.flush()
+
+    def add_card(self, card_id_with_sales: Tuple[int, List[CardSaleResponse]]):
+        """
+            add for sales fetched for every variant of a card since the card's watermark. The ones up to their own
+            variant's watermark were already fetched for the variant alone and are left out, and the card's watermark
+            moves past all of them with the batch they're committed in.
+        """
+        card_id, sales = card_id_with_sales
+        new_sales = []
+
+        for response in sales:
+            order_date = CardSale.parse_response_order_date(response['orderDate'])
+            if self.watermarks.is_new(card_id, response['variant'], response['condition'], order_date):
+                new_sales.append(response)
+
+            if card_id not in self._pending_card_watermarks or order_date > self._pending_card_watermarks[card_id]:
+                self._pending_card_watermarks[card_id] = order_date
+
+        self.add((card_id, new_sales))
+
+    def flush(self):
+        if not self._pending and not self._pending_card_watermarks:
+            return
+
+        try:
+            self.db_session.add_all(self._pending)
+            if self._pending_card_watermarks:
+                set_card_sales_watermarks(self.db_session, {
+                    card_id: order_date.astimezone(timezone.utc).replace(tzinfo=None)
+                    for card_id, order_date in self._pending_card_watermarks.items()
+                })
+            self.db_session.commit()
+        except BaseException:
+            # Leaves the session usable, the watermarks stay where they were so the next run fetches the batch again
+            self.db_session.rollback()
+            raise
+
+        metrics.inc(DB_ROWS_WRITTEN_METRIC, len(self._pending), table=CardSale.__tablename__)
+
+        self.watermarks.advance(self._pending)
+        self.watermarks.advance_cards(self._pending_card_watermarks)
+        self.inserted += len(self._pending)
+        self._pending = []
+        self._pending_card_watermarks = {}
 
-def _insert_sales_data(
-        product_id_with_sales: tuple[int, list[CardSaleResponse]]
-):
-    (product_id, sales) = product_id_with_sales
-    session.add_all(map(lambda response: CardSale.from_tcgplayer_response(response, product_id), sales))
 
+def _get_sales_start_date(time_delta: timedelta) -> datetime:
+    # card_sales stores the UTC order dates without their time zone
+    return datetime.now(tz=timezone.utc).replace(tzinfo=None) - time_delta
 
-def fetch_card_sales_data_for_frequency(frequency: SyncFrequency):
+
+def fetch_card_sales_data_for_frequency(
+        frequency: SyncFrequency,
+        time_delta: timedelta = timedelta(days=SALES_TIME_DELTA_DAYS),
+):
+    """
+        Fetches the sales of every card of the frequency tier since the card's sales watermark, the newest sale the
+        previous fetch of the whole card got back. Sales fetch_sales_for_skus already inserted for single variants
+        are skipped. The watermarks of all the cards are loaded up front, the fetches themselves never touch the
+        database.
+    """
     card_ids = [card[0] for card in session.query(CardSyncData.card_id)
         .filter(CardSyncData.sync_frequency == frequency)
         .all()
     ]
 
+    watermarks = SalesWatermarkIndex.load(session, card_ids, _get_sales_start_date(time_delta))
+    inserter = SalesInserter(session, watermarks)
+
+    def fetch_card_sales(offset: int) -> Tuple[int, List[CardSaleResponse]]:
+        card_id = card_ids[offset]
+        # No printings or conditions, every variant of the card
+        request = CardRequestData(product_id=card_id, printings=[], conditions=[])
+
+        return card_id, get_sales(request, time_delta, since=watermarks.get(card_id))
+
     paginateWithBackoff(
         total=len(card_ids),
-        paginate_fn=lambda offset: get_sales(
-            card_ids[offset],
-            query_most_recent_sale_timestamp_for_card(session, card_ids[offset]).scalar()),
-        on_paginated=lambda product_id_with_sales: _insert_sales_data(product_id_with_sales),
+        paginate_fn=fetch_card_sales,
+        on_paginated=inserter.add_card,
         pagination_size=1,
+        num_parallel_requests=SALES_RATE_CONTROLLER.max_concurrency,
+        name=f'fetch_card_sales_{frequency.name.lower()}',
     )
 
-    session.commit()
+    inserter.flush()
+
+    logger.info(f'Inserted {inserter.inserted} new sales of {len(card_ids)} {frequency.name} cards')
 
     scheduler.add_job(set_card_sync_data, args=[card_ids])
+
+
+@log_runtime
+def fetch_sales_for_skus(sku_ids: List[int], time_delta: timedelta = timedelta(days=SALES_TIME_DELTA_DAYS)) -> int:
+    """
+        Fetches the sales of the last time_delta of sku_ids into card_sales and returns how many were inserted. Only the
+        sales after the latest one card_sales already has for a SKU are requested, so a run only fetches what sold since
+        the previous one. The SKUs are fetched concurrently, SALES_RATE_CONTROLLER keeps the requests under the rate
+        limit, and all the database work happens on the calling thread.
+    """
+    with db_sessionmaker() as db_session:
+        sku_request_data = get_sku_request_data(db_session, sku_ids)
+        card_ids = list({card_id for _, card_id, *_ in sku_request_data})
+
+        watermarks = SalesWatermarkIndex.load(db_session, card_ids, _get_sales_start_date(time_delta))
+        inserter = SalesInserter(db_session, watermarks)
+
+        def fetch_sku_sales(offset: int) -> Tuple[int, List[CardSaleResponse]]:
+            _, card_id, printing_id, condition_id, printing_name, condition_name = sku_request_data[offset]
+
+            request = CardRequestData(product_id=card_id, printings=[printing_id], conditions=[condition_id])
+            since = watermarks.get_variant(card_id, printing_name, condition_name)
+
+            return card_id, get_sales(request, time_delta, since=since)
+
+        paginateWithBackoff(
+            total=len(sku_request_data),
+            paginate_fn=fetch_sku_sales,
+            on_paginated=inserter.add,
+            pagination_size=1,
+            num_parallel_requests=SALES_RATE_CONTROLLER.max_concurrency,
+            name='fetch_sales_for_skus',
+        )
+
+        inserter.flush()
+
+    logger.info(f'Inserted {inserter.inserted} new sales of {len(sku_request_data)} SKUs')
+
+    return inserter.inserted
@@ -1,27 +1,29 @@
 import heapq
 import logging
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from decimal import Decimal
+from concurrent.futures import as_completed
 from typing import List, Tuple
 from urllib.parse import urlencode
 
-from data.dao import get_latest_listings_for_skus
+from constants import PROFIT_WORKERS
+from data.dao import get_latest_listings_for_skus, get_latest_complete_snapshot_timestamp
+from data.order_book_store import BookListing
 from models import db_sessionmaker, SKUListing, SKU
-from tasks.utils import split_into_segments
+from tasks.utils import split_into_segments, ExecutionMode, create_cpu_executor
+from utils.money import apply_rate
 
 logger = logging.getLogger(__name__)
 
-# Max 14 workers because of DB config of 5 concurrent + 10 overflow connections
-NUM_WORKERS = 14
+ORDER_SHIPPING_COST_CENTS = 200
+ORDER_PROCESSING_COST_CENTS = 500
+PURCHASE_TAX_RATE_BASIS_POINTS = 890
+SALE_FEE_RATE_BASIS_POINTS = 1200
 
-ORDER_SHIPPING_COST = 2
-ORDER_PROCESSING_COST = 5
-PURCHASE_TAX_PERCENT = Decimal(0.089)
-SALE_FEE_AMOUNT = Decimal(0.12)
 
-
-def compute_top_pickups(data: List[Tuple[int, List[SKUListing]]], limit: int) -> List[Tuple[int, List[SKUListing]]]:
+def compute_top_pickups(
+        data: List[Tuple[int, List[SKUListing | BookListing]]],
+        limit: int,
+) -> List[Tuple[int, float]]:
     # Filter out all cards that don't have more than a page of listings because these are probably some
     # random rare prize card bullshit
     data = filter(lambda x: len(x[1]) >= 10, data)
@@ -30,14 +32,20 @@ def compute_top_pickups(data: List[Tuple[int, List[SKUListing]]], limit: int) ->
     heap = []
 
     for sku_id, listings in data_dict.items():
-        listings = sorted(listings, key=lambda listing: listing.price)
+        listings = sorted(listings, key=lambda listing: listing.price_cents)
 
         # Assume we can sell the item at the listing price at the bottom of the page.
-        total_purchase_price = listings[0].total_price * (1 + PURCHASE_TAX_PERCENT)
+        purchase_price_cents = listings[0].total_price_cents
+        total_purchase_price_cents = \
+            purchase_price_cents + apply_rate(purchase_price_cents, PURCHASE_TAX_RATE_BASIS_POINTS)
 
-        potential_profit_price = listings[9].price * (1 - SALE_FEE_AMOUNT) - ORDER_PROCESSING_COST - ORDER_SHIPPING_COST
+        sale_price_cents = listings[9].price_cents
+        potential_profit_price_cents = sale_price_cents - apply_rate(sale_price_cents, SALE_FEE_RATE_BASIS_POINTS) - \
+            ORDER_PROCESSING_COST_CENTS - ORDER_SHIPPING_COST_CENTS
 
-        potential_profit_percent = ((potential_profit_price / total_purchase_price) / total_purchase_price) * 100
+        # Same score as with dollar amounts, it's only used for ranking
+        potential_profit_percent = \
+            potential_profit_price_cents / total_purchase_price_cents / (total_purchase_price_cents / 100) * 100
 
         if potential_profit_percent < 0:
             continue
@@ -53,20 +61,23 @@ def compute_top_pickups(data: List[Tuple[int, List[SKUListing]]], limit: int) ->
     return top_pickup_sku_ids
 
 
-def find_potential_pickups():
+def find_potential_pickups(execution_mode: ExecutionMode = ExecutionMode.PROCESSES):
     session = db_sessionmaker()
-    latest_listings = get_latest_listings_for_skus(session)
+    latest_listings = get_latest_listings_for_skus(session, timestamp=get_latest_complete_snapshot_timestamp(session))
 
     sku_id_to_listings_dict = defaultdict(list)
 
+    # Plain tuples instead of the ORM objects, they are what gets pickled to the workers
     for listing in latest_listings:
-        sku_id_to_listings_dict[listing.sku_id].append(listing)
+        sku_id_to_listings_dict[listing.sku_id].append(
+            BookListing(listing.price_cents, listing.shipping_price_cents, listing.quantity)
+        )
 
-    sku_id_to_listings_segments = split_into_segments(list(sku_id_to_listings_dict.items()), NUM_WORKERS)
+    sku_id_to_listings_segments = split_into_segments(list(sku_id_to_listings_dict.items()), PROFIT_WORKERS)
 
     top_sku_ids_with_range = []
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+    with create_cpu_executor(execution_mode, PROFIT_WORKERS) as executor:
         futures = [executor.submit(compute_top_pickups, segment, 20) for segment in sku_id_to_listings_segments]
 
         for future in as_completed(futures):
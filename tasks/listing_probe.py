@@ -0,0 +1,111 @@
+import hashlib
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import List, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from data.dao import get_latest_complete_snapshot_timestamp, get_batch_aggregate_data_at_timestamp
+from tasks.custom_types import CardRequestData, SKUListingResponse
+from tasks.listing_writer import get_listing_response_total_price_cents
+from utils.money import to_cents
+
+logger = logging.getLogger(__name__)
+
+PROBE_LOOKBACK = timedelta(days=1)
+"""Only a snapshot this recent is compared against, older ones have likely aged out of sku_listing anyway"""
+
+
+def compute_first_page_fingerprint(first_page: List[SKUListingResponse]) -> int:
+    """Order-independent hash of what matters on a page of listings, as a signed 64-bit int to fit in a BIGINT"""
+    page_key = sorted(
+        (result['listingId'], result['quantity'], result['price'], result['shippingPrice']) for result in first_page
+    )
+    digest = hashlib.blake2b(repr(page_key).encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+@dataclass
+class ProductSnapshotSummary:
+    total_listings_count: int
+    lowest_listing_price_cents: int
+    first_page_fingerprint: Optional[int]
+
+
+class ListingProbe:
+    """
+        Decides from a product's first page whether the rest of its listings need fetching. A product is unchanged
+        when its totalResults, lowest price and first page fingerprint all match the previous snapshot. Skipped
+        products are remembered so their previous snapshot can be carried forward.
+    """
+
+    def __init__(
+            self,
+            previous_timestamp: Optional[datetime],
+            card_id_to_summary: Dict[int, ProductSnapshotSummary],
+            card_id_to_sku_ids: Dict[int, List[int]],
+    ):
+        self.previous_timestamp = previous_timestamp
+        self.card_id_to_summary = card_id_to_summary
+        self.card_id_to_sku_ids = card_id_to_sku_ids
+        self.skipped_card_ids: List[int] = []
+        self.probed_count = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def load(session: Session, card_id_to_sku_ids: Dict[int, List[int]]) -> 'ListingProbe':
+        previous_timestamp = get_latest_complete_snapshot_timestamp(session, datetime.utcnow() - PROBE_LOOKBACK)
+
+        if previous_timestamp is None:
+            return ListingProbe(None, {}, card_id_to_sku_ids)
+
+        sku_id_to_card_id = {sku_id: card_id for card_id, sku_ids in card_id_to_sku_ids.items() for sku_id in sku_ids}
+        card_id_to_rows = defaultdict(list)
+
+        for row in get_batch_aggregate_data_at_timestamp(session, previous_timestamp):
+            card_id = sku_id_to_card_id.get(row.sku_id)
+            if card_id is not None:
+                card_id_to_rows[card_id].append(row)
+
+        card_id_to_summary = {
+            card_id: ProductSnapshotSummary(
+                total_listings_count=sum(row.total_listings_count for row in rows),
+                lowest_listing_price_cents=min(to_cents(row.lowest_listing_price) for row in rows),
+                # Every SKU of the product was stored with the same product fingerprint
+                first_page_fingerprint=rows[0].first_page_fingerprint,
+            )
+            for card_id, rows in card_id_to_rows.items()
+        }
+
+        return ListingProbe(previous_timestamp, card_id_to_summary, card_id_to_sku_ids)
+
+    def should_fetch_remaining_pages(
+            self,
+            request: CardRequestData,
+            total_results: int,
+            first_page: List[SKUListingResponse],
+    ) -> bool:
+        summary = self.card_id_to_summary.get(request['product_id'])
+
+        changed = (
+            summary is None or
+            summary.first_page_fingerprint is None or
+            summary.total_listings_count != total_results or
+            not first_page or
+            summary.lowest_listing_price_cents != min(map(get_listing_response_total_price_cents, first_page)) or
+            summary.first_page_fingerprint != compute_first_page_fingerprint(first_page)
+        )
+
+        with self._lock:
+            self.probed_count += 1
+            if not changed:
+                self.skipped_card_ids.append(request['product_id'])
+
+        return changed
+
+    def skipped_sku_ids(self) -> List[int]:
+        return [sku_id for card_id in self.skipped_card_ids for sku_id in self.card_id_to_sku_ids.get(card_id, [])]
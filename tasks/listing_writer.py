@@ -0,0 +1,397 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from enum import Enum
+from threading import Thread, Lock
+from typing import Callable, List, Dict, Optional
+
+from data.copy_ingest import CopyBuffer
+from data.order_book_store import OrderBookSnapshotBuilder
+from models import db_sessionmaker
+from models.sku_listing import SKUListing
+from models.sku_listings_batch_aggregate_data import SKUListingsBatchAggregateData
+from tasks.custom_types import SKUListingResponse
+from utils.metrics import metrics, time_stage, DB_ROWS_WRITTEN_METRIC, QUEUE_DEPTH_METRIC
+from utils.money import to_cents, from_cents
+
+logger = logging.getLogger(__name__)
+
+NUM_LISTING_WRITERS = 4
+"""Each writer holds its own DB connection, so keep this well under the 5 + 10 overflow pool"""
+MAX_QUEUED_LISTING_BATCHES = 512
+"""Products' worth of listings the fetchers can get ahead of the writers before they're made to wait"""
+MAX_BATCHES_PER_FLUSH = 64
+"""How many queued products a writer drains into one transaction"""
+WRITER_STATS_LOG_INTERVAL_SEC = 30
+
+COPY_COMMIT_BATCH_ROWS = 100_000
+"""Number of buffered sku_listing rows after which the COPY ingester writes and commits"""
+
+SKU_LISTING_COPY_COLUMNS = (
+    'id', 'timestamp', 'sku_id', 'verified_seller', 'gold_seller', 'quantity', 'seller_name', 'price', 'shipping_price',
+)
+BATCH_AGGREGATE_DATA_COPY_COLUMNS = (
+    'sku_id',
+    'timestamp',
+    'lowest_listing_price',
+    'total_listings_count',
+    'total_copies_count',
+    'first_page_fingerprint',
+)
+
+
+class ListingIngestMode(Enum):
+    ORM = 'orm'
+    """One ORM object per row and a commit per product"""
+    COPY = 'copy'
+    """Rows are streamed into an in-memory COPY buffer and written in large batches"""
+
+
+def get_listing_response_total_price_cents(response: SKUListingResponse) -> int:
+    return to_cents(response['price']) + to_cents(response['sellerShippingPrice'])
+
+
+def compute_batch_aggregate_data(
+        sku_listing_responses: List[SKUListingResponse],
+        timestamp: datetime,
+        first_page_fingerprint: Optional[int] = None,
+) -> List[dict]:
+    sku_id_to_listing_response_dict: Dict[int, List[SKUListingResponse]] = defaultdict(list)
+
+    for response in sku_listing_responses:
+        sku_id_to_listing_response_dict[int(response['productConditionId'])].append(response)
+
+    return [dict(
+        sku_id=sku_id,
+        timestamp=timestamp,
+        lowest_listing_price=from_cents(min(map(get_listing_response_total_price_cents, responses))),
+        total_listings_count=len(responses),
+        total_copies_count=int(sum(map(lambda response: response['quantity'], responses))),
+        first_page_fingerprint=first_page_fingerprint,
+    ) for sku_id, responses in sku_id_to_listing_response_dict.items()]
+
+
+def to_sku_listing_row(response: SKUListingResponse, timestamp: datetime) -> tuple:
+    # Same values as SKUListing.from_tcgplayer_response, in SKU_LISTING_COPY_COLUMNS order
+    return (
+        response['listingId'],
+        timestamp,
+        response['productConditionId'],
+        response['verifiedSeller'],
+        response['goldSeller'],
+        response['quantity'],
+        response['sellerName'],
+        from_cents(to_cents(response['price'])),
+        from_cents(to_cents(response['shippingPrice'])),
+    )
+
+
+class ListingCopyIngester:
+    """
+        Buffers the listings and batch aggregate rows of a sweep and writes them with COPY, committing every
+        commit_batch_rows listings instead of once per product. on_commit is called after each commit, once everything
+        added so far is written.
+    """
+
+    def __init__(
+            self,
+            db_session,
+            timestamp: datetime,
+            commit_batch_rows: int = COPY_COMMIT_BATCH_ROWS,
+            on_commit: Optional[Callable[[], None]] = None,
+    ):
+        self.db_session = db_session
+        self.timestamp = timestamp
+        self.commit_batch_rows = commit_batch_rows
+        self.on_commit = on_commit
+        self.listing_buffer = CopyBuffer(SKUListing.__tablename__, SKU_LISTING_COPY_COLUMNS)
+        self.aggregate_buffer = CopyBuffer(
+            SKUListingsBatchAggregateData.__tablename__,
+            BATCH_AGGREGATE_DATA_COPY_COLUMNS,
+        )
+
+    def add(self, sku_listing_responses: List[SKUListingResponse], first_page_fingerprint: Optional[int] = None):
+        self.aggregate_buffer.add_rows(
+            tuple(row[column] for column in BATCH_AGGREGATE_DATA_COPY_COLUMNS)
+            for row in compute_batch_aggregate_data(sku_listing_responses, self.timestamp, first_page_fingerprint)
+        )
+        self.listing_buffer.add_rows(
+            to_sku_listing_row(response, self.timestamp) for response in sku_listing_responses
+        )
+
+        if self.listing_buffer.row_count >= self.commit_batch_rows:
+            self.flush()
+
+    def flush(self):
+        with time_stage('copy_listings'):
+            aggregate_row_count = self.aggregate_buffer.flush(self.db_session)
+            listing_row_count = self.listing_buffer.flush(self.db_session)
+
+            self.db_session.commit()
+
+        logger.debug(f'Copied {listing_row_count} listings and {aggregate_row_count} aggregate rows')
+
+        if self.on_commit is not None:
+            self.on_commit()
+
+
+def _insert_listing_data(
+        db_session,
+        sku_listing_responses: List[SKUListingResponse],
+        timestamp: datetime,
+        first_page_fingerprint: Optional[int] = None,
+):
+    aggregate_rows = compute_batch_aggregate_data(sku_listing_responses, timestamp, first_page_fingerprint)
+    db_session.add_all(SKUListingsBatchAggregateData(**row) for row in aggregate_rows)
+
+    sku_listings = map(
+        lambda response: SKUListing.from_tcgplayer_response(
+            response,
+            timestamp,
+        ),
+        sku_listing_responses,
+    )
+
+    db_session.add_all(sku_listings)
+
+    metrics.inc(DB_ROWS_WRITTEN_METRIC, len(aggregate_rows), table=SKUListingsBatchAggregateData.__tablename__)
+    metrics.inc(DB_ROWS_WRITTEN_METRIC, len(sku_listing_responses), table=SKUListing.__tablename__)
+
+
+@dataclass
+class ListingWriterStats:
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    batches_written: int = 0
+    rows_written: int = 0
+    writer_lag_sec: float = 0.0
+    """Time the most recently written batch spent between being queued and being committed"""
+    max_writer_lag_sec: float = 0.0
+    producer_blocked_sec: float = 0.0
+    """Total time the fetchers were held back because the queue was full"""
+
+
+@dataclass
+class _QueuedListingBatch:
+    sku_listing_responses: List[SKUListingResponse]
+    first_page_fingerprint: Optional[int]
+    queued_at: float
+
+
+_STOP = object()
+
+
+class ListingWriter:
+    """
+        Writer stage of the listing sweep. Fetchers put each product's listings on a bounded queue and return straight
+        away, while writer threads, each with their own session, drain the queue and write what they took in one go.
+        When the writers fall behind and the queue fills up, put blocks so the fetchers slow down to the write rate.
+
+        With an order_book_builder, the writers also add everything they write to it for the in-memory order books.
+    """
+
+    def __init__(
+            self,
+            timestamp: datetime,
+            ingest_mode: ListingIngestMode = ListingIngestMode.COPY,
+            num_writers: int = NUM_LISTING_WRITERS,
+            max_queued_batches: int = MAX_QUEUED_LISTING_BATCHES,
+            order_book_builder: Optional[OrderBookSnapshotBuilder] = None,
+    ):
+        self.timestamp = timestamp
+        self.ingest_mode = ingest_mode
+        self.order_book_builder = order_book_builder
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued_batches)
+        # The writers run in a copy of the creating thread's context, so what they record goes to its job
+        self.threads = [
+            Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run_writer,),
+                name=f'listing-writer-{index}',
+                daemon=True,
+            )
+            for index in range(num_writers)
+        ]
+        self.error: Optional[BaseException] = None
+        self._stats = ListingWriterStats()
+        self._stats_lock = Lock()
+        self._last_stats_log_time = time.monotonic()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, sku_listing_responses: List[SKUListingResponse], first_page_fingerprint: Optional[int] = None):
+        """Queues a product's listings for writing, waiting for space if the writers are behind."""
+        item = _QueuedListingBatch(sku_listing_responses, first_page_fingerprint, time.monotonic())
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            blocked_start_time = time.monotonic()
+
+            # Wake up now and then so a dead writer stage fails the sweep instead of blocking it forever
+            while True:
+                self._raise_if_failed()
+                try:
+                    self.queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+            with self._stats_lock:
+                self._stats.producer_blocked_sec += time.monotonic() - blocked_start_time
+
+        self._raise_if_failed()
+        self._update_queue_depth()
+
+    async def put_async(
+            self,
+            sku_listing_responses: List[SKUListingResponse],
+            first_page_fingerprint: Optional[int] = None,
+    ):
+        """put for the event loop. Only hops to a thread when the queue is full, so the loop itself never blocks."""
+        if not self.queue.full():
+            self.put(sku_listing_responses, first_page_fingerprint)
+        else:
+            await asyncio.to_thread(self.put, sku_listing_responses, first_page_fingerprint)
+
+    def close(self):
+        """Waits for everything queued to be written and stops the writers. Raises if any of the writers failed."""
+        for _ in self.threads:
+            self.queue.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+        self._log_stats()
+        self._raise_if_failed()
+
+    def stats(self) -> ListingWriterStats:
+        with self._stats_lock:
+            return ListingWriterStats(**{**vars(self._stats), 'queue_depth': self.queue.qsize()})
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise RuntimeError('Listing writer failed') from self.error
+
+    def _update_queue_depth(self):
+        queue_depth = self.queue.qsize()
+
+        with self._stats_lock:
+            self._stats.queue_depth = queue_depth
+            self._stats.max_queue_depth = max(self._stats.max_queue_depth, queue_depth)
+
+        metrics.set(QUEUE_DEPTH_METRIC, queue_depth, queue='listing_writer')
+
+    def _log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f'Listing writer: {stats.batches_written} batches, {stats.rows_written} rows, '
+            f'queue depth {stats.queue_depth} (max {stats.max_queue_depth}), '
+            f'lag {stats.writer_lag_sec:.2f}s (max {stats.max_writer_lag_sec:.2f}s), '
+            f'fetchers blocked for {stats.producer_blocked_sec:.2f}s'
+        )
+
+    def _take_batches(self) -> tuple[List[_QueuedListingBatch], bool]:
+        # Blocks for the first batch, then takes whatever else is already queued up to MAX_BATCHES_PER_FLUSH
+        batches = []
+        stop = False
+
+        item = self.queue.get()
+        while True:
+            if item is _STOP:
+                stop = True
+                break
+
+            batches.append(item)
+            if len(batches) >= MAX_BATCHES_PER_FLUSH:
+                break
+
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+        return batches, stop
+
+    def _record_written(self, batches: List[_QueuedListingBatch]):
+        now = time.monotonic()
+        writer_lag_sec = now - min(batch.queued_at for batch in batches)
+
+        with self._stats_lock:
+            self._stats.batches_written += len(batches)
+            self._stats.rows_written += sum(len(batch.sku_listing_responses) for batch in batches)
+            self._stats.writer_lag_sec = writer_lag_sec
+            self._stats.max_writer_lag_sec = max(self._stats.max_writer_lag_sec, writer_lag_sec)
+
+            should_log = now - self._last_stats_log_time >= WRITER_STATS_LOG_INTERVAL_SEC
+            if should_log:
+                self._last_stats_log_time = now
+
+        metrics.observe('listing_writer_lag_seconds', writer_lag_sec)
+
+        if should_log:
+            self._log_stats()
+
+    def _run_writer(self):
+        db_session = db_sessionmaker()
+        # Batches handed to the COPY ingester that it hasn't committed yet
+        uncommitted_batches: List[_QueuedListingBatch] = []
+
+        def record_committed():
+            if uncommitted_batches:
+                self._record_written(uncommitted_batches.copy())
+                uncommitted_batches.clear()
+
+        copy_ingester = ListingCopyIngester(db_session, self.timestamp, on_commit=record_committed) \
+            if self.ingest_mode == ListingIngestMode.COPY else None
+
+        try:
+            while True:
+                batches, stop = self._take_batches()
+
+                if batches and self.error is None:
+                    for batch in batches:
+                        if copy_ingester is not None:
+                            # Before add, which commits the batch itself when it crosses the row threshold
+                            uncommitted_batches.append(batch)
+                            copy_ingester.add(batch.sku_listing_responses, batch.first_page_fingerprint)
+                        else:
+                            _insert_listing_data(
+                                db_session,
+                                batch.sku_listing_responses,
+                                self.timestamp,
+                                batch.first_page_fingerprint,
+                            )
+
+                        if self.order_book_builder is not None:
+                            self.order_book_builder.add(batch.sku_listing_responses)
+
+                    # COPY commits on its own row threshold and records the batches it committed then, the ORM path
+                    # commits every drained batch
+                    if copy_ingester is None:
+                        db_session.commit()
+                        self._record_written(batches)
+
+                    self._update_queue_depth()
+
+                if stop:
+                    break
+
+            if copy_ingester is not None and self.error is None:
+                copy_ingester.flush()
+        except BaseException as e:
+            logger.exception(e)
+            self.error = e
+
+            # Keep draining so producers blocked on a full queue get to see the error
+            while self.queue.get() is not _STOP:
+                pass
+        finally:
+            db_session.close()
@@ -2,6 +2,7 @@ import functools
 import time
 
 from tasks import logger
+from utils.metrics import time_stage
 
 
 def log_runtime(func):
@@ -9,7 +10,9 @@ def log_runtime(func):
     def wrapper(*args, **kwargs):
         start_time = time.time()
 
-        result = func(*args, **kwargs)
+        # Also recorded as a stage of the job it runs in
+        with time_stage(func.__name__):
+            result = func(*args, **kwargs)
 
         end_time = time.time()
         logger.info(f"Finished {func.__name__} in {end_time - start_time:.2f} seconds")
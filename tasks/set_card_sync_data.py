@@ -5,9 +5,10 @@ from typing import List
 
 from sqlalchemy.dialects.postgresql import insert
 
-from data.dao import get_sales_count_since_date
+from data.dao import get_sales_count_since_date, get_sales_counts_since_date
 from models import db_sessionmaker, Card
 from models.card_sync_data import SyncFrequency, CardSyncData
+from utils.metrics import track_job
 import numpy as np
 
 logger = logging.getLogger(__name__)
@@ -15,29 +16,30 @@ logger = logging.getLogger(__name__)
 # Max 14 workers because of DB config of 5 concurrent + 10 overflow connections
 NUM_WORKERS = 14
 SALES_DELTA = timedelta(days=7)
+UPSERT_CHUNK_SIZE = 10_000
+"""2 parameters per row, well under Postgres' 65535 bind parameter limit"""
 
-worker_id = 0
 
-
-def assign_sync_frequency(card_ids: List[int], date: datetime):
+def get_sync_frequency_for_sales_count(sales_count: int) -> SyncFrequency:
     """
     Assign a fetch tier based on the sales_count. HIGH is roughly 5%, MEDIUM is 45%.
     """
-    global worker_id
-    local_worker_id = worker_id
+    if sales_count >= 25:
+        return SyncFrequency.HIGH
+    elif sales_count >= 5:
+        return SyncFrequency.MEDIUM
+    else:
+        return SyncFrequency.LOW
+
+
+def assign_sync_frequency(card_ids: List[int], date: datetime, local_worker_id: int):
     session = db_sessionmaker()
     logger.debug(f'Worker {local_worker_id} received {len(card_ids)} items')
-    worker_id += 1
 
     for index, card_id in enumerate(card_ids):
         sales_count = get_sales_count_since_date(session, card_id, date)
 
-        if sales_count >= 25:
-            frequency = SyncFrequency.HIGH
-        elif sales_count >= 5:
-            frequency = SyncFrequency.MEDIUM
-        else:
-            frequency = SyncFrequency.LOW
+        frequency = get_sync_frequency_for_sales_count(sales_count)
 
         logger.debug(f'Worker {local_worker_id} processed card {index + 1} out of {len(card_ids)}')
 
@@ -55,17 +57,56 @@ def assign_sync_frequency(card_ids: List[int], date: datetime):
     session.commit()
 
 
-def set_card_sync_data(card_ids: List[int]):
+def bulk_assign_sync_frequency(card_ids: List[int], date: datetime):
+    """
+        Same result as assign_sync_frequency, but the sales counts of all cards come from a single grouped query and
+        the tiers are upserted in chunks instead of a COUNT and an upsert per card.
+    """
+    session = db_sessionmaker()
+
+    card_id_to_sales_count = get_sales_counts_since_date(session, date)
+
+    values = [
+        {
+            'card_id': card_id,
+            'sync_frequency': get_sync_frequency_for_sales_count(card_id_to_sales_count.get(card_id, 0)),
+        }
+        for card_id in card_ids
+    ]
+
+    for offset in range(0, len(values), UPSERT_CHUNK_SIZE):
+        stmt = insert(CardSyncData).values(values[offset:offset + UPSERT_CHUNK_SIZE])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['card_id'],
+            set_={'sync_frequency': stmt.excluded.sync_frequency},
+        )
+
+        session.execute(stmt)
+
+    session.commit()
+
+    logger.info(f'Assigned sync frequencies for {len(values)} cards')
+
+
+@track_job
+def set_card_sync_data(card_ids: List[int], bulk: bool = True):
     """
         Recomputes the card sync data for cards with a given sync frequency. If none, recomputes the sync data for
         all cards. Currently, we just look at card sales to determine sync frequency.
     """
     start_date = datetime.now() - SALES_DELTA
 
+    if bulk:
+        bulk_assign_sync_frequency(list(card_ids), start_date)
+        return
+
     card_id_segments = np.array_split(card_ids, NUM_WORKERS)
 
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        futures = [executor.submit(assign_sync_frequency, segment.tolist(), start_date) for segment in card_id_segments]
+        futures = [
+            executor.submit(assign_sync_frequency, segment.tolist(), start_date, index)
+            for index, segment in enumerate(card_id_segments)
+        ]
 
         for future in as_completed(futures):
             future.result()
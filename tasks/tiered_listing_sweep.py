@@ -0,0 +1,220 @@
+import heapq
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from constants import SYNC_FREQUENCY_INTERVAL_HOURS
+from data.dao import get_latest_complete_snapshot_timestamp
+from models import db_sessionmaker
+from models.card_sync_data import SyncFrequency, CardSyncData
+from tasks.fetch_card_listings import fetch_card_listings, get_near_mint_card_requests
+from tasks.listing_probe import ListingProbe, PROBE_LOOKBACK
+from tasks.log_runtime_decorator import log_runtime
+from utils.metrics import track_job
+
+logger = logging.getLogger(__name__)
+
+session = db_sessionmaker()
+
+LISTING_SWEEP_TICK_INTERVAL = timedelta(hours=1)
+SYNC_FREQUENCY_LISTING_INTERVALS = {
+    SyncFrequency.HIGH: timedelta(hours=1),
+    SyncFrequency.MEDIUM: timedelta(hours=4),
+    SyncFrequency.LOW: timedelta(days=1),
+}
+FULL_SNAPSHOT_INTERVAL = timedelta(hours=SYNC_FREQUENCY_INTERVAL_HOURS)
+"""Ticks on these boundaries (UTC) write a complete snapshot, the ones in between only write the cards they fetch"""
+DEFAULT_SYNC_FREQUENCY = SyncFrequency.MEDIUM
+"""Cards without sync data keep the 4-hourly refresh every card used to get"""
+DUE_SLACK = LISTING_SWEEP_TICK_INTERVAL / 2
+"""Cards coming due before the middle of the next tick are fetched now, so jitter in when a tick starts can't push a
+card back a whole tick"""
+
+
+def get_full_snapshot_boundary(now: datetime) -> Optional[datetime]:
+    """The full snapshot boundary the tick at now falls on, None if it's a tick in between"""
+    boundary = datetime.min + round((now - datetime.min) / FULL_SNAPSHOT_INTERVAL) * FULL_SNAPSHOT_INTERVAL
+
+    return boundary if abs(now - boundary) <= DUE_SLACK else None
+
+
+@dataclass
+class _CardSchedule:
+    sync_frequency: SyncFrequency
+    next_due: datetime
+    last_fetched: datetime | None = None
+    last_snapshot: datetime | None = None
+    """Timestamp of the snapshot the card's listings were last written in"""
+
+
+class TieredListingScheduler:
+    """
+        Decides which cards' listings are refreshed on each tick of the listing sweep. Every card is due again one
+        sync frequency interval after it was last fetched, and a priority queue keyed by the next due time hands out
+        the cards that are due on each tick.
+
+        New cards get their first due time spread evenly over their interval, so each tick fetches about the same
+        number of cards instead of every card of a tier coming due on the same tick.
+
+        It also remembers the snapshot each card was last written in, so a full snapshot can carry every card forward
+        from its latest fetch, partial snapshots included.
+    """
+
+    def __init__(self):
+        # Entries are (next_due, card_id). Rescheduled cards leave their old entry behind, it's skipped on pop when it
+        # no longer matches the card's schedule.
+        self._due_queue: List[Tuple[datetime, int]] = []
+        self._schedules: Dict[int, _CardSchedule] = {}
+        self._lock = Lock()
+
+    def sync_cards(self, card_id_to_sync_frequency: Dict[int, SyncFrequency], now: datetime):
+        with self._lock:
+            for card_id in set(self._schedules) - set(card_id_to_sync_frequency):
+                del self._schedules[card_id]
+
+            new_card_ids_by_frequency: Dict[SyncFrequency, List[int]] = {frequency: [] for frequency in SyncFrequency}
+
+            for card_id, sync_frequency in card_id_to_sync_frequency.items():
+                schedule = self._schedules.get(card_id)
+
+                if schedule is None:
+                    new_card_ids_by_frequency[sync_frequency].append(card_id)
+                elif schedule.sync_frequency != sync_frequency:
+                    schedule.sync_frequency = sync_frequency
+
+                    # A card that moved to a faster tier shouldn't have to wait out its old interval
+                    if schedule.last_fetched is not None:
+                        next_due = schedule.last_fetched + SYNC_FREQUENCY_LISTING_INTERVALS[sync_frequency]
+                        if next_due < schedule.next_due:
+                            self._schedule(card_id, max(now, next_due))
+
+            for sync_frequency, card_ids in new_card_ids_by_frequency.items():
+                interval = SYNC_FREQUENCY_LISTING_INTERVALS[sync_frequency]
+
+                for index, card_id in enumerate(sorted(card_ids)):
+                    self._schedules[card_id] = _CardSchedule(sync_frequency, now)
+                    self._schedule(card_id, now + interval * index / len(card_ids))
+
+    def pop_due(self, now: datetime) -> List[int]:
+        """Returns the cards due by now and schedules their next refresh"""
+        due_card_ids = []
+
+        with self._lock:
+            while self._due_queue and self._due_queue[0][0] <= now + DUE_SLACK:
+                next_due, card_id = heapq.heappop(self._due_queue)
+
+                schedule = self._schedules.get(card_id)
+                if schedule is None or schedule.next_due != next_due:
+                    continue
+
+                due_card_ids.append(card_id)
+
+                schedule.last_fetched = now
+                self._schedule(card_id, now + SYNC_FREQUENCY_LISTING_INTERVALS[schedule.sync_frequency])
+
+        return due_card_ids
+
+    def record_snapshot(self, card_ids: Iterable[int], timestamp: datetime):
+        """Records that the cards' listings were written in the snapshot at timestamp"""
+        with self._lock:
+            for card_id in card_ids:
+                schedule = self._schedules.get(card_id)
+                if schedule is not None:
+                    schedule.last_snapshot = timestamp
+
+    def get_snapshots_since(self, card_ids: Iterable[int], since: datetime) -> Dict[int, datetime]:
+        """The snapshot each of the cards was last written in, for the ones written in a snapshot after since"""
+        with self._lock:
+            return {
+                card_id: self._schedules[card_id].last_snapshot
+                for card_id in card_ids
+                if card_id in self._schedules and (self._schedules[card_id].last_snapshot or since) > since
+            }
+
+    def _schedule(self, card_id: int, next_due: datetime):
+        # Called with _lock held
+        self._schedules[card_id].next_due = next_due
+        heapq.heappush(self._due_queue, (next_due, card_id))
+
+
+tiered_listing_scheduler = TieredListingScheduler()
+
+
+def _get_card_sync_frequencies(card_ids) -> Dict[int, SyncFrequency]:
+    card_id_to_sync_frequency = {card_id: DEFAULT_SYNC_FREQUENCY for card_id in card_ids}
+
+    for card_id, sync_frequency in session.query(CardSyncData.card_id, CardSyncData.sync_frequency):
+        if card_id in card_id_to_sync_frequency and sync_frequency is not None:
+            card_id_to_sync_frequency[card_id] = sync_frequency
+
+    return card_id_to_sync_frequency
+
+
+@track_job
+@log_runtime
+def fetch_due_near_mint_card_listing_data() -> bool:
+    """
+        One tick of the tiered listing sweep. Fetches the listings of the cards that are due, HIGH sync frequency cards
+        every hour, MEDIUM every 4 hours and LOW every day, each tier spread over the ticks. Ticks on a full snapshot
+        boundary carry every other card forward from the snapshot it was last written in, so the snapshot is complete,
+        while the ones in between only write the cards they fetch.
+
+        Returns whether the tick wrote a complete snapshot.
+    """
+    now = datetime.utcnow()
+    card_id_to_request, card_id_to_sku_ids = get_near_mint_card_requests()
+
+    tiered_listing_scheduler.sync_cards(_get_card_sync_frequencies(card_id_to_request.keys()), now)
+    due_card_ids = set(tiered_listing_scheduler.pop_due(now))
+    complete = get_full_snapshot_boundary(now) is not None
+
+    previous_timestamp = get_latest_complete_snapshot_timestamp(session, now - PROBE_LOOKBACK)
+
+    # Nothing to carry forward from, so this snapshot has to fetch everything
+    if previous_timestamp is None:
+        due_card_ids = set(card_id_to_request.keys())
+        complete = True
+
+    logger.info(
+        f'{len(due_card_ids)} out of {len(card_id_to_request)} cards are due for a listing refresh, writing a '
+        f'{"complete" if complete else "partial"} snapshot'
+    )
+
+    due_card_id_to_sku_ids = {card_id: card_id_to_sku_ids[card_id] for card_id in due_card_ids}
+    carry_forward_sku_ids = [
+        sku_id
+        for card_id, sku_ids in card_id_to_sku_ids.items() if card_id not in due_card_ids
+        for sku_id in sku_ids
+    ]
+
+    # Cards fetched by the partial snapshots since the last complete one are carried forward from those, the others
+    # from the last complete snapshot
+    carry_forward_sources = {}
+    if complete and previous_timestamp is not None:
+        carry_forward_sources = {
+            sku_id: snapshot_timestamp
+            for card_id, snapshot_timestamp in tiered_listing_scheduler.get_snapshots_since(
+                (card_id for card_id in card_id_to_sku_ids if card_id not in due_card_ids),
+                previous_timestamp,
+            ).items()
+            for sku_id in card_id_to_sku_ids[card_id]
+        }
+
+    snapshot_timestamp = fetch_card_listings(
+        [card_id_to_request[card_id] for card_id in due_card_ids],
+        probe=ListingProbe.load(session, due_card_id_to_sku_ids),
+        carry_forward_sku_ids=carry_forward_sku_ids,
+        carry_forward_sources=carry_forward_sources,
+        complete=complete,
+    )
+    tiered_listing_scheduler.record_snapshot(due_card_ids, snapshot_timestamp)
+
+    session.commit()
+
+    return complete
+
+
+if __name__ == "__main__":
+    fetch_due_near_mint_card_listing_data()
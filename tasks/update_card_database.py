@@ -1,17 +1,22 @@
 import logging
+from datetime import datetime
+from typing import Dict, Optional, List, Tuple
 
-from sqlalchemy import inspect
+from sqlalchemy import inspect, or_
 from sqlalchemy.dialects.postgresql import insert
 
+from data.dao import get_set_modified_dates, get_card_modified_dates
 from models import db_sessionmaker
 from models.card import Card
 from models.condition import Condition
 from models.printing import Printing
 from models.set import Set
 from models.sku import SKU
+from services import http_transport
 from services.tcgplayer_catalog_service import TCGPlayerCatalogService
 from tasks.log_runtime_decorator import log_runtime
 from tasks.utils import paginateWithBackoff
+from utils.metrics import track_job
 
 logger = logging.getLogger(__name__)
 tcgplayer_catalog_service = TCGPlayerCatalogService()
@@ -19,6 +24,7 @@ tcgplayer_catalog_service = TCGPlayerCatalogService()
 db_session = db_sessionmaker()
 
 PAGINATION_SIZE = 100
+POSTGRES_MAX_BIND_PARAMETERS = 65535
 
 
 def _to_dict(model):
@@ -30,61 +36,125 @@ def _get_upsert_conflict_set_args(model_class, excluded):
     return {column: getattr(excluded, column) for column in columns}
 
 
-def _add_updated_set_models(outdated_sets: list, set_responses: list):
-    for set_response in set_responses:
-        response_set_model = Set.from_tcgplayer_response(set_response)
+def _get_upsert_changed_condition(model_class, excluded):
+    columns = [column.name for column in inspect(model_class).columns if column.name != 'id']
+    return or_(*(
+        getattr(model_class.__table__.c, column).is_distinct_from(getattr(excluded, column)) for column in columns
+    ))
 
-        existing_set_model: Set = db_session.get(Set, response_set_model.id)
 
-        if (existing_set_model is None or
-                existing_set_model.modified_date < response_set_model.modified_date):
-            outdated_sets.append(response_set_model)
+def _upsert(model_class, values: List[dict]):
+    """
+        INSERT ... ON CONFLICT (id) DO UPDATE of values, in statements small enough for Postgres' bind parameter limit.
+        Existing rows are only updated when one of their values changed, so unchanged rows don't leave dead tuples.
+    """
+    if len(values) == 0:
+        return
 
+    chunk_size = POSTGRES_MAX_BIND_PARAMETERS // len(values[0])
 
-def _convert_and_insert_cards_and_skus(card_responses: list):
-    if len(card_responses) > 0:
-        insert_card_stmt = insert(Card).values(
-            list(map(lambda response: _to_dict(Card.from_tcgplayer_response(response)), card_responses))
-        )
+    for offset in range(0, len(values), chunk_size):
+        upsert_stmt = insert(model_class).values(values[offset:offset + chunk_size])
 
-        insert_card_stmt = insert_card_stmt.on_conflict_do_update(
+        upsert_stmt = upsert_stmt.on_conflict_do_update(
             index_elements=['id'],
-            set_=_get_upsert_conflict_set_args(Card, insert_card_stmt.excluded)
+            set_=_get_upsert_conflict_set_args(model_class, upsert_stmt.excluded),
+            where=_get_upsert_changed_condition(model_class, upsert_stmt.excluded),
         )
-        #
-        db_session.execute(insert_card_stmt)
 
-        sku_values = []
-        for card_response in card_responses:
-            for sku_response in card_response['skus']:
-                sku_values.append(_to_dict(SKU.from_tcgplayer_response(sku_response)))
+        db_session.execute(upsert_stmt)
+
+
+def _is_outdated(stored_modified_date: Optional[datetime], modified_date: Optional[datetime]) -> bool:
+    # Nothing stored yet, or stored before we kept track of modified_date
+    if stored_modified_date is None or modified_date is None:
+        return True
+
+    return stored_modified_date < modified_date
+
+
+def _add_updated_set_models(
+        outdated_sets: list,
+        set_responses: list,
+        set_id_to_modified_date: Dict[int, Optional[datetime]],
+):
+    for set_response in set_responses:
+        response_set_model = Set.from_tcgplayer_response(set_response)
+
+        if _is_outdated(set_id_to_modified_date.get(response_set_model.id), response_set_model.modified_date):
+            outdated_sets.append(response_set_model)
+
+
+def _convert_and_insert_cards_and_skus(
+        card_responses: list,
+        card_id_to_modified_date: Dict[int, Optional[datetime]],
+):
+    card_values = []
+    sku_values = []
+
+    # A set is outdated as soon as one of its cards changed, only the new and changed cards are written
+    for card_response in card_responses:
+        card_model = Card.from_tcgplayer_response(card_response)
+
+        if not _is_outdated(card_id_to_modified_date.get(card_model.id), card_model.modified_date):
+            continue
+
+        card_values.append(_to_dict(card_model))
+
+        for sku_response in card_response['skus']:
+            sku_values.append(_to_dict(SKU.from_tcgplayer_response(sku_response)))
+
+    _upsert(Card, card_values)
+    _upsert(SKU, sku_values)
+
+    logger.debug(f'{len(card_values)} of {len(card_responses)} cards of the page are new or modified')
 
-        if len(sku_values) > 0:
-            insert_sku_stmt = insert(SKU).values(sku_values)
 
-            insert_sku_stmt = insert_sku_stmt.on_conflict_do_update(
-                index_elements=['id'],
-                set_=_get_upsert_conflict_set_args(SKU, insert_sku_stmt.excluded)
-            )
+def _fetch_and_insert_cards_in_sets(set_ids: List[int], card_id_to_modified_date: Dict[int, Optional[datetime]]):
+    """
+        Fetches the cards of set_ids and upserts every page as it arrives, nothing waits for a whole set. The first
+        pages of all the sets come first, their card counts give the remaining pages, which are then all fetched
+        together. The upserts happen on the calling thread.
+    """
+    # (set id, offset) of the pages after the first
+    remaining_pages: List[Tuple[int, int]] = []
 
-            db_session.execute(insert_sku_stmt)
+    def on_first_page(set_id_with_page: Tuple[int, dict]):
+        set_id, page = set_id_with_page
 
+        _convert_and_insert_cards_and_skus(page.get('results', []), card_id_to_modified_date)
 
-def _fetch_cards_in_set(set_id: int) -> list:
-    set_card_count = tcgplayer_catalog_service.fetch_total_card_count(set_id)
-    set_cards = []
+        remaining_pages.extend(
+            (set_id, offset) for offset in range(PAGINATION_SIZE, page.get('totalItems', 0), PAGINATION_SIZE)
+        )
 
+    # A failed page raises so it's retried, an empty one would pass for a set without cards while the set's new
+    # modified_date still gets stored, and its cards would never be fetched
     paginateWithBackoff(
-        total=set_card_count,
-        paginate_fn=lambda offset: tcgplayer_catalog_service.get_cards(offset, PAGINATION_SIZE, set_id),
-        pagination_size=PAGINATION_SIZE,
-        on_paginated=lambda card_responses: set_cards.extend(card_responses),
-        # on_paginated_failure=lambda card_responses: delete_set_by_id(set_id)
+        total=len(set_ids),
+        paginate_fn=lambda offset: (
+            set_ids[offset],
+            tcgplayer_catalog_service.get_cards_page(0, PAGINATION_SIZE, set_ids[offset], raise_errors=True),
+        ),
+        pagination_size=1,
+        on_paginated=on_first_page,
+        name='fetch_first_card_pages',
     )
 
-    return set_cards
+    paginateWithBackoff(
+        total=len(remaining_pages),
+        paginate_fn=lambda offset: tcgplayer_catalog_service.get_cards(
+            remaining_pages[offset][1], PAGINATION_SIZE, remaining_pages[offset][0], raise_errors=True
+        ),
+        pagination_size=1,
+        on_paginated=lambda card_responses: _convert_and_insert_cards_and_skus(
+            card_responses, card_id_to_modified_date
+        ),
+        name='fetch_card_pages',
+    )
 
 
+@track_job
 @log_runtime
 def update_card_database():
     printing_responses = tcgplayer_catalog_service.get_card_printings()
@@ -92,63 +162,36 @@ def update_card_database():
     # rarity_responses = tcgplayer_catalog_service.get_card_rarities()
 
     # rarity_models = list(map(lambda x: Rarity.from_tcgplayer_response(x), rarity_responses))
-    insert_printing_stmt = insert(Printing).values(
-        list(map(lambda response: _to_dict(Printing.from_tcgplayer_response(response)), printing_responses))
-    )
-
-    insert_printing_stmt = insert_printing_stmt.on_conflict_do_update(
-        index_elements=['id'],
-        set_=_get_upsert_conflict_set_args(Printing, insert_printing_stmt.excluded)
-    )
-
-    insert_condition_stmt = insert(Condition).values(
-        list(map(lambda response: _to_dict(Condition.from_tcgplayer_response(response)), condition_responses))
-    )
-
-    insert_condition_stmt = insert_condition_stmt.on_conflict_do_update(
-        index_elements=['id'],
-        set_=_get_upsert_conflict_set_args(Condition, insert_condition_stmt.excluded)
-    )
-
-    db_session.execute(insert_printing_stmt)
-    db_session.execute(insert_condition_stmt)
+    _upsert(Printing, [_to_dict(Printing.from_tcgplayer_response(response)) for response in printing_responses])
+    _upsert(Condition, [_to_dict(Condition.from_tcgplayer_response(response)) for response in condition_responses])
 
     set_total_count = tcgplayer_catalog_service.get_total_card_set_count()
 
+    # The sets and the cards of the outdated ones are diffed against what's stored in memory, one query each
+    set_id_to_modified_date = get_set_modified_dates(db_session)
     outdated_sets = []
 
     paginateWithBackoff(
         total=set_total_count,
         paginate_fn=lambda offset: tcgplayer_catalog_service.get_sets(offset, PAGINATION_SIZE),
         pagination_size=PAGINATION_SIZE,
-        on_paginated=lambda set_responses: _add_updated_set_models(outdated_sets, set_responses),
+        on_paginated=lambda set_responses: _add_updated_set_models(
+            outdated_sets, set_responses, set_id_to_modified_date
+        ),
     )
 
     logger.info(f'{len(outdated_sets)} sets are outdated: {[outdated_set.name for outdated_set in outdated_sets]}')
 
-    if len(outdated_sets) > 0:
-        insert_outdated_sets_stmt = insert(Set).values(
-            list(map(lambda model: _to_dict(model), outdated_sets))
-        )
+    _upsert(Set, [_to_dict(outdated_set) for outdated_set in outdated_sets])
 
-        insert_outdated_sets_stmt = insert_outdated_sets_stmt.on_conflict_do_update(
-            index_elements=['id'],
-            set_=_get_upsert_conflict_set_args(Set, insert_outdated_sets_stmt.excluded)
-        )
+    card_id_to_modified_date = get_card_modified_dates(db_session, [outdated_set.id for outdated_set in outdated_sets])
 
-        db_session.execute(insert_outdated_sets_stmt)
-
-    # We want to "paginate" on all the card sets and fetch the cards in each set. Hence, we call paginate
-    # with pagination_size=1.
-    paginateWithBackoff(
-        total=len(outdated_sets),
-        paginate_fn=lambda offset: _fetch_cards_in_set(outdated_sets[offset].id),
-        pagination_size=1,
-        on_paginated=lambda card_responses: _convert_and_insert_cards_and_skus(card_responses),
-    )
+    _fetch_and_insert_cards_in_sets([outdated_set.id for outdated_set in outdated_sets], card_id_to_modified_date)
 
     db_session.commit()
 
+    http_transport.log_host_stats()
+
 
 if __name__ == "__main__":
     update_card_database()
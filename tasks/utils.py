@@ -1,12 +1,37 @@
+import contextvars
+import heapq
+import math
+import multiprocessing
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Callable, Any, List
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future, Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Any, List, Dict, Tuple, Optional
 from urllib.parse import urlencode
 
 from models import SKU
 from tasks import logger
+from utils.metrics import metrics, QUEUE_DEPTH_METRIC
 
 MAX_PARALLEL_NETWORK_REQUESTS = 48
+RETRY_BASE_DELAY_SEC = 1
+
+
+@dataclass
+class PaginationStats:
+    tasks: int = 0
+    retries: int = 0
+    latencies_sec: List[float] = field(default_factory=list)
+
+    def latency_percentile(self, percentile: float) -> float:
+        """Nearest-rank percentile of the task latencies, in seconds"""
+        if not self.latencies_sec:
+            return 0.0
+
+        sorted_latencies = sorted(self.latencies_sec)
+        rank = max(1, math.ceil(percentile / 100 * len(sorted_latencies)))
+
+        return sorted_latencies[rank - 1]
 
 
 def paginateWithBackoff(
@@ -17,52 +42,89 @@ def paginateWithBackoff(
         start=0,
         num_parallel_requests=MAX_PARALLEL_NETWORK_REQUESTS,
         retry_delay_sec=300,
-):
-    if total == 0:
-        return
-
-    batch_offset_increments = min(total, num_parallel_requests * pagination_size)
-
-    for batch_offset in range(start, total, batch_offset_increments):
-        with ThreadPoolExecutor(num_parallel_requests) as executor:
-            futures_to_offset_map = {
-                executor.submit(paginate_fn, cur_offset): cur_offset
-
-                for cur_offset in range(
-                    batch_offset,
-                    min(batch_offset + batch_offset_increments, total),
-                    pagination_size
-                )
-            }
-
-            while futures_to_offset_map:
-                retry_offsets = []
-
-                for future in as_completed(futures_to_offset_map.keys()):
-                    try:
-                        result = future.result()
-
-                        on_paginated(result)
+        name: Optional[str] = None,
+) -> PaginationStats:
+    """
+        Calls paginate_fn for every offset in [start, total) stepping by pagination_size, keeping exactly
+        num_parallel_requests calls in flight: as soon as one finishes the next offset is submitted. A failed offset
+        is retried on its own with exponential backoff capped at retry_delay_sec, while the rest keep going.
+
+        on_paginated is called with each result on the calling thread. Only paginate_fn is retried: an exception from
+        on_paginated, usually the database, is raised once the calls in flight have finished.
+    """
+    stats = PaginationStats()
 
-                    except Exception as e:
-                        logger.error(f'Error on offset {futures_to_offset_map[future]}: {e}')
-
-                        # If there's an error, add the offset for retry and mark the batch
-                        retry_offsets.append(futures_to_offset_map[future])
-
-                    finally:
-                        del futures_to_offset_map[future]
-
-                # If there's any tasks we need to retry, delay and rerun the batch
-                if retry_offsets:
-                    logger.info(f'Delaying for {retry_delay_sec} seconds and retrying...')
-                    time.sleep(retry_delay_sec)
-
-                    futures_to_offset_map = {
-                        executor.submit(paginate_fn, offset): offset
-
-                        for offset in retry_offsets
-                    }
+    if total == 0:
+        return stats
+
+    name = name or getattr(paginate_fn, '__name__', 'paginate')
+    offsets = iter(range(start, total, pagination_size))
+    # (ready time, offset, attempt) of offsets waiting out their backoff
+    retry_heap: List[Tuple[float, int, int]] = []
+    # future -> (offset, attempt, submit time)
+    in_flight: Dict[Future, Tuple[int, int, float]] = {}
+
+    with ThreadPoolExecutor(num_parallel_requests) as executor:
+        while True:
+            now = time.monotonic()
+
+            while len(in_flight) < num_parallel_requests:
+                if retry_heap and retry_heap[0][0] <= now:
+                    _, offset, attempt = heapq.heappop(retry_heap)
+                else:
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    attempt = 0
+
+                # Each call gets a copy of the caller's context, so what it records is labelled with the caller's job
+                future = executor.submit(contextvars.copy_context().run, paginate_fn, offset)
+                in_flight[future] = (offset, attempt, time.monotonic())
+
+            metrics.set('pagination_in_flight', len(in_flight), stage=name)
+            metrics.set(QUEUE_DEPTH_METRIC, len(retry_heap), queue=f'{name}_retries')
+
+            if not in_flight and not retry_heap:
+                break
+
+            if not in_flight:
+                # Only retries are left and none is due yet, wait() would return straight away on nothing in flight
+                time.sleep(max(0.0, retry_heap[0][0] - now))
+                continue
+
+            # Wake up for whichever comes first: a finished call or the next retry becoming due
+            timeout = max(0.0, retry_heap[0][0] - now) if retry_heap else None
+            done, _ = wait(in_flight.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                offset, attempt, submit_time = in_flight.pop(future)
+                stats.latencies_sec.append(time.monotonic() - submit_time)
+                metrics.observe('pagination_task_duration_seconds', time.monotonic() - submit_time, stage=name)
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    delay = min(retry_delay_sec, RETRY_BASE_DELAY_SEC * 2 ** attempt)
+                    logger.error(f'Error on offset {offset}: {e}. Retrying in {delay} seconds')
+
+                    stats.retries += 1
+                    metrics.inc('pagination_retries_total', stage=name)
+                    heapq.heappush(retry_heap, (time.monotonic() + delay, offset, attempt + 1))
+                    continue
+
+                on_paginated(result)
+
+                stats.tasks += 1
+                metrics.inc('pagination_tasks_total', stage=name)
+
+    logger.info(
+        f'{name}: {stats.tasks} tasks, {stats.retries} retries, latency '
+        f'p50 {stats.latency_percentile(50):.2f}s, '
+        f'p95 {stats.latency_percentile(95):.2f}s, '
+        f'p99 {stats.latency_percentile(99):.2f}s'
+    )
+
+    return stats
 
 
 def split_into_segments(array, num_segments) -> List[List[Any]]:
@@ -81,3 +143,21 @@ def split_into_segments(array, num_segments) -> List[List[Any]]:
         start = end
 
     return segments
+
+
+class ExecutionMode(Enum):
+    THREADS = 'threads'
+    PROCESSES = 'processes'
+
+
+def create_cpu_executor(execution_mode: ExecutionMode, max_workers: int) -> Executor:
+    """
+        Executor for CPU-bound work on picklable arguments. Processes are started by a forkserver rather than forked from
+        the app, whose scheduler, DB and metrics threads could hold locks a forked child would inherit held. The workers
+        import the modules of the submitted functions themselves, so those have to be module level functions, and they
+        compute and return while the parent does the I/O.
+    """
+    if execution_mode == ExecutionMode.PROCESSES:
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    return ThreadPoolExecutor(max_workers=max_workers)
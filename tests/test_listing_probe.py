@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pytest
+
+from tasks.custom_types import CardRequestData
+from tasks.listing_probe import ListingProbe, ProductSnapshotSummary, compute_first_page_fingerprint
+
+PRODUCT_ID = 42
+REQUEST = CardRequestData(product_id=PRODUCT_ID, printings=['Normal'], conditions=['Near Mint'])
+
+
+def listing(listing_id: int, price: float, quantity: int = 1, shipping_price: float = 0.99) -> dict:
+    return dict(
+        listingId=listing_id,
+        quantity=quantity,
+        price=price,
+        shippingPrice=shipping_price,
+        sellerShippingPrice=shipping_price,
+    )
+
+
+FIRST_PAGE = [listing(1, 1.50, 2), listing(2, 2.25)]
+TOTAL_RESULTS = 120
+
+
+def create_probe(**summary_changes) -> ListingProbe:
+    summary = dict(
+        total_listings_count=TOTAL_RESULTS,
+        lowest_listing_price_cents=249,
+        first_page_fingerprint=compute_first_page_fingerprint(FIRST_PAGE),
+    )
+    summary.update(summary_changes)
+
+    return ListingProbe(
+        datetime(2026, 1, 1),
+        {PRODUCT_ID: ProductSnapshotSummary(**summary)},
+        {PRODUCT_ID: [421, 422]},
+    )
+
+
+def test_unchanged_product_is_skipped_and_carried_forward():
+    probe = create_probe()
+
+    assert not probe.should_fetch_remaining_pages(REQUEST, TOTAL_RESULTS, FIRST_PAGE)
+    assert probe.probed_count == 1
+    assert probe.skipped_card_ids == [PRODUCT_ID]
+    assert probe.skipped_sku_ids() == [421, 422]
+
+
+def test_fingerprint_ignores_the_order_of_the_page():
+    assert not create_probe().should_fetch_remaining_pages(REQUEST, TOTAL_RESULTS, list(reversed(FIRST_PAGE)))
+
+
+@pytest.mark.parametrize('total_results, first_page', [
+    (TOTAL_RESULTS + 1, FIRST_PAGE),
+    (TOTAL_RESULTS - 1, FIRST_PAGE),
+    # A new lowest price
+    (TOTAL_RESULTS, [listing(3, 1.00)] + FIRST_PAGE[1:]),
+    # Same lowest price, but a quantity changed on the page
+    (TOTAL_RESULTS, [listing(1, 1.50, 3), listing(2, 2.25)]),
+    # Same lowest price, but another listing's price changed
+    (TOTAL_RESULTS, [listing(1, 1.50, 2), listing(2, 2.30)]),
+    # Same lowest price and total, but a listing was replaced by another
+    (TOTAL_RESULTS, [listing(1, 1.50, 2), listing(5, 2.25)]),
+    (TOTAL_RESULTS, []),
+])
+def test_changed_product_is_fetched(total_results, first_page):
+    probe = create_probe()
+
+    assert probe.should_fetch_remaining_pages(REQUEST, total_results, first_page)
+    assert probe.skipped_card_ids == []
+
+
+def test_changed_lowest_price_in_the_snapshot_is_fetched():
+    assert create_probe(lowest_listing_price_cents=250).should_fetch_remaining_pages(
+        REQUEST, TOTAL_RESULTS, FIRST_PAGE
+    )
+
+
+def test_product_without_a_stored_fingerprint_is_fetched():
+    assert create_probe(first_page_fingerprint=None).should_fetch_remaining_pages(REQUEST, TOTAL_RESULTS, FIRST_PAGE)
+
+
+def test_product_missing_from_the_previous_snapshot_is_fetched():
+    probe = ListingProbe(None, {}, {PRODUCT_ID: [421]})
+
+    assert probe.should_fetch_remaining_pages(REQUEST, TOTAL_RESULTS, FIRST_PAGE)
+    assert probe.skipped_sku_ids() == []
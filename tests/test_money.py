@@ -0,0 +1,76 @@
+import random
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import numpy as np
+import pytest
+
+from constants import TAX_RATE_BASIS_POINTS, SELLER_COST_RATE_BASIS_POINTS
+from utils.money import to_cents, from_cents, apply_rate, apply_rate_array, BASIS_POINTS
+
+
+@pytest.mark.parametrize('amount, cents', [
+    (0.1, 10),
+    ('0.125', 12),
+    ('0.135', 14),
+    ('0.005', 0),
+    ('0.015', 2),
+    ('-0.125', -12),
+    (Decimal('19.995'), 2000),
+    (3, 300),
+    (1.1, 110),
+])
+def test_to_cents_rounds_half_to_even(amount, cents):
+    assert to_cents(amount) == cents
+
+
+def test_from_cents_has_two_decimals():
+    assert from_cents(1234) == Decimal('12.34')
+    assert str(from_cents(5)) == '0.05'
+    assert to_cents(from_cents(-987)) == -987
+
+
+@pytest.mark.parametrize('cents, rate_basis_points, expected', [
+    # 5 * 10% is 0.5 of a cent, rounded to the even 0, and 15 * 10% to the even 2
+    (5, 1000, 0),
+    (15, 1000, 2),
+    (25, 1000, 2),
+    (35, 1000, 4),
+    (1, 5000, 0),
+    (3, 5000, 2),
+    (-5, 1000, 0),
+    (-15, 1000, -2),
+    (12345, BASIS_POINTS, 12345),
+    (0, 8500, 0),
+])
+def test_apply_rate_rounds_half_to_even(cents, rate_basis_points, expected):
+    assert apply_rate(cents, rate_basis_points) == expected
+    assert apply_rate_array(np.array([cents], dtype=np.int64), rate_basis_points).tolist() == [expected]
+
+
+def test_apply_rate_array_matches_apply_rate():
+    rng = random.Random(0)
+    cents = [rng.randint(-10 ** 9, 10 ** 9) for _ in range(5000)] + list(range(-200, 200))
+
+    for rate_basis_points in (TAX_RATE_BASIS_POINTS, SELLER_COST_RATE_BASIS_POINTS, 1, 5000, 9999):
+        expected = [apply_rate(value, rate_basis_points) for value in cents]
+
+        assert apply_rate_array(np.array(cents, dtype=np.int64), rate_basis_points).tolist() == expected
+
+
+def decimal_rate_cents(cents: int, rate: Decimal) -> int:
+    # What the Decimal code computed, in dollars and rounded half to even to the cent
+    dollars = (Decimal(cents) / 100 * rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_EVEN)
+
+    return int(dollars * 100)
+
+
+@pytest.mark.parametrize('rate_basis_points, rate', [
+    (TAX_RATE_BASIS_POINTS, Decimal('0.10')),
+    (SELLER_COST_RATE_BASIS_POINTS, Decimal('0.85')),
+])
+def test_rates_match_the_decimal_results(rate_basis_points, rate):
+    rng = random.Random(rate_basis_points)
+    cents = [rng.randint(0, 10 ** 7) for _ in range(5000)] + list(range(0, 1000))
+
+    for value in cents:
+        assert apply_rate(value, rate_basis_points) == decimal_rate_cents(value, rate), value
@@ -0,0 +1,169 @@
+import threading
+import time
+from unittest import mock
+
+import tasks.utils
+from tasks.utils import paginateWithBackoff, PaginationStats
+
+
+def test_waiting_retry_does_not_busy_loop():
+    attempts = []
+
+    def paginate(offset):
+        attempts.append(offset)
+        if len(attempts) == 1:
+            raise ValueError('first attempt fails')
+
+        return offset
+
+    results = []
+    monotonic = mock.Mock(side_effect=time.monotonic)
+
+    with mock.patch.object(tasks.utils.time, 'monotonic', monotonic):
+        stats = paginateWithBackoff(
+            total=1,
+            paginate_fn=paginate,
+            pagination_size=1,
+            on_paginated=results.append,
+            num_parallel_requests=1,
+        )
+
+    assert results == [0]
+    assert stats.tasks == 1 and stats.retries == 1
+    # The retry waits out a RETRY_BASE_DELAY_SEC backoff with nothing in flight, spinning would take thousands of calls
+    assert monotonic.call_count < 50
+
+
+def test_keeps_at_most_num_parallel_requests_in_flight():
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def paginate(offset):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+
+        time.sleep(0.01)
+
+        with lock:
+            in_flight -= 1
+
+        return offset
+
+    results = []
+
+    paginateWithBackoff(
+        total=100,
+        paginate_fn=paginate,
+        pagination_size=5,
+        on_paginated=results.append,
+        num_parallel_requests=4,
+    )
+
+    assert sorted(results) == list(range(0, 100, 5))
+    assert max_in_flight == 4
+
+
+def test_retries_run_in_order_of_their_backoff():
+    attempts = []
+    failures_left = {0: 2, 1: 1}
+
+    def paginate(offset):
+        attempts.append(offset)
+        if failures_left.get(offset, 0) > 0:
+            failures_left[offset] -= 1
+            raise ValueError(f'offset {offset} fails')
+
+        return offset
+
+    results = []
+
+    with mock.patch.object(tasks.utils, 'RETRY_BASE_DELAY_SEC', 0.05):
+        stats = paginateWithBackoff(
+            total=2,
+            paginate_fn=paginate,
+            pagination_size=1,
+            on_paginated=results.append,
+            num_parallel_requests=1,
+        )
+
+    # Offset 0's second failure doubles its backoff, so offset 1 is retried before it even though 0 failed first
+    assert attempts == [0, 1, 0, 1, 0]
+    assert results == [1, 0]
+    assert stats.tasks == 2 and stats.retries == 3
+
+
+def test_retry_delay_is_capped():
+    failures_left = 3
+    sleeps = []
+    real_sleep = time.sleep
+
+    def paginate(offset):
+        nonlocal failures_left
+        if failures_left > 0:
+            failures_left -= 1
+            raise ValueError('fails')
+
+        return offset
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        real_sleep(seconds)
+
+    with mock.patch.object(tasks.utils.time, 'sleep', sleep):
+        paginateWithBackoff(
+            total=1,
+            paginate_fn=paginate,
+            pagination_size=1,
+            on_paginated=lambda result: None,
+            num_parallel_requests=1,
+            retry_delay_sec=0.02,
+        )
+
+    assert len(sleeps) == 3
+    assert max(sleeps) <= 0.02
+
+
+def test_stats_count_tasks_retries_and_every_attempt_latency():
+    attempts = []
+
+    def paginate(offset):
+        attempts.append(offset)
+        if offset == 4 and attempts.count(4) == 1:
+            raise ValueError('first attempt fails')
+
+        return offset
+
+    with mock.patch.object(tasks.utils, 'RETRY_BASE_DELAY_SEC', 0.01):
+        stats = paginateWithBackoff(
+            total=10,
+            paginate_fn=paginate,
+            pagination_size=2,
+            on_paginated=lambda result: None,
+            num_parallel_requests=2,
+        )
+
+    assert stats.tasks == 5
+    assert stats.retries == 1
+    assert len(stats.latencies_sec) == 6
+    assert all(latency >= 0 for latency in stats.latencies_sec)
+
+
+def test_stats_when_nothing_to_paginate():
+    stats = paginateWithBackoff(total=0, paginate_fn=lambda offset: offset, pagination_size=1, on_paginated=print)
+
+    assert (stats.tasks, stats.retries, stats.latencies_sec) == (0, 0, [])
+    assert stats.latency_percentile(99) == 0.0
+
+
+def test_latency_percentile_is_nearest_rank():
+    stats = PaginationStats(latencies_sec=[0.5, 0.1, 0.4, 0.2, 0.3])
+
+    assert stats.latency_percentile(0) == 0.1
+    assert stats.latency_percentile(20) == 0.1
+    assert stats.latency_percentile(21) == 0.2
+    assert stats.latency_percentile(50) == 0.3
+    assert stats.latency_percentile(95) == 0.5
+    assert stats.latency_percentile(100) == 0.5
@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+from data.order_book_store import BookListing
+from services.find_profitable_skus import compute_max_profit_for_listings
+from services.profit_engine import pack_listings, compute_max_profits, compute_profitable_skus
+
+
+def random_book(rng: random.Random) -> list:
+    num_listings = rng.choice([0, 1, 1, 2, 3, 5, 10, 30])
+    # A handful of prices and shippings, so books often have listings with the same cost
+    return [
+        BookListing(
+            price_cents=rng.choice([1, 99, 100, 250, 999, 3999, 4000, 4001, 12_345]) + rng.randint(0, 3),
+            shipping_price_cents=rng.choice([0, 0, 99, 130]),
+            quantity=rng.randint(1, 8),
+        )
+        for _ in range(num_listings)
+    ]
+
+
+def assert_matches_loop(sku_id_to_book: dict, sku_id_to_limit: dict | None):
+    packed = pack_listings(sku_id_to_book, sku_id_to_limit)
+    profits = compute_max_profits(packed)
+
+    for index, sku_id in enumerate(packed.sku_ids.tolist()):
+        limit = sku_id_to_limit[sku_id] if sku_id_to_limit is not None else None
+        expected = compute_max_profit_for_listings(sku_id_to_book[sku_id], limit)
+
+        assert (
+            int(profits.max_profit_cents[index]), int(profits.num_cards[index]), int(profits.cost_cents[index])
+        ) == (expected.max_profit_cents, expected.num_cards, expected.cost_cents), sku_id_to_book[sku_id]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_loop_on_random_books(seed):
+    rng = random.Random(seed)
+    sku_id_to_book = {sku_id: random_book(rng) for sku_id in range(100)}
+
+    assert_matches_loop(sku_id_to_book, None)
+    assert_matches_loop(sku_id_to_book, {sku_id: rng.randint(0, 20) for sku_id in sku_id_to_book})
+
+
+def test_empty_and_single_listing_books_make_no_profit():
+    sku_id_to_book = {1: [], 2: [BookListing(100, 0, 3)], 3: []}
+
+    profits = compute_max_profits(pack_listings(sku_id_to_book))
+
+    assert profits.best_index.tolist() == [-1, -1, -1]
+    assert profits.max_profit_cents.tolist() == [0, 0, 0]
+    assert_matches_loop(sku_id_to_book, None)
+
+
+def test_no_listings_at_all():
+    profits = compute_max_profits(pack_listings({1: [], 2: []}))
+
+    assert profits.best_index.tolist() == [-1, -1]
+
+
+def test_ties_keep_the_first_listing_reaching_the_max():
+    # Both listings cost the same, the loop buys the first one it sorted and stops at the first max
+    sku_id_to_book = {
+        7: [BookListing(100, 0, 1), BookListing(100, 0, 1), BookListing(1000, 0, 1), BookListing(1000, 0, 1)],
+    }
+
+    assert_matches_loop(sku_id_to_book, None)
+    assert_matches_loop(sku_id_to_book, {7: 1})
+
+
+def test_profitable_skus_are_the_ones_above_the_cutoff():
+    rng = random.Random(0)
+    sku_id_to_book = {sku_id: random_book(rng) for sku_id in range(200)}
+
+    records = compute_profitable_skus(pack_listings(sku_id_to_book), 100)
+
+    expected = {
+        sku_id for sku_id, book in sku_id_to_book.items()
+        if compute_max_profit_for_listings(book).max_profit_cents >= 100
+    }
+    assert {record.sku_id for record in records} == expected
@@ -0,0 +1,77 @@
+import numpy as np
+
+from services.sales_forecaster import fit_damped_holt, forecast_sales, bucket_sales, MIN_SALE_BUCKETS
+
+HORIZON = 6
+NUM_BUCKETS = 42
+
+
+def test_constant_series_forecasts_its_level():
+    series = np.full((3, NUM_BUCKETS), [[1.0], [2.0], [5.0]])
+
+    fit = fit_damped_holt(series)
+
+    np.testing.assert_allclose(fit.level, [1, 2, 5])
+    np.testing.assert_allclose(fit.trend, 0, atol=1e-12)
+    np.testing.assert_allclose(forecast_sales(series, HORIZON), [6, 12, 30])
+
+
+def test_trending_series_forecasts_above_its_level():
+    series = np.arange(1, NUM_BUCKETS + 1, dtype=np.float64)[np.newaxis, :]
+
+    fit = fit_damped_holt(series)
+    forecast = forecast_sales(series, HORIZON)
+
+    assert fit.trend[0] > 0
+    # Damped, so less than carrying the trend on undamped, but more than staying at the level
+    assert HORIZON * fit.level[0] < forecast[0] < HORIZON * (series[0, -1] + HORIZON)
+
+
+def test_falling_series_never_forecasts_negative_sales():
+    series = np.concatenate([np.full(NUM_BUCKETS - 6, 10.0), np.zeros(6)])[np.newaxis, :]
+
+    assert forecast_sales(series, HORIZON)[0] >= 0
+
+
+def test_all_zero_series_forecasts_nothing():
+    assert forecast_sales(np.zeros((4, NUM_BUCKETS)), HORIZON).tolist() == [0, 0, 0, 0]
+
+
+def test_sparse_series_get_their_average_rate():
+    sparse = np.zeros(NUM_BUCKETS)
+    sparse[[3, 20]] = [4, 3]
+    dense = np.zeros(NUM_BUCKETS)
+    dense[:MIN_SALE_BUCKETS * 2] = 1
+
+    forecasts = forecast_sales(np.stack([sparse, dense]), HORIZON)
+
+    assert np.count_nonzero(sparse) < MIN_SALE_BUCKETS
+    assert forecasts[0] == 7 / NUM_BUCKETS * HORIZON
+    # The dense series is fitted, and with its sales long past, forecast below its average rate
+    assert forecasts[1] < MIN_SALE_BUCKETS * 2 / NUM_BUCKETS * HORIZON
+
+
+def test_rows_are_forecast_independently():
+    rng = np.random.default_rng(0)
+    series = rng.poisson(2, size=(5, NUM_BUCKETS)).astype(np.float64)
+
+    together = forecast_sales(series, HORIZON)
+    alone = [forecast_sales(series[row:row + 1], HORIZON)[0] for row in range(len(series))]
+
+    np.testing.assert_allclose(together, alone)
+
+
+def test_bucket_sales_drops_sales_outside_the_buckets():
+    end_timestamp = 10 * 3600.0
+
+    buckets = bucket_sales(
+        row_indexes=[0, 0, 1, 1, 1],
+        order_timestamps=[end_timestamp - 1, end_timestamp - 3600 - 1, end_timestamp, 0.0, end_timestamp - 1],
+        quantities=[1, 2, 5, 7, 3],
+        num_rows=2,
+        end_timestamp=end_timestamp,
+        num_buckets=3,
+        bucket_sec=3600,
+    )
+
+    assert buckets.tolist() == [[0, 2, 1], [0, 0, 3]]
@@ -0,0 +1,366 @@
+"""
+    In-process metrics of the jobs: counters, gauges and histograms keyed by name and labels, kept in one thread-safe
+    registry. Everything recorded while a job decorated with track_job runs is labelled with the job, so the series of
+    jobs running side by side don't mix, and stages are timed into stage_duration_seconds labelled with the stage.
+
+    The registry is served in the Prometheus text format by start_metrics_server, and every tracked job writes a JSON
+    summary of what it recorded to METRICS_SUMMARY_DIR when it ends.
+"""
+import bisect
+import functools
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Dict, List, Tuple, Union
+
+from sqlalchemy import event
+
+from utils.profiling import job_transaction, profile_job
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+"""Histogram buckets, from single requests and statements up to whole sweeps"""
+METRICS_SUMMARY_DIR = os.environ.get('METRICS_SUMMARY_DIR', 'metrics')
+NO_JOB = 'none'
+"""Job label of what's recorded outside of a tracked job"""
+
+STAGE_DURATION_METRIC = 'stage_duration_seconds'
+JOB_DURATION_METRIC = 'job_duration_seconds'
+JOB_RUNS_METRIC = 'job_runs_total'
+DB_ROWS_WRITTEN_METRIC = 'db_rows_written_total'
+DB_STATEMENTS_METRIC = 'db_statements_total'
+DB_STATEMENT_DURATION_METRIC = 'db_statement_duration_seconds'
+DB_COMMIT_DURATION_METRIC = 'db_commit_duration_seconds'
+QUEUE_DEPTH_METRIC = 'queue_depth'
+
+current_job: ContextVar[str] = ContextVar('current_job', default=NO_JOB)
+"""
+    The tracked job the caller runs in. Threads don't inherit it, work handed to a pool keeps it when submitted with
+    contextvars.copy_context().run.
+"""
+
+Labels = Tuple[Tuple[str, str], ...]
+SeriesKey = Tuple[str, Labels]
+
+
+class MetricType(Enum):
+    COUNTER = 'counter'
+    GAUGE = 'gauge'
+    HISTOGRAM = 'histogram'
+
+
+@dataclass
+class HistogramValue:
+    buckets: Tuple[float, ...]
+    bucket_counts: List[int] = field(default_factory=list)
+    """Observations per bucket, not cumulative, the last one is +Inf"""
+    count: int = 0
+    sum: float = 0.0
+
+    def __post_init__(self):
+        if not self.bucket_counts:
+            self.bucket_counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def copy(self) -> 'HistogramValue':
+        return HistogramValue(self.buckets, list(self.bucket_counts), self.count, self.sum)
+
+    def minus(self, other: 'HistogramValue') -> 'HistogramValue':
+        return HistogramValue(
+            self.buckets,
+            [count - other_count for count, other_count in zip(self.bucket_counts, other.bucket_counts)],
+            self.count - other.count,
+            self.sum - other.sum,
+        )
+
+    def quantile(self, quantile: float) -> float:
+        """Upper bound of the bucket the quantile falls in, the largest finite bucket when it's past all of them"""
+        rank = quantile * self.count
+        cumulative_count = 0
+
+        for bucket, count in zip(self.buckets, self.bucket_counts):
+            cumulative_count += count
+            if cumulative_count >= rank:
+                return bucket
+
+        return self.buckets[-1]
+
+
+MetricValue = Union[float, HistogramValue]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = Lock()
+        self._types: Dict[str, MetricType] = {}
+        self._values: Dict[SeriesKey, MetricValue] = {}
+
+    def _get_key(self, name: str, metric_type: MetricType, labels: dict) -> SeriesKey:
+        # Called with _lock held
+        registered_type = self._types.setdefault(name, metric_type)
+        if registered_type != metric_type:
+            raise ValueError(f'{name} is a {registered_type.value}, not a {metric_type.value}')
+
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def _with_job(labels: dict) -> dict:
+        return labels if 'job' in labels else {**labels, 'job': current_job.get()}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        labels = self._with_job(labels)
+
+        with self._lock:
+            key = self._get_key(name, MetricType.COUNTER, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        labels = self._with_job(labels)
+
+        with self._lock:
+            self._values[self._get_key(name, MetricType.GAUGE, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        labels = self._with_job(labels)
+
+        with self._lock:
+            key = self._get_key(name, MetricType.HISTOGRAM, labels)
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = HistogramValue(DEFAULT_BUCKETS_SEC)
+
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """Observes how long the block took into the histogram name, whether it raised or not"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def snapshot(self) -> Dict[SeriesKey, Tuple[MetricType, MetricValue]]:
+        with self._lock:
+            return {
+                key: (self._types[key[0]], value.copy() if isinstance(value, HistogramValue) else value)
+                for key, value in self._values.items()
+            }
+
+    def render_prometheus(self) -> str:
+        """Every series in the Prometheus text exposition format"""
+        lines = []
+        previous_name = None
+
+        for (name, labels), (metric_type, value) in sorted(self.snapshot().items(), key=lambda item: item[0]):
+            if name != previous_name:
+                lines.append(f'# TYPE {name} {metric_type.value}')
+                previous_name = name
+
+            if metric_type != MetricType.HISTOGRAM:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+
+            cumulative_count = 0
+            for bucket, count in zip(value.buckets + (float('inf'),), value.bucket_counts):
+                cumulative_count += count
+                bucket_labels = labels + (('le', _format_value(bucket)),)
+                lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {cumulative_count}')
+
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value.sum)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels
+    )
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def time_stage(stage: str, **labels):
+    """Times the block into stage_duration_seconds of the current job"""
+    return metrics.time(STAGE_DURATION_METRIC, stage=stage, **labels)
+
+
+def summarize_job(
+        job: str,
+        before: Dict[SeriesKey, Tuple[MetricType, MetricValue]],
+        after: Dict[SeriesKey, Tuple[MetricType, MetricValue]],
+) -> dict:
+    """What the job recorded between the two snapshots: counter increases, last gauge values and histogram changes"""
+    summary = dict(counters={}, gauges={}, histograms={})
+
+    for key, (metric_type, value) in sorted(after.items(), key=lambda item: item[0]):
+        name, labels = key
+        if dict(labels).get('job') != job:
+            continue
+
+        series = f'{name}{_format_labels(tuple(label for label in labels if label[0] != "job"))}'
+        previous_value = before.get(key, (metric_type, None))[1]
+
+        if metric_type == MetricType.GAUGE:
+            summary['gauges'][series] = value
+        elif metric_type == MetricType.COUNTER:
+            if value - (previous_value or 0):
+                summary['counters'][series] = value - (previous_value or 0)
+        else:
+            delta = value.minus(previous_value) if previous_value is not None else value
+            if delta.count:
+                summary['histograms'][series] = dict(
+                    count=delta.count,
+                    sum=delta.sum,
+                    mean=delta.sum / delta.count,
+                    p50=delta.quantile(0.5),
+                    p95=delta.quantile(0.95),
+                )
+
+    return summary
+
+
+def _write_job_summary(summary: dict):
+    try:
+        os.makedirs(METRICS_SUMMARY_DIR, exist_ok=True)
+        path = os.path.join(
+            METRICS_SUMMARY_DIR,
+            f'{summary["job"]}-{datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%S")}.json',
+        )
+
+        with open(path, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+        logger.info(f'Wrote the metrics of {summary["job"]} to {path}')
+    except OSError as e:
+        # Losing a summary isn't worth failing the job over
+        logger.warning(f'Could not write the metrics of {summary["job"]}: {e}')
+
+
+def track_job(func):
+    """
+        Runs func as a job: what it records is labelled with its name, its runs and duration are recorded, and a JSON
+        summary of its metrics is written when it ends. Each run is also a Sentry transaction, and is profiled when the
+        job is in PROFILE_JOBS, see utils/profiling.py.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = func.__name__
+        token = current_job.set(job)
+        started_at = datetime.now(tz=timezone.utc)
+        before = metrics.snapshot()
+        start_time = time.perf_counter()
+        status = 'error'
+
+        try:
+            with job_transaction(job), profile_job(job):
+                result = func(*args, **kwargs)
+            status = 'success'
+
+            return result
+        finally:
+            duration_sec = time.perf_counter() - start_time
+            metrics.observe(JOB_DURATION_METRIC, duration_sec)
+            metrics.inc(JOB_RUNS_METRIC, status=status)
+
+            _write_job_summary(dict(
+                job=job,
+                status=status,
+                started_at=started_at.isoformat(),
+                duration_sec=duration_sec,
+                **summarize_job(job, before, metrics.snapshot()),
+            ))
+
+            current_job.reset(token)
+
+    return wrapper
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render_prometheus().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the job logs
+        pass
+
+
+def start_metrics_server(port: int, host: str = 'localhost') -> ThreadingHTTPServer:
+    """Serves the registry at http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+
+    logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    return server
+
+
+def instrument_database(engine, session_factory):
+    """Records the statements run on engine, and how long the commits of session_factory's sessions take"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('metrics_statement_start_times', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration_sec = time.perf_counter() - connection.info['metrics_statement_start_times'].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+
+        metrics.inc(DB_STATEMENTS_METRIC, operation=operation)
+        metrics.observe(DB_STATEMENT_DURATION_METRIC, duration_sec, operation=operation)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        # The statement failed, so after_cursor_execute won't pop its start time
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('metrics_statement_start_times'):
+            connection.info['metrics_statement_start_times'].pop()
+
+    @event.listens_for(session_factory, 'before_commit')
+    def before_commit(session):
+        session.info['metrics_commit_start_time'] = time.perf_counter()
+
+    @event.listens_for(session_factory, 'after_commit')
+    def after_commit(session):
+        start_time = session.info.pop('metrics_commit_start_time', None)
+        if start_time is not None:
+            metrics.observe(DB_COMMIT_DURATION_METRIC, time.perf_counter() - start_time)
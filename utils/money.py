@@ -0,0 +1,44 @@
+"""
+    Money is handled as integer cents and rates as integer basis points, so the analysis loops only do int arithmetic
+    and every rounding is explicit: amounts round to the cent half to even, in to_cents and apply_rate alike. Decimal
+    only comes back at the storage boundary (from_cents), for the Numeric(10, 2) columns.
+"""
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import numpy as np
+
+BASIS_POINTS = 10_000
+"""A rate of 1 (100%) in basis points"""
+
+
+def to_cents(amount) -> int:
+    """Cents of a float, str, int or Decimal dollar amount, rounded half to even past the second decimal"""
+    if isinstance(amount, int):
+        return amount * 100
+
+    # str() of a float is its shortest repr, so 0.1 becomes 10 cents and not 10.000000000000000555
+    return int(Decimal(str(amount)).scaleb(2).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_cents(cents: int) -> Decimal:
+    """Dollar amount of cents with exactly 2 decimals, as stored in Numeric(10, 2)"""
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def apply_rate(cents: int, rate_basis_points: int) -> int:
+    """cents * rate rounded half to even to the cent"""
+    quotient, remainder = divmod(cents * rate_basis_points, BASIS_POINTS)
+
+    if 2 * remainder > BASIS_POINTS or (2 * remainder == BASIS_POINTS and quotient % 2 == 1):
+        quotient += 1
+
+    return quotient
+
+
+def apply_rate_array(cents: np.ndarray, rate_basis_points: int) -> np.ndarray:
+    """apply_rate for an int64 array of cents"""
+    quotient, remainder = np.divmod(cents * rate_basis_points, BASIS_POINTS)
+
+    round_up = (2 * remainder > BASIS_POINTS) | ((2 * remainder == BASIS_POINTS) & (quotient % 2 == 1))
+
+    return quotient + round_up
@@ -0,0 +1,156 @@
+"""
+    How much of each job gets traced and profiled. Every job decorated with track_job runs in a Sentry transaction named
+    after it, and Sentry keeps SENTRY_TRACES_SAMPLE_RATE of them and profiles SENTRY_PROFILES_SAMPLE_RATE of the kept
+    ones. Both can be set per job, e.g.
+
+        SENTRY_JOB_TRACES_SAMPLE_RATES=find_profitable_skus=1,fetch_due_near_mint_card_listing_data=0.05
+
+    For a closer look, the jobs named in PROFILE_JOBS (comma separated, * for all of them) run under cProfile and
+    tracemalloc. Every run writes {job}-{timestamp}.prof, for pstats or snakeviz, and {job}-{timestamp}.txt, with the
+    slowest functions and the peak memory, to PROFILE_DIR:
+
+        PROFILE_JOBS=find_profitable_skus python services/find_profitable_skus.py
+
+    cProfile only sees the thread running the job, not its worker threads or processes, while tracemalloc counts the
+    allocations of the whole process.
+"""
+import io
+import logging
+import os
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Dict, Optional, TYPE_CHECKING
+
+import sentry_sdk
+from sentry_sdk.integrations.logging import LoggingIntegration
+
+# Only profiled runs need these, every job imports this module
+if TYPE_CHECKING:
+    import cProfile
+    import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+SENTRY_DSN = 'https://10a229c7bc4d2953f655cca7add05f6f@o4506209812873216.ingest.us.sentry.io/4507025756061696'
+
+TRACES_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE', 0.1))
+PROFILES_SAMPLE_RATE = float(os.environ.get('SENTRY_PROFILES_SAMPLE_RATE', 0.0))
+"""Share of the sampled transactions that are also profiled"""
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_TOP_FUNCTIONS = 40
+PROFILE_TOP_ALLOCATIONS = 20
+
+
+def parse_job_sample_rates(value: str) -> Dict[str, float]:
+    """Parses job=rate pairs separated by commas"""
+    job_to_rate = {}
+
+    for pair in filter(None, (pair.strip() for pair in value.split(','))):
+        job, _, rate = pair.partition('=')
+        job_to_rate[job.strip()] = float(rate)
+
+    return job_to_rate
+
+
+JOB_TRACES_SAMPLE_RATES = parse_job_sample_rates(os.environ.get('SENTRY_JOB_TRACES_SAMPLE_RATES', ''))
+JOB_PROFILES_SAMPLE_RATES = parse_job_sample_rates(os.environ.get('SENTRY_JOB_PROFILES_SAMPLE_RATES', ''))
+
+
+def _get_transaction_name(sampling_context: dict) -> Optional[str]:
+    return (sampling_context.get('transaction_context') or {}).get('name')
+
+
+def traces_sampler(sampling_context: dict) -> float:
+    return JOB_TRACES_SAMPLE_RATES.get(_get_transaction_name(sampling_context), TRACES_SAMPLE_RATE)
+
+
+def profiles_sampler(sampling_context: dict) -> float:
+    return JOB_PROFILES_SAMPLE_RATES.get(_get_transaction_name(sampling_context), PROFILES_SAMPLE_RATE)
+
+
+def init_sentry():
+    # Both tasks and services call this on import, the client is only set up once
+    if sentry_sdk.get_client().is_active():
+        return
+
+    sentry_sdk.init(
+        dsn=SENTRY_DSN,
+        traces_sampler=traces_sampler,
+        profiles_sampler=profiles_sampler,
+        integrations=[
+            LoggingIntegration(
+                level=logging.INFO,
+                event_level=logging.INFO,
+            )
+        ]
+    )
+
+
+def job_transaction(job: str):
+    """Sentry transaction of a job run, sampled by traces_sampler and profiles_sampler"""
+    return sentry_sdk.start_transaction(op='job', name=job)
+
+
+def is_profiled(job: str) -> bool:
+    # Read on every run, so a job can be profiled by setting the variable for a single run of it
+    profiled_jobs = {job.strip() for job in os.environ.get('PROFILE_JOBS', '').split(',')}
+
+    return job in profiled_jobs or '*' in profiled_jobs
+
+
+def _format_profile_report(job: str, profiler: 'cProfile.Profile', peak_bytes: int, snapshot: 'tracemalloc.Snapshot'):
+    import pstats
+
+    report = io.StringIO()
+    report.write(f'{job}\n\nPeak traced memory: {peak_bytes / 2 ** 20:.1f} MiB\n\n')
+
+    report.write(f'Top {PROFILE_TOP_ALLOCATIONS} allocations still held at the end of the run:\n')
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ALLOCATIONS]:
+        report.write(f'{stat.size / 2 ** 20:10.2f} MiB {stat.count:10} blocks  {stat.traceback[0]}\n')
+
+    report.write('\n')
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+
+    return report.getvalue()
+
+
+@contextmanager
+def _profile_run(job: str):
+    import cProfile
+    import tracemalloc
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f'{job}-{datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%S")}')
+
+            profiler.dump_stats(f'{path}.prof')
+            with open(f'{path}.txt', 'w') as file:
+                file.write(_format_profile_report(job, profiler, peak_bytes, snapshot))
+
+            logger.info(f'Wrote the profile of {job} to {path}.prof, peak memory {peak_bytes / 2 ** 20:.1f} MiB')
+        except OSError as e:
+            logger.warning(f'Could not write the profile of {job}: {e}')
+
+
+def profile_job(job: str):
+    """Profiles the block into PROFILE_DIR if job is in PROFILE_JOBS, does nothing otherwise"""
+    return _profile_run(job) if is_profiled(job) else nullcontext()
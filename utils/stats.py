@@ -1,12 +1,13 @@
 import datetime
 from datetime import timedelta
+from typing import TYPE_CHECKING
 
-import pandas as pd
-from matplotlib import dates
-from pandas import DataFrame
+# pandas and matplotlib take seconds to import and only the analysis scripts use these, so they're imported on use
+if TYPE_CHECKING:
+    from pandas import DataFrame
 
 
-def remove_outliers_iqr(df: DataFrame, axis: str) -> DataFrame:
+def remove_outliers_iqr(df: 'DataFrame', axis: str) -> 'DataFrame':
     q3 = df[axis].quantile(0.75)
     q1 = df[axis].quantile(0.25)
     iqr = q3 - q1
@@ -21,9 +22,12 @@ def remove_outliers_iqr(df: DataFrame, axis: str) -> DataFrame:
     return filtered_df
 
 
-def get_past_week_data(df: DataFrame, axis: str) -> DataFrame:
+def get_past_week_data(df: 'DataFrame', axis: str) -> 'DataFrame':
     return df[df[axis] > (datetime.datetime.now() - timedelta(days=7))].sort_values(axis)
 
 
 def shift_series_by_time_delta(series, time_delta) -> list:
+    import pandas as pd
+    from matplotlib import dates
+
     return dates.date2num(series - (datetime.datetime.now() - time_delta) + pd.to_datetime(dates.get_epoch()))